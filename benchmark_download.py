@@ -0,0 +1,106 @@
+"""
+Compare download throughput of the ranged, multi-connection Downloader with
+streaming the whole file in 4 KiB chunks, against a local HTTP server that
+can limit each connection's rate like a remote object store does.
+
+    python benchmark_download.py --size-mb 64 --rate-mb 20
+"""
+
+import argparse
+import os
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from processing.api import iter_to_file
+from processing.download import Downloader
+
+
+def make_handler(data, rate):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2)), len(data) - 1)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            else:
+                start, end = 0, len(data) - 1
+                self.send_response(200)
+            self.send_header("Content-Length", str(end + 1 - start))
+            self.end_headers()
+            view = memoryview(data)[start : end + 1]
+            block = 64 * 1024
+            started = time.time()
+            for offset in range(0, len(view), block):
+                self.wfile.write(view[offset : offset + block])
+                if rate:
+                    # hold each connection to rate bytes a second
+                    ahead = (offset + block) / rate - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def timed(name, size, download):
+    start = time.time()
+    download()
+    seconds = time.time() - start
+    print(f"{name:<40} {seconds:6.2f}s {size / seconds / 1024**2:8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=float, default=64)
+    parser.add_argument(
+        "--rate-mb", type=float, default=20, help="per connection, 0 for no limit"
+    )
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--part-mb", type=float, default=8)
+    args = parser.parse_args()
+
+    data = os.urandom(int(args.size_mb * 1024**2))
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), make_handler(data, args.rate_mb * 1024**2)
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/recording"
+
+    with tempfile.TemporaryDirectory() as temp:
+        filename = os.path.join(temp, "recording")
+
+        def single():
+            r = requests.get(url, stream=True)
+            r.raise_for_status()
+            iter_to_file(filename, r.iter_content(chunk_size=4096))
+
+        def ranged():
+            Downloader(requests.Session(), args.connections, args.part_mb).download(
+                url, filename
+            )
+
+        timed("one connection, 4 KiB chunks", len(data), single)
+        timed(
+            f"{args.connections} connections, {args.part_mb:g} MB parts",
+            len(data),
+            ranged,
+        )
+        with open(filename, "rb") as f:
+            assert f.read() == data
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -19,20 +19,44 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import asyncio
 import contextlib
+import functools
+import os
+import queue
+import signal
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
-from pebble import ProcessPool
 import processing
 from processing import API, logs, audio_analysis, thermal, trail_analysis
+from processing import coordinator, metrics, pipeline
+from processing.api import NO_HINTS, conf_session, merge_hints, token_cache
+from processing.autoscale import Autoscaler
+from processing.cache import RecordingCache
+from processing.backoff import PollBackoff
+from processing.configwatch import ConfigWatcher, changed_options
+from processing.coordinator import CoordinatorClient
+from processing.costmodel import CostModel
+from processing.download import Downloader
+from processing.handoff import Handoffs
+from processing.journal import Journal
+from processing.quarantine import Quarantine
+from processing.timing import TimingLog
 from processing.processutils import HandleCalledProcessError
+from processing.workerpool import WorkerPool
 import subprocess
 import argparse
 
 SLEEP_SECS = 0.2
 POLL_ERROR_SLEEP_SECS = 5
+STATS_INTERVAL_SECS = 60 * 10
+# longest to block waiting for a job to finish before checking timers
+MAX_WAIT_SECS = 60
+# returned for polls that took longer than poll_timeout_secs
+TIMED_OUT = object()
 logger = logs.master_logger()
 
 
@@ -52,6 +76,11 @@ def parse_args():
         help='API server URL can be absolute URL or ("prod" for api.cacophony.org.nz or "test" for api-test.cacophony.org.nz or "ir" for api-ir.cacophony.org.nz) This will over ride whats in the config',
     )
 
+    parser.add_argument(
+        "--coordinator",
+        action="store_true",
+        help="Claim jobs for the processing hosts using the coordinator in the config instead of processing them",
+    )
     parser.add_argument(
         "--sleep",
         default=None,
@@ -102,7 +131,8 @@ def is_docker_running(config):
 def main():
     start_time = time.time()
     args = parse_args()
-    conf = processing.Config.load(args.config_file)
+    watcher = ConfigWatcher(args.config_file)
+    conf = processing.Config.load(watcher.filename)
 
     if args.api is not None:
         conf.api_credentials.api_url = args.api
@@ -113,32 +143,88 @@ def main():
 
     Processor.conf = conf
     Processor.log_q = logs.init_master()
-    Processor.api = API(conf.api_url, conf.user, conf.password, logger)
+    os.makedirs(conf.temp_dir, exist_ok=True)
+    Processor.api = API(
+        conf.api_url,
+        conf.user,
+        conf.password,
+        logger,
+        token_cache(conf),
+        conf_session(conf),
+        conf.post_workers,
+    )
+    Processor.api.downloader = Downloader(
+        Processor.api.session, conf.download_connections, conf.download_part_mb
+    )
+    Processor.api.refresh_in_background()
+    if args.coordinator:
+        coordinator.run(Processor.api, conf)
+        return
+    if conf.recording_cache_mb:
+        Processor.api.cache = RecordingCache(
+            conf.recording_cache_dir or os.path.join(conf.temp_dir, "cache"),
+            conf.recording_cache_mb,
+        )
+    Processor.claimer = Processor.api
+    Processor.poller = ThreadPoolExecutor(thread_name_prefix="poll")
+    if conf.coordinator is not None:
+        Processor.coordinator = CoordinatorClient(
+            conf.coordinator,
+            max_duration=conf.coordinator_max_duration,
+            secret=conf.coordinator_secret,
+        )
+        Processor.coordinator.start()
+        Processor.claimer = Processor.coordinator
+    # with autoscaling the pool starts its largest number of workers, and
+    # only how many of them are used changes
+    Processor.pool = WorkerPool(
+        conf.max_workers,
+        Processor.log_q,
+        conf.worker_max_tasks,
+        conf.autoscale_max_workers,
+    )
+    Processor.quarantine = Quarantine(
+        conf.quarantine_file,
+        conf.quarantine_max_failures,
+        conf.quarantine_backoff_secs,
+        conf.quarantine_expiry_hours * 60 * 60,
+    )
+    if conf.journal_file is not None:
+        Processor.journal = Journal(conf.journal_file)
+    handoffs = None
+    if conf.handoff_secs and (
+        (conf.thermal_tracking_workers > 0 and conf.thermal_analyse_workers > 0)
+        or (conf.ir_tracking_workers > 0 and conf.ir_analyse_workers > 0)
+    ):
+        handoffs = Handoffs(os.path.join(conf.temp_dir, "handoff"), conf.handoff_secs)
+    Processor.pipeline = pipeline.Pipeline(
+        Processor.api, Processor.pool, conf, Processor.journal, handoffs
+    )
+    Processor.costs = CostModel(conf.memory_budget_mb)
+    if conf.timing_log is not None:
+        Processor.timing_log = TimingLog(conf.timing_log)
     logger.info("Sleep seconds set to %s", SLEEP_SECS)
 
     processors = Processors()
     processors.add(
         "audio",
         ["FINISHED"],
-        audio_analysis.track_analyse,
-        conf.audio_analysis_workers,
-        conf.no_job_sleep_seconds,
+        audio_analysis.TRACK_ANALYSIS,
+        "audio_analysis_workers",
     )
     processors.add(
         "audio",
         ["analyse", "reprocess"],
-        audio_analysis.process,
-        conf.audio_analysis_workers,
-        conf.no_job_sleep_seconds,
+        audio_analysis.ANALYSIS,
+        "audio_analysis_workers",
     )
 
     if conf.ir_tracking_workers > 0:
         processors.add(
             "irRaw",
             ["tracking", "retrack"],
-            thermal.tracking_job,
-            conf.ir_tracking_workers,
-            conf.no_job_sleep_seconds,
+            thermal.TRACKING,
+            "ir_tracking_workers",
         )
     tracking_states = ["tracking"]
 
@@ -152,27 +238,24 @@ def main():
         processors.add(
             "irRaw",
             ["analyse", "reprocess"],
-            thermal.classify_job,
-            conf.ir_analyse_workers,
-            conf.no_job_sleep_seconds,
+            thermal.CLASSIFY,
+            "ir_analyse_workers",
         )
     thermal_tracking = None
     if conf.thermal_tracking_workers > 0:
         processors.add(
             "thermalRaw",
             tracking_states,
-            thermal.tracking_job,
-            conf.thermal_tracking_workers,
-            conf.no_job_sleep_seconds,
+            thermal.TRACKING,
+            "thermal_tracking_workers",
         )
         thermal_tracking = processors[-1]
     if conf.thermal_analyse_workers > 0:
         processors.add(
             "thermalRaw",
             ["analyse", "reprocess"],
-            thermal.classify_job,
-            conf.thermal_analyse_workers,
-            conf.no_job_sleep_seconds,
+            thermal.CLASSIFY,
+            "thermal_analyse_workers",
         )
         if thermal_tracking is not None:
             pre_jobs[processors[-1].id] = thermal_tracking
@@ -181,22 +264,66 @@ def main():
         processors.add(
             "thermalRaw",
             ["trackAndAnalyse"],
-            thermal.track_classify_job,
-            conf.thermal_track_analyse_workers,
-            conf.no_job_sleep_seconds,
+            thermal.TRACK_CLASSIFY,
+            "thermal_track_analyse_workers",
         )
 
     if conf.trail_workers > 0:
         processors.add(
             "trailcam-image",
             ["analyse"],
-            trail_analysis.analyse_image,
-            conf.trail_workers,
-            conf.no_job_sleep_seconds,
+            trail_analysis.ANALYSIS,
+            "trail_workers",
         )
+    Processor.autoscaler = make_autoscaler(conf)
+    if Processor.autoscaler is not None:
+        Processor.pool.max_workers = Processor.autoscaler.clamp(
+            conf.max_workers or sum(Processor.pool.quotas.values())
+        )
+    Processor.pool.start()
+    logger.info(
+        "Sharing %s workers between %s processors",
+        Processor.pool.max_workers,
+        len(processors),
+    )
+    if Processor.journal is not None:
+        processors.resume(Processor.journal)
+    if conf.metrics_port is not None:
+        metrics.serve(conf.metrics_port, conf.metrics_address)
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGHUP, functools.partial(request_reload, watcher))
     logger.info("checking for recordings")
 
+    last_stats = time.time()
     while True:
+        if watcher.changed():
+            try:
+                new_conf = watcher.load(Processor.conf)
+            except Exception:
+                logger.error(
+                    "Failed to reload config, keeping the old one", exc_info=True
+                )
+            else:
+                logger.info(
+                    "Reloaded config, changed %s",
+                    changed_options(Processor.conf, new_conf),
+                )
+                processors.reconfigure(new_conf)
+                conf = new_conf
+
+        if time.time() - last_stats > STATS_INTERVAL_SECS:
+            for processor in processors:
+                processor.log_stats()
+            cache = Processor.api.cache
+            if cache is not None and cache.hit_rate() is not None:
+                logger.info(
+                    "Recording cache hit %.0f%% of %s lookups, %.1f MB cached",
+                    cache.hit_rate() * 100,
+                    cache.hits + cache.misses,
+                    cache.size / 1024**2,
+                )
+            last_stats = time.time()
+
         success = False
         try:
             for processor in processors:
@@ -213,8 +340,8 @@ def main():
                             processor.processing_states,
                         )
                         processor.force_poll()
-                processor.poll()
-                success = True
+            processors.poll_all()
+            success = True
         except requests.exceptions.RequestException as e:
             logger.error(
                 "Request Exception, make sure api user is a super user for api\n%s",
@@ -233,29 +360,63 @@ def main():
             time.sleep(POLL_ERROR_SLEEP_SECS)
             continue
 
-        procesing_ids = []
-        [procesing_ids.extend(processor.in_progress.keys()) for processor in processors]
+        if Processor.draining and all(
+            processor.has_no_work() for processor in processors
+        ):
+            logger.info("Finished draining jobs, exiting")
+            return
+        if (
+            conf.restart_after is not None
+            and (time.time() - start_time) > conf.restart_after
+        ):
+            logger.info(
+                "Recycling workers as have been running for %s hours",
+                round((time.time() - start_time) / 3600, 1),
+            )
+            Processor.pool.recycle()
+            Processor.api.login(use_cache=False)
+            start_time = time.time()
+
+        processors.autoscale()
+        if Processor.coordinator is not None:
+            processors.drop(Processor.coordinator.take_lost())
+        processors.update_metrics()
+        processors.wait(processors.next_poll_in())
 
-        done_sleep = False
-        if all(processor.has_no_work() for processor in processors):
-            if (
-                conf.restart_after is not None
-                and (time.time() - start_time) > conf.restart_after
-            ):
-                logger.info(
-                    "Restarting as have been running for %s hours",
-                    round((time.time() - start_time) / 3600, 1),
-                )
-                time.sleep(1)
-                return
 
-            if all(not processor.should_poll() for processor in processors):
-                logger.info("Nothing to process - extending wait time")
-                time.sleep(conf.no_recordings_wait_secs)
-                done_sleep = True
-        if not done_sleep:
-            if SLEEP_SECS > 0:
-                time.sleep(SLEEP_SECS)
+def drain(signum, frame):
+    """Stop claiming jobs and exit once the running ones have finished"""
+    logger.info("Draining, will exit once running jobs are finished")
+    Processor.draining = True
+    # wake the main loop so it notices straight away
+    Processor.completed.put(None)
+
+
+def request_reload(watcher, signum, frame):
+    logger.info("Reloading config")
+    watcher.request()
+    Processor.completed.put(None)
+
+
+def make_autoscaler(conf):
+    if conf.autoscale_max_workers is None:
+        return None
+    autoscaler = Processor.autoscaler
+    if autoscaler is None:
+        autoscaler = Autoscaler(
+            conf.autoscale_min_workers,
+            conf.autoscale_max_workers,
+            conf.autoscale_interval_secs,
+            conf.memory_reserve_mb,
+        )
+    else:
+        autoscaler.min_workers = conf.autoscale_min_workers
+        autoscaler.max_workers = max(
+            conf.autoscale_max_workers, conf.autoscale_min_workers
+        )
+        autoscaler.interval = conf.autoscale_interval_secs
+        autoscaler.memory_reserve_mb = conf.memory_reserve_mb
+    return autoscaler
 
 
 class Processors(list):
@@ -263,21 +424,270 @@ class Processors(list):
         self,
         recording_type,
         processing_states,
-        process_func,
-        num_workers,
-        no_job_sleep_seconds,
+        stages,
+        workers_option,
     ):
-        if num_workers < 1:
+        if getattr(Processor.conf, workers_option) < 1:
             return
-        p = Processor(
-            recording_type,
-            processing_states,
-            process_func,
-            num_workers,
-            no_job_sleep_seconds,
-        )
+        p = Processor(recording_type, processing_states, stages, workers_option)
         self.append(p)
 
+    def reconfigure(self, conf):
+        """Apply a reloaded config, running jobs carry on with the old one"""
+        Processor.conf = conf
+        for processor in self:
+            processor.reconfigure(conf)
+        Processor.pool.max_tasks = conf.worker_max_tasks
+        Processor.quarantine.max_failures = conf.quarantine_max_failures
+        Processor.quarantine.backoff_secs = conf.quarantine_backoff_secs
+        Processor.quarantine.expiry_secs = conf.quarantine_expiry_hours * 60 * 60
+        if Processor.api.cache is not None and conf.recording_cache_mb:
+            Processor.api.cache.resize(conf.recording_cache_mb)
+        if Processor.pipeline.handoffs is not None and conf.handoff_secs:
+            Processor.pipeline.handoffs.expiry_secs = conf.handoff_secs
+        Processor.autoscaler = make_autoscaler(conf)
+        if Processor.autoscaler is not None:
+            size = Processor.autoscaler.clamp(Processor.pool.max_workers)
+        else:
+            size = conf.max_workers
+        if Processor.pool.resize(size):
+            logger.info("Resized worker pool to %s", Processor.pool.max_workers)
+        for processor in self:
+            processor.start_ready()
+
+    def poll_all(self):
+        """Poll for every processor with free capacity in a single request,
+        falling back to polling every processor concurrently if the server
+        can't."""
+        for processor in self:
+            processor.reap_completed()
+        self.schedule_late_polls()
+        # least served processors, relative to their quota, get workers first
+        by_usage = sorted(
+            self, key=lambda processor: Processor.pool.usage(processor.id)
+        )
+        pollable = [processor for processor in by_usage if processor.should_poll()]
+        if len(pollable) == 0:
+            return
+
+        wanted = []
+        pending = 0
+        for processor in list(pollable):
+            limit = processor.claim_limit(pending)
+            if limit < 1:
+                # workers already promised to processors ahead of this one
+                pollable.remove(processor)
+                continue
+            pending += limit
+            wanted.append(
+                {
+                    "type": processor.recording_type,
+                    "states": processor.processing_states,
+                    "limit": limit,
+                }
+            )
+        if len(pollable) == 0:
+            return
+        asyncio.run(self.claim(pollable, wanted))
+
+    async def claim(self, pollable, wanted):
+        """Claim jobs for all of pollable, waiting at most poll_timeout_secs
+        for each request. If the server can't take a single request for all of
+        them each processor polls on its own, and its jobs are scheduled as
+        soon as they arrive so a slow poll doesn't hold up the others."""
+        poll_start = time.time()
+        polled = await self.in_thread(
+            pollable, None, Processor.claimer.poll_jobs, wanted
+        )
+        jobs, hints = (None, NO_HINTS) if polled is TIMED_OUT else polled
+        if polled is TIMED_OUT or jobs is not None:
+            found = {}
+            if jobs is not None:
+                found = self.schedule_polled(jobs)
+            claim_secs = (time.time() - poll_start) / len(pollable)
+            for processor in pollable:
+                processor.polled(
+                    poll_start, claim_secs, found.get(processor.id, 0), hints
+                )
+            return
+
+        errors = await asyncio.gather(
+            *(
+                self.poll_one(processor, w["limit"])
+                for processor, w in zip(pollable, wanted)
+            ),
+            return_exceptions=True,
+        )
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise errors[0]
+
+    async def poll_one(self, processor, limit):
+        poll_start = time.time()
+        polled = await self.in_thread([processor], processor, processor.claim, limit)
+        claimed, hints = ([], NO_HINTS) if polled is TIMED_OUT else polled
+        # quarantined jobs don't count as found, so polling still backs off
+        found = sum(processor.schedule(response, state) for response, state in claimed)
+        processor.polled(poll_start, time.time() - poll_start, found, hints)
+
+    async def in_thread(self, polling, processor, func, *args):
+        """Run a poll on a poll thread. processor is who gets the jobs, or None
+        if they come from a multiplexed poll for all of polling."""
+        future = Processor.poller.submit(func, *args)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future), Processor.conf.poll_timeout_secs
+            )
+        except asyncio.TimeoutError:
+            # the request can't be stopped, so whatever it claims is scheduled
+            # from the main loop once it returns. Until then these processors
+            # aren't polled again so they don't claim more than they can run
+            for waiting in polling:
+                waiting.late_poll = True
+            future.add_done_callback(
+                functools.partial(self.poll_returned, polling, processor)
+            )
+            logger.warning(
+                "Polling for %s timed out, will take its jobs when it returns",
+                ", ".join(
+                    f"{waiting.recording_type}.{waiting.processing_states}"
+                    for waiting in polling
+                ),
+            )
+            return TIMED_OUT
+
+    def poll_returned(self, polling, processor, future):
+        Processor.late_polls.put((polling, processor, future))
+        Processor.completed.put(None)
+
+    def schedule_late_polls(self):
+        with contextlib.suppress(queue.Empty):
+            while True:
+                polling, processor, future = Processor.late_polls.get_nowait()
+                for waiting in polling:
+                    waiting.late_poll = False
+                if future.cancelled():
+                    continue
+                if future.exception() is not None:
+                    logger.error("Late poll failed: %s", future.exception())
+                    continue
+                # the hints are out of date by now
+                result, _ = future.result()
+                if result is None:
+                    continue
+                if processor is None:
+                    self.schedule_polled(result)
+                else:
+                    for response, state in result:
+                        processor.schedule(response, state)
+
+    def schedule_polled(self, jobs):
+        """Schedule jobs from a multiplexed poll, returning how many each
+        processor accepted"""
+        found = {}
+        for response in jobs:
+            recording = response["recording"]
+            state = recording.get("processingState")
+            processor = self.route(recording.get("type"), state)
+            if processor is None:
+                logger.error(
+                    "No processor for recording %s (%s: %s)",
+                    recording.get("id"),
+                    recording.get("type"),
+                    state,
+                )
+                continue
+            if processor.schedule(response, state):
+                found[processor.id] = found.get(processor.id, 0) + 1
+        return found
+
+    def next_poll_in(self):
+        """Seconds until a processor is due to poll again"""
+        waits = [
+            wait
+            for wait in (processor.next_poll_in() for processor in self)
+            if wait is not None
+        ]
+        if len(waits) == 0:
+            # everything is busy, only a job finishing will free a slot
+            return MAX_WAIT_SECS
+        wait = min(waits)
+        if wait > 0 and all(processor.has_no_work() for processor in self):
+            logger.info("Nothing to process - extending wait time")
+            wait = max(wait, Processor.conf.no_recordings_wait_secs)
+        return max(wait, SLEEP_SECS)
+
+    def wait(self, timeout):
+        """Block until a job finishes or timeout expires, then reap finished jobs"""
+        try:
+            Processor.completed.get(timeout=timeout)
+        except queue.Empty:
+            return
+        # several jobs may have finished together
+        with contextlib.suppress(queue.Empty):
+            while True:
+                Processor.completed.get_nowait()
+        for processor in self:
+            processor.reap_completed()
+
+    def autoscale(self):
+        if Processor.autoscaler is None:
+            return
+        resized = Processor.autoscaler.update(
+            Processor.pool,
+            sum(processor.ready() for processor in self),
+            sum(processor.claim_requests for processor in self),
+            sum(processor.found_polls for processor in self),
+        )
+        if resized:
+            for processor in self:
+                processor.start_ready()
+
+    def update_metrics(self):
+        for processor in self:
+            processor.update_metrics()
+        metrics.WORKERS.set(Processor.pool.max_workers)
+        metrics.WORKERS_BUSY.set(Processor.pool.running())
+
+    def resume(self, journal):
+        for entry in journal.entries():
+            processor = self.route(entry.type, entry.state)
+            if processor is None:
+                logger.warning(
+                    "No processor to resume %s (%s: %s), forgetting it",
+                    entry.id,
+                    entry.type,
+                    entry.state,
+                )
+                journal.finished(entry.id)
+                continue
+            processor.resume(entry)
+        for processor in self:
+            processor.start_ready()
+
+    def drop(self, recording_ids):
+        """Stop jobs that have been handed to another host"""
+        for recording_id in recording_ids:
+            for processor in self:
+                job = processor.in_progress.get(recording_id)
+                if job is None:
+                    continue
+                logger.warning("Lost lease of %s, cancelling it", recording_id)
+                if job.future is None or job.future.cancel():
+                    if job.stage == pipeline.COMPUTE:
+                        processor.pool.finished(processor.id)
+                        processor.costs.finished(job.id)
+                    processor.finished(job, "cancelled")
+
+    def route(self, recording_type, state):
+        for processor in self:
+            if (
+                processor.recording_type == recording_type
+                and state in processor.processing_states
+            ):
+                return processor
+        return None
+
 
 PROCESS_ID = 1
 
@@ -286,34 +696,62 @@ class Processor:
     conf = None
     api = None
     log_q = None
+    pool = None
+    pipeline = None
+    costs = None
+    autoscaler = None
+    timing_log = None
+    journal = None
+    # where jobs are claimed from, the API or a coordinator
+    claimer = None
+    # polls run on threads so a slow one doesn't hold up the others
+    poller = None
+    # polls that returned after poll_timeout_secs, as (processor, future)
+    late_polls = queue.Queue()
+    coordinator = None
+    quarantine = None
+    draining = False
+    # (processor id, recording id) of jobs as they finish, or None to wake.
+    # SimpleQueue as signal handlers put to it, which Queue can deadlock on
+    completed = queue.SimpleQueue()
 
     def __init__(
         self,
         recording_type,
         processing_states,
-        process_func,
-        num_workers,
-        no_job_sleep_seconds,
+        stages,
+        workers_option,
     ):
         global PROCESS_ID
         self.id = PROCESS_ID
         PROCESS_ID += 1
         self.recording_type = recording_type
         self.processing_states = processing_states
-        self.process_func = process_func
-        self.num_workers = num_workers
-        self.no_job_sleep_seconds = no_job_sleep_seconds
-        self.pool = ProcessPool(
-            num_workers, initializer=logs.init_worker, initargs=(self.log_q,)
+        self.stages = stages
+        # config option holding the number of workers, so it can be reloaded
+        self.workers_option = workers_option
+        self.num_workers = getattr(self.conf, workers_option)
+        self.backoff = PollBackoff(
+            self.conf.no_job_sleep_seconds, self.conf.max_no_job_sleep_seconds
         )
+        self.pool.register(self.id, self.num_workers)
         self.in_progress = {}
 
         self.last_poll = None
         self.last_poll_success = None
+        # a poll that timed out and may still claim jobs for this processor
+        self.late_poll = False
         self.last_success = None
 
+        # time spent claiming jobs versus running them
+        self.claim_secs = 0
+        self.claim_requests = 0
+        self.found_polls = 0
+        self.jobs_claimed = 0
+        self.busy_secs = 0
+
     def full(self):
-        return len(self.in_progress) >= self.num_workers
+        return self.free_slots() == 0
 
     def has_no_work(self):
         return len(self.in_progress) == 0
@@ -322,96 +760,347 @@ class Processor:
         return len(self.in_progress) > 0
 
     def should_poll(self):
-        return not self.full() and (
-            self.last_poll_success
-            or self.last_poll is None
-            or (time.time() - self.last_poll) > self.no_job_sleep_seconds
+        return (
+            not self.draining
+            and not self.late_poll
+            and not self.full()
+            and time.time() >= self.backoff.next_poll
         )
 
+    def next_poll_in(self):
+        if self.full():
+            return None
+        return max(0, self.backoff.next_poll - time.time())
+
     def force_poll(self):
-        self.last_poll_success = True
+        self.backoff.reset()
+
+    def free_slots(self, pending=0):
+        # claim enough to keep downloads going ahead of the free workers
+        return max(
+            0,
+            self.pool.free_slots(self.id, pending)
+            + self.conf.prefetch_jobs
+            - self.waiting(),
+        )
 
-    def poll(self):
-        self.reap_completed()
-        if not self.should_poll():
-            return True
+    def claim_limit(self, pending=0):
+        return min(self.free_slots(pending), self.conf.max_claim_batch)
 
-        working = False
-        self.last_poll_success = False
+    def claim(self, limit):
+        """Claim up to limit jobs, in order of state priority, returning them
+        with the poll hints for all the states. Runs on a poll thread so only
+        makes requests, the jobs are scheduled by the caller"""
+        claimed = []
+        hints = NO_HINTS
         for state in self.processing_states:
-            self.last_poll = time.time()
-            response = self.api.next_job(self.recording_type, state)
-            self.last_poll_success = self.last_poll_success or response is not None
-            if not response:
-                continue
-            recording = response["recording"]
-            rawJWT = response["rawJWT"]
-            if recording.get("id", 0) in self.in_progress:
-                logger.info(
-                    "Recording %s (%s: %s) is already scheduled, cancelling %s",
-                    recording["id"],
-                    recording["type"],
-                    state,
-                    self.in_progress[recording["id"]],
-                )
+            if len(claimed) >= limit:
+                break
+            jobs, state_hints = self.api.next_jobs(
+                self.recording_type, state, limit - len(claimed)
+            )
+            claimed.extend((response, state) for response in jobs)
+            hints = merge_hints(hints, state_hints)
+        return claimed, hints
 
-                success = self.in_progress[recording["id"]][1].cancel()
-                logger.info(
-                    "Job cancelled with success? %s",
-                    success,
-                )
-                if not success:
-                    continue
+    def polled(self, poll_start, claim_secs, found, hints=NO_HINTS):
+        self.last_poll = poll_start
+        self.last_poll_success = found > 0
+        self.claim_secs += claim_secs
+        self.claim_requests += 1
+        if found > 0:
+            self.found_polls += 1
+        self.jobs_claimed += found
+        self.pool.set_backlog(self.id, found > 0 or self.waiting() > 0)
+        metrics.POLLS.inc(
+            type=self.recording_type,
+            states=",".join(self.processing_states),
+            result="found" if found > 0 else "empty",
+        )
+        delay = self.backoff.polled(
+            found > 0, hints.retry_after, hints.queue_depth, now=time.time()
+        )
+        if found == 0:
             logger.debug(
-                "scheduling %s (%s: %s)",
+                "No %s.%s jobs, polling again in %.1fs",
+                self.recording_type,
+                self.processing_states,
+                delay,
+            )
+
+    def schedule(self, response, state):
+        recording = response["recording"]
+        rawJWT = response["rawJWT"]
+        skip = self.quarantine.skip(recording.get("id"))
+        if skip is not None:
+            logger.warning(
+                "Skipping %s (%s: %s), %s",
+                recording.get("id"),
+                recording.get("type"),
+                state,
+                skip,
+            )
+            metrics.JOBS.inc(type=self.recording_type, state=state, result="skipped")
+            self.report_failed(recording.get("id"), recording.get("jobKey"))
+            self.release(recording.get("id"))
+            return False
+        if recording.get("id", 0) in self.in_progress:
+            existing = self.in_progress[recording["id"]]
+            logger.info(
+                "Recording %s (%s: %s) is already scheduled, cancelling %s",
                 recording["id"],
                 recording["type"],
                 state,
+                existing,
             )
-            future = self.pool.schedule(
-                self.process_func, (recording, rawJWT, self.conf)
+
+            success = existing.future is None or existing.future.cancel()
+            logger.info(
+                "Job cancelled with success? %s",
+                success,
             )
-            self.in_progress[recording["id"]] = (recording["jobKey"], future)
-            working = True
-            break
-        return working
+            if not success:
+                self.release(recording["id"])
+                return False
+            if existing.stage == pipeline.COMPUTE:
+                self.pool.finished(self.id)
+                self.costs.finished(existing.id)
+            self.pipeline.cleanup(existing)
+        logger.debug(
+            "scheduling %s (%s: %s)",
+            recording["id"],
+            recording["type"],
+            state,
+        )
+        job = pipeline.Job(recording, rawJWT, state)
+        metrics.JOBS_CLAIMED.inc(type=self.recording_type, state=state)
+        if self.journal is not None:
+            self.journal.claimed(job, self.recording_type)
+        self.in_progress[job.id] = job
+        self.start_stage(self.pipeline.download(job, self.stages, self.conf), job)
+        return True
+
+    def resume(self, entry):
+        """Pick up a job from the journal after a restart, from the last stage
+        it finished"""
+        job = pipeline.Job(
+            entry.recording, entry.raw_jwt, entry.state, started=entry.claimed
+        )
+        self.in_progress[job.id] = job
+        if entry.work_dir is not None and os.path.isdir(entry.work_dir):
+            job.work_dir = entry.work_dir
+            if entry.result is not None:
+                logger.info("Resuming upload of %s", job.id)
+                job.result = entry.result
+                self.start_stage(self.pipeline.upload(job, self.stages, self.conf), job)
+                return
+            if os.path.isfile(entry.recording.get("filename", "")):
+                logger.info("Resuming %s from its downloaded file", job.id)
+                job.set_stage(pipeline.READY)
+                return
+            # it was being streamed, so the file isn't there
+            self.pipeline.cleanup(job)
+        logger.info("Resuming %s, downloading again", job.id)
+        self.start_stage(self.pipeline.download(job, self.stages, self.conf), job)
+
+    def start_stage(self, future, job):
+        future.add_done_callback(functools.partial(self.job_done, job.id))
+
+    def waiting(self):
+        """Jobs claimed but not yet running in a worker"""
+        return sum(
+            1
+            for job in self.in_progress.values()
+            if job.stage in (pipeline.DOWNLOAD, pipeline.READY)
+        )
+
+    def ready(self):
+        """Jobs downloaded and waiting for a worker"""
+        return sum(
+            1 for job in self.in_progress.values() if job.stage == pipeline.READY
+        )
+
+    def start_ready(self):
+        ready = sorted(
+            (job for job in self.in_progress.values() if job.stage == pipeline.READY),
+            key=lambda job: self.costs.priority(job, self.stages.name),
+        )
+        for job in ready:
+            if self.pool.free_slots(self.id) < 1:
+                break
+            job.cost = self.costs.predict(self.stages.name, job.recording)
+            if not self.costs.admit(job.cost):
+                logger.debug(
+                    "Waiting for memory to run %s, needs %.0fMB",
+                    job.id,
+                    job.cost.memory_mb,
+                )
+                break
+            self.costs.started(job.id, job.cost)
+            self.stage_finished(job)
+            self.start_stage(
+                self.pipeline.compute(self.id, job, self.stages, self.conf), job
+            )
+
+    def reconfigure(self, conf):
+        num_workers = getattr(conf, self.workers_option)
+        if num_workers < 1:
+            logger.warning(
+                "%s.%s can't be disabled without a restart, keeping %s workers",
+                self.recording_type,
+                self.processing_states,
+                self.num_workers,
+            )
+        elif num_workers != self.num_workers:
+            logger.info(
+                "%s.%s workers changed from %s to %s",
+                self.recording_type,
+                self.processing_states,
+                self.num_workers,
+                num_workers,
+            )
+            self.num_workers = num_workers
+            self.pool.set_quota(self.id, num_workers)
+        self.backoff.base_delay = conf.no_job_sleep_seconds
+        self.backoff.max_delay = max(
+            conf.max_no_job_sleep_seconds, conf.no_job_sleep_seconds
+        )
+
+    def log_stats(self):
+        total = self.claim_secs + self.busy_secs
+        logger.info(
+            "%s.%s claimed %s jobs in %s requests, claim overhead %.1fs (%.1f%%) processing %.1fs",
+            self.recording_type,
+            self.processing_states,
+            self.jobs_claimed,
+            self.claim_requests,
+            self.claim_secs,
+            100 * self.claim_secs / total if total > 0 else 0,
+            self.busy_secs,
+        )
+
+    def job_done(self, recording_id, future):
+        Processor.completed.put((self.id, recording_id))
 
     def reap_completed(self):
-        for recording_id, job in list(self.in_progress.items()):
-            future = job[1]
-            err = None
+        for job in list(self.in_progress.values()):
+            if job.future is None or not job.future.done():
+                continue
+            if job.stage == pipeline.COMPUTE:
+                # free the worker straight away, uploading doesn't need it
+                self.pool.finished(self.id)
+                self.costs.finished(job.id)
+            self.stage_finished(job)
+
+            if job.future.cancelled():
+                logger.info("Job %s was cancelled", job.id)
+                self.finished(job, "cancelled")
+                continue
+            err = job.future.exception()
+            if err is not None:
+                self.failed(job, err)
+                continue
+
+            result = job.future.result()
+            job.future = None
+            if job.stage == pipeline.DOWNLOAD:
+                if result is None:
+                    # nothing more to do for this recording
+                    self.succeeded(job)
+                else:
+                    job.recording = result
+                    job.set_stage(pipeline.READY)
+                    if self.journal is not None:
+                        self.journal.downloaded(job)
+            elif job.stage == pipeline.COMPUTE:
+                job.result, memory_mb, durations = result
+                job.timings.update(durations)
+                if self.journal is not None:
+                    self.journal.computed(job)
+                self.costs.observe(
+                    self.stages.name,
+                    job.recording,
+                    time.time() - job.compute_started,
+                    memory_mb,
+                )
+                self.start_stage(self.pipeline.upload(job, self.stages, self.conf), job)
+            else:
+                self.succeeded(job)
+        self.start_ready()
+
+    def stage_finished(self, job):
+        metrics.STAGE_SECONDS.observe(
+            job.stage_finished(),
+            type=self.recording_type,
+            state=job.state,
+            stage=job.stage,
+        )
+
+    def update_metrics(self):
+        counts = {
+            (state, stage): 0
+            for state in self.processing_states
+            for stage in pipeline.STAGES
+        }
+        for job in self.in_progress.values():
+            key = (job.state, job.stage)
+            counts[key] = counts.get(key, 0) + 1
+        for (state, stage), count in counts.items():
+            metrics.IN_PROGRESS.set(
+                count, type=self.recording_type, state=state, stage=stage
+            )
+
+    def finished(self, job, result):
+        del self.in_progress[job.id]
+        self.pipeline.cleanup(job)
+        self.release(job.id)
+        if self.journal is not None:
+            self.journal.finished(job.id)
+        self.busy_secs += time.time() - job.started
+        metrics.JOBS.inc(type=self.recording_type, state=job.state, result=result)
+        metrics.JOB_SECONDS.observe(
+            time.time() - job.started, type=self.recording_type, state=job.state
+        )
+        if self.timing_log is not None:
             try:
-                err = future.exception(timeout=0)
-            except:
-                pass
-            # for debugging
-            if err is not None and not future.done():
-                logger.error("Have exception %s while future is not done", err)
-            if future.done() or err is not None:
-                if err is None:
-                    try:
-                        err = future.exception(timeout=0)
-                        self.last_success = time.time()
-                    except:
-                        pass
+                self.timing_log.write(job, self.recording_type, result)
+            except OSError:
+                logger.error("Could not write timings of %s", job.id, exc_info=True)
 
-                if future.cancelled():
-                    logger.info("Job %s was cancelled", recording_id)
-                if err:
-                    msg = f"{self.recording_type}.{self.processing_states} processing of {recording_id} failed: {err}"
-                    tb = getattr(err, "traceback", None)
-                    if tb:
-                        msg += f":\n{tb}"
-                    logger.error(msg)
-                    try:
-                        self.api.report_failed(recording_id, job[0])
-                    except:
-                        logger.error(
-                            "Could not set %s to failed state",
-                            recording_id,
-                            exc_info=True,
-                        )
-                del self.in_progress[recording_id]
+    def release(self, recording_id):
+        """Give up the coordinator's lease on a job this host isn't running.
+        A job still in progress keeps the lease until it finishes"""
+        if self.coordinator is None or recording_id in self.in_progress:
+            return
+        try:
+            self.coordinator.release(recording_id)
+        except Exception:
+            logger.error("Could not release lease of %s", recording_id, exc_info=True)
+
+    def succeeded(self, job):
+        self.finished(job, "succeeded")
+        self.quarantine.succeeded(job.id)
+        self.last_success = time.time()
+
+    def failed(self, job, err):
+        self.finished(job, "failed")
+        kind = self.quarantine.failed(job.id, err)
+        msg = f"{self.recording_type}.{self.processing_states} {job.stage} of {job.id} failed ({kind}): {err}"
+        tb = getattr(err, "traceback", None)
+        if tb:
+            msg += f":\n{tb}"
+        logger.error(msg)
+        self.report_failed(job.id, job.job_key)
+
+    def report_failed(self, recording_id, job_key):
+        try:
+            self.api.report_failed(recording_id, job_key)
+        except:
+            logger.error(
+                "Could not set %s to failed state",
+                recording_id,
+                exc_info=True,
+            )
 
 
 if __name__ == "__main__":
@@ -17,21 +17,287 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import contextvars
 import json
 import os
+import re
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from requests_toolbelt.multipart.encoder import MultipartEncoder
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
 import hashlib
 import jwt
+import threading
 import time
 from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+from .cache import HASH_FIELD, SIZE_FIELD
+from . import journal
+from . import stream
+from .download import Downloader
+from . import metrics
+from .timing import timed, with_timings
 
-DL_TIMEOUT = 60 * 5
 TIMEOUT = 60
 
+# status codes meaning the server has no batch claim endpoint
+BATCH_UNSUPPORTED = (404, 405, 501)
+# status codes the server uses to ask pollers to back off
+THROTTLED = (429, 503)
+QUEUE_DEPTH_HEADER = "X-Queue-Depth"
+TOKEN_CACHE_FILENAME = "token.json"
+# track tags and archives posted at once when posting results singly
+POST_WORKERS = 4
+# server errors worth retrying, 429 and 503 are left to the poll back off
+RETRY_STATUS = (500, 502, 504)
+# refresh the token this long before it expires
+REFRESH_SECS = 5 * 60
+# and wait at least this long between refreshes, or after one failed
+MIN_REFRESH_SECS = 30
+
+PollHints = namedtuple("PollHints", ["retry_after", "queue_depth"])
+NO_HINTS = PollHints(None, None)
+
+
+def parse_poll_hints(response):
+    """Read the Retry-After (seconds or HTTP date) and queue depth headers"""
+    retry_after = None
+    queue_depth = None
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            retry_after = max(0, float(value))
+        except ValueError:
+            try:
+                retry_after = max(
+                    0, parsedate_to_datetime(value).timestamp() - time.time()
+                )
+            except (TypeError, ValueError):
+                pass
+    value = headers.get(QUEUE_DEPTH_HEADER)
+    if value:
+        try:
+            queue_depth = int(value)
+        except ValueError:
+            pass
+    return PollHints(retry_after, queue_depth)
+
+
+def merge_hints(a, b):
+    """Hints for polls of several states, waiting for the longest Retry-After
+    with the queue depths added up"""
+    retry_after = [
+        hints.retry_after for hints in (a, b) if hints.retry_after is not None
+    ]
+    queue_depth = [
+        hints.queue_depth for hints in (a, b) if hints.queue_depth is not None
+    ]
+    return PollHints(
+        max(retry_after) if retry_after else None,
+        sum(queue_depth) if queue_depth else None,
+    )
+
+
+class TokenCache:
+    """Tokens shared between processes through a small file, so a new API
+    client can use a valid token rather than authenticating again"""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def get(self, key):
+        """The (token, expiry) cached for key, or None"""
+        try:
+            with open(self.filename) as f:
+                cached = json.load(f).get(key)
+        except (OSError, ValueError):
+            return None
+        if cached is None:
+            return None
+        return cached["token"], cached["expiry"]
+
+    def put(self, key, token, expiry):
+        tokens = {}
+        try:
+            with open(self.filename) as f:
+                tokens = json.load(f)
+        except (OSError, ValueError):
+            pass
+        tokens[key] = {"token": token, "expiry": expiry}
+        # written to a private file and swapped in so readers never see half
+        # a file or someone else's
+        partial = f"{self.filename}.{os.getpid()}"
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(tokens, f)
+        os.replace(partial, self.filename)
+
+
+def token_cache(conf):
+    return TokenCache(
+        conf.token_cache_file or os.path.join(conf.temp_dir, TOKEN_CACHE_FILENAME)
+    )
+
+
+def make_session(pool_size=10, retries=3, backoff_factor=0.5):
+    """A session keeping up to pool_size connections alive per host, which
+    retries connection errors and server errors with exponential back off.
+
+    Only idempotent requests are retried on server errors, a POST that
+    reached the server isn't sent again.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS,
+        raise_on_status=False,
+        # a Retry-After is for the poll back off, not to wait for here
+        respect_retry_after_header=False,
+    )
+    adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def conf_session(conf):
+    pool_size = conf.http_pool_size
+    if pool_size is None:
+        # enough for every download, upload, post and poll thread
+        pool_size = conf.download_workers + conf.upload_workers + conf.post_workers + 4
+    return make_session(pool_size, conf.http_retries, conf.http_backoff_factor)
+
+
+def track_tag_data(prediction, data=""):
+    return {
+        "what": prediction.tag,
+        "confidence": prediction.confidence,
+        "data": json.dumps(data),
+    }
+
+
+class ResultsError(IOError):
+    """Some of a recording's results couldn't be posted, errors has why"""
+
+    def __init__(self, errors):
+        super().__init__(
+            f"{len(errors)} result posts failed, first error: {errors[0]!r}"
+        )
+        self.errors = errors
+
+
+class PendingTrack:
+    """A track added to Results, which has an id once they are submitted"""
+
+    def __init__(self, track, algorithm_id):
+        self.track = track
+        self.algorithm_id = algorithm_id
+        self.data = track.post_data()
+        self.tags = []
+        self.id = None
+
+    def resolve(self, track_id):
+        self.id = track_id
+        self.track.id = track_id
+
+
+class Results:
+    """Track, track tag and archive writes for a recording, collected so
+    API.submit_results can send them together.
+
+    It has the same add_track, add_track_tag and archive_track methods as the
+    API, add_track returning a PendingTrack to tag the new track with. Tag data
+    is copied when it is added, so callers can reuse their dicts.
+    """
+
+    def __init__(self, recording):
+        self.recording = recording
+        self.tracks = []
+        # tags for tracks that already exist, as (track id, post data)
+        self.tags = []
+        self.archived = []
+
+    def add_track(self, recording, track, algorithm_id):
+        pending = PendingTrack(track, algorithm_id)
+        self.tracks.append(pending)
+        return pending
+
+    def add_track_tag(self, recording, track_id, prediction, data=""):
+        post_data = track_tag_data(prediction, data)
+        if isinstance(track_id, PendingTrack):
+            track_id.tags.append(post_data)
+        else:
+            self.tags.append((track_id, post_data))
+
+    def archive_track(self, recording, track_id):
+        self.archived.append(track_id)
+
+    def __len__(self):
+        return (
+            len(self.tracks)
+            + sum(len(pending.tags) for pending in self.tracks)
+            + len(self.tags)
+            + len(self.archived)
+        )
+
+
+def failures(futures):
+    wait(futures)
+    return [future.exception() for future in futures if future.exception()]
+
+
+_worker_api = None
+
+
+def worker_api(conf, logger):
+    """The API client for this worker process, created on first use and
+    reused by every job it runs"""
+    global _worker_api
+    if _worker_api is None or (_worker_api.api_url, _worker_api.user) != (
+        conf.api_url,
+        conf.user,
+    ):
+        _worker_api = API(
+            conf.api_url,
+            conf.user,
+            conf.password,
+            logger,
+            token_cache(conf),
+            conf_session(conf),
+            conf.post_workers,
+        )
+    _worker_api.logger = logger
+    return _worker_api
+
+
+def endpoint(url):
+    """URL path with ids replaced, so requests can be grouped by endpoint"""
+    return re.sub(r"/\d+(?=/|$)", "/:id", urlparse(url).path)
+
+
+def timed_request(request, url, args):
+    start = time.time()
+    status = "error"
+    try:
+        r = request(url, **args)
+        status = r.status_code
+        return r
+    finally:
+        metrics.API_SECONDS.observe(
+            time.time() - start,
+            method=request.__name__.upper(),
+            endpoint=endpoint(url),
+            status=status,
+        )
+
 
 def ensure_timeout(args):
     if "timeout" not in args:
@@ -39,13 +305,37 @@ def ensure_timeout(args):
 
 
 class API:
-    def __init__(self, api_url, user, password, logger):
+    def __init__(
+        self,
+        api_url,
+        user,
+        password,
+        logger,
+        token_cache=None,
+        session=None,
+        post_workers=POST_WORKERS,
+    ):
         self.file_url = urljoin(api_url, "api/v1/processing")
         self.api_url = api_url
         self.user = user
         self._password = password
         self.logger = logger
+        self.token_cache = token_cache
+        if session is None:
+            session = make_session()
+        self.session = session
+        self.downloader = Downloader(session)
+        self.post_workers = post_workers
+        # created up front as upload threads post at the same time, the
+        # threads start when first needed
+        self.writers = ThreadPoolExecutor(post_workers, thread_name_prefix="post")
         self._token = None
+        self._expiry = 0
+        self._batch_claim = True
+        self._multi_poll = True
+        self._bulk_results = True
+        # a RecordingCache shared by every job type, if one is configured
+        self.cache = None
         self.login()
 
     def ensure_valid_auth(self, args):
@@ -59,52 +349,61 @@ class API:
     def put(self, url, **args):
         self.ensure_valid_auth(args)
         ensure_timeout(args)
-        return self.retry_if_auth(requests.put, url, args)
+        return self.retry_if_auth(self.session.put, url, args)
 
     def post(self, url, **args):
         self.ensure_valid_auth(args)
         ensure_timeout(args)
 
-        return self.retry_if_auth(requests.post, url, args)
+        return self.retry_if_auth(self.session.post, url, args)
 
     def get(self, url, **args):
         self.ensure_valid_auth(args)
         ensure_timeout(args)
-        return self.retry_if_auth(requests.get, url, args)
+        return self.retry_if_auth(self.session.get, url, args)
 
     def delete(self, url, **args):
         self.ensure_valid_auth(args)
         ensure_timeout(args)
-        return self.retry_if_auth(requests.delete, url, args)
+        return self.retry_if_auth(self.session.delete, url, args)
 
     # helper code to retry auth error once
     def retry_if_auth(self, request, url, args):
         retries = 1
         count = 0
-        while count <= retries:
-            count += 1
+        while True:
             try:
-                r = None
-                r = request(url, **args)
+                r = timed_request(request, url, args)
                 r.raise_for_status()
                 return r
             except requests.exceptions.RequestException as e:
-                if e.response.status_code != 401 or count >= retries:
+                if (
+                    e.response is None
+                    or e.response.status_code != 401
+                    or count >= retries
+                ):
                     raise e
-                self.logger.warn(
+                count += 1
+                self.logger.warning(
                     "Request failed with 401 token should be valid until %s %s",
                     datetime.fromtimestamp(self._expiry),
-                    "trying to authenticate again" if count <= retries else "",
+                    "trying to authenticate again",
                 )
                 # hopefully just have failed JWT
-                self.login()
+                self.login(use_cache=False)
                 self.ensure_valid_auth(args)
 
     @property
     def auth_header(self):
         return {"Authorization": self._token}
 
-    def login(self):
+    @property
+    def token_key(self):
+        return f"{self.user}@{self.api_url}"
+
+    def login(self, use_cache=True):
+        if use_cache and self.cached_login():
+            return
         request_time = time.time()
         try:
             self._token = self._get_jwt()
@@ -128,10 +427,41 @@ class API:
                 "Error getting token expiry using 5 minute", exc_info=True
             )
             self._expiry = request_time + 5 * 60 - 30
+        if self.token_cache is not None and self._token is not None:
+            try:
+                self.token_cache.put(self.token_key, self._token, self._expiry)
+            except OSError:
+                self.logger.warning("Couldn't cache token", exc_info=True)
+
+    def cached_login(self):
+        """Use a token another process cached, returning whether there was
+        a valid one"""
+        if self.token_cache is None:
+            return False
+        cached = self.token_cache.get(self.token_key)
+        if cached is None or cached[1] < time.time():
+            return False
+        self._token, self._expiry = cached
+        return True
+
+    def refresh_in_background(self):
+        """Log in again before the token expires from a thread, so requests
+        never wait on a login"""
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    def refresh(self):
+        while True:
+            time.sleep(max(MIN_REFRESH_SECS, self._expiry - REFRESH_SECS - time.time()))
+            try:
+                self.login(use_cache=False)
+            except Exception:
+                self.logger.error("Failed to refresh token", exc_info=True)
 
     def _get_jwt(self):
         url = urljoin(self.api_url, "api/v1/users/authenticate")
-        r = requests.post(url, data={"email": self.user, "password": self._password})
+        r = self.session.post(
+            url, data={"email": self.user, "password": self._password}
+        )
         r.raise_for_status()
         return r.json().get("token")
 
@@ -146,14 +476,87 @@ class API:
         if self._expiry < time.time():
             self.login()
 
+    def _poll(self, request, url, **args):
+        """Make a job polling request, returning the response and any hints
+        the server gave on when to poll next. The response is None if the
+        server asked us to back off."""
+        try:
+            r = request(url, **args)
+        except requests.exceptions.HTTPError as e:
+            hints = parse_poll_hints(e.response)
+            if e.response.status_code in THROTTLED and hints.retry_after is not None:
+                return None, hints
+            raise e
+        return r, parse_poll_hints(r)
+
     def next_job(self, recording_type, state):
         params = {"type": recording_type, "state": state}
-        r = self.get(self.file_url, params=params)
-        if r.status_code == 204:
-            return None
+        r, hints = self._poll(self.get, self.file_url, params=params)
+        if r is None or r.status_code == 204:
+            return None, hints
         r.raise_for_status()
-        return r.json()
+        return r.json(), hints
+
+    def next_jobs(self, recording_type, state, max_jobs):
+        """Claim up to max_jobs jobs of recording_type in state, returning
+        them with the poll hints from the last request.
+
+        Uses the batch claim endpoint when the server has one, otherwise falls
+        back to claiming jobs one at a time via next_job.
+        """
+        if max_jobs < 1:
+            return [], NO_HINTS
+        if self._batch_claim:
+            params = {"type": recording_type, "state": state, "limit": max_jobs}
+            try:
+                r, hints = self._poll(self.get, self.file_url + "/batch", params=params)
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code not in BATCH_UNSUPPORTED:
+                    raise e
+                self.logger.info(
+                    "Server doesn't support batch claiming, claiming jobs singly"
+                )
+                self._batch_claim = False
+            else:
+                if r is None or r.status_code == 204:
+                    return [], hints
+                return r.json().get("jobs", [])[:max_jobs], hints
+
+        jobs = []
+        hints = NO_HINTS
+        while len(jobs) < max_jobs:
+            job, hints = self.next_job(recording_type, state)
+            if job is None:
+                break
+            jobs.append(job)
+        return jobs, hints
+
+    def poll_jobs(self, wanted):
+        """Claim jobs for several recording types and states in one request.
+
+        wanted is a list of {"type", "states", "limit"} dicts, states being in
+        priority order. Returns the claimed jobs and the poll hints, the jobs
+        being None if the server doesn't support multiplexed polling.
+        """
+        if not self._multi_poll:
+            return None, NO_HINTS
+        try:
+            r, hints = self._poll(
+                self.post, self.file_url + "/poll", json={"requests": wanted}
+            )
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code not in BATCH_UNSUPPORTED:
+                raise e
+            self.logger.info(
+                "Server doesn't support multiplexed polling, polling each type"
+            )
+            self._multi_poll = False
+            return None, NO_HINTS
+        if r is None or r.status_code == 204:
+            return [], hints
+        return r.json().get("jobs", []), hints
 
+    @timed
     def update_metadata(self, recording, fieldUpdates, completed):
         params = {
             "id": recording["id"],
@@ -179,6 +582,7 @@ class API:
     def report_done(self, recording, newKey=None, newMimeType=None, metadata=None):
         if not metadata:
             metadata = {}
+        with_timings(metadata)
         if newMimeType:
             metadata["fileMimeType"] = newMimeType
 
@@ -194,6 +598,7 @@ class API:
         r = self.put(self.file_url, data=params)
         r.raise_for_status()
 
+    @timed
     def tag_recording(self, recording, label, metadata):
         tag = metadata.copy()
         tag["automatic"] = True
@@ -213,6 +618,7 @@ class API:
 
         r.raise_for_status()
 
+    @timed
     def get_rat_threshold(self, deviceId, atTime=None):
         try:
             url = f"/ratthresh/{deviceId}"
@@ -224,6 +630,7 @@ class API:
         except:
             return None
 
+    @timed
     def get_algorithm_id(self, algorithm):
         url = self.file_url + "/algorithm"
         post_data = {"algorithm": json.dumps(algorithm)}
@@ -232,6 +639,7 @@ class API:
             return r.json()["algorithmId"]
         raise IOError(r.text)
 
+    @timed
     def archive_track(self, recording, track_id):
         url = self.file_url + "/{}/tracks/{}/archive".format(recording["id"], track_id)
         r = self.post(url)
@@ -239,6 +647,7 @@ class API:
             return
         raise IOError(r.text)
 
+    @timed
     def update_track_thumbnail(self, recording, track):
         url = self.file_url + "/{}/tracks/{}/thumbnailInfo".format(
             recording["id"], track.id
@@ -249,6 +658,7 @@ class API:
             return
         raise IOError(r.text)
 
+    @timed
     def update_track(self, recording, track):
         url = self.file_url + "/{}/tracks/{}".format(recording["id"], track.id)
         post_data = {"data": json.dumps(track.post_data())}
@@ -257,41 +667,179 @@ class API:
             return
         raise IOError(r.text)
 
+    @timed
     def add_track(self, recording, track, algorithm_id):
         url = self.file_url + "/{}/tracks".format(recording["id"])
         post_data = {"data": json.dumps(track.post_data()), "algorithmId": algorithm_id}
-        r = self.post(url, data=post_data)
-        if r.status_code == 200:
-            return r.json()["trackId"]
-        raise IOError(r.text)
+        return self.post_once(url, post_data, "trackId")
 
     def add_track_tag(self, recording, track_id, prediction, data=""):
+        return self.post_track_tag(
+            recording, track_id, track_tag_data(prediction, data)
+        )
+
+    @timed
+    def post_track_tag(self, recording, track_id, post_data):
         url = self.file_url + "/{}/tracks/{}/tags".format(recording["id"], track_id)
+        return self.post_once(url, post_data, "trackTagId")
+
+    @timed
+    def submit_results(self, results):
+        """Post the tracks, track tags and archives collected in results.
 
-        post_data = {
-            "what": prediction.tag,
-            "confidence": prediction.confidence,
-            "data": json.dumps(data),
+        They are sent in one request if the server supports it, otherwise one
+        request each, tracks first so their tags can use the new ids.
+        """
+        if len(results) == 0:
+            return
+        if not self._bulk_results:
+            self.post_results_singly(results)
+            return
+        try:
+            track_ids = self.post_results(results)
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code not in BATCH_UNSUPPORTED:
+                raise e
+            # a 404 can also mean the recording was deleted, which posting
+            # singly finds out too. If they succeed the endpoint is missing
+            if e.response.status_code != 404:
+                self.bulk_unsupported()
+            self.post_results_singly(results)
+            self.bulk_unsupported()
+            return
+        for pending, track_id in zip(results.tracks, track_ids):
+            pending.resolve(track_id)
+
+    def bulk_unsupported(self):
+        if self._bulk_results:
+            self.logger.info(
+                "Server doesn't support posting results together, posting singly"
+            )
+            self._bulk_results = False
+
+    def post_results(self, results):
+        recording = results.recording
+        url = self.file_url + "/{}/results".format(recording["id"])
+        payload = {
+            "tracks": [
+                {
+                    "data": pending.data,
+                    "algorithmId": pending.algorithm_id,
+                    "tags": pending.tags,
+                }
+                for pending in results.tracks
+            ],
+            "tags": [
+                dict(post_data, trackId=track_id)
+                for track_id, post_data in results.tags
+            ],
+            "archived": results.archived,
         }
+        return self.post_once(url, {"results": json.dumps(payload)}, "trackIds")
+
+    def post_results_singly(self, results):
+        """Post results one request each. Tracks are added in order, and each
+        track's tags are posted on the writer threads as soon as it has an id.
+        Archiving waits for every tag, so a track is never archived before it
+        is tagged. Everything that can be posted is, then a ResultsError is
+        raised if anything failed."""
+        recording = results.recording
+        posts = []
+        errors = []
+        for pending in results.tracks:
+            try:
+                pending.resolve(
+                    self.add_track(recording, pending.track, pending.algorithm_id)
+                )
+            except Exception as e:
+                errors.append(e)
+                continue
+            for post_data in pending.tags:
+                posts.append(
+                    self.post_later(
+                        self.post_track_tag, recording, pending.id, post_data
+                    )
+                )
+        for track_id, post_data in results.tags:
+            posts.append(
+                self.post_later(self.post_track_tag, recording, track_id, post_data)
+            )
+        errors.extend(failures(posts))
+        archives = [
+            self.post_later(self.archive_track, recording, track_id)
+            for track_id in results.archived
+        ]
+        errors.extend(failures(archives))
+        if errors:
+            raise ResultsError(errors)
+
+    def post_later(self, post, *args):
+        """Post from a writer thread, keeping this thread's timings and
+        journal"""
+        return self.writers.submit(contextvars.copy_context().run, post, *args)
+
+    def post_once(self, url, post_data, id_field):
+        """Post and return the new id, unless the same data was already posted
+        for this job before a restart, then return the id it was given"""
+        key = journal.post_key(
+            hashlib.sha1(
+                (url + json.dumps(post_data, sort_keys=True)).encode()
+            ).hexdigest()
+        )
+        posted_id = journal.already_posted(key)
+        if posted_id is not None:
+            return posted_id
         r = self.post(url, data=post_data)
         if r.status_code == 200:
-            return r.json()["trackTagId"]
+            posted_id = r.json()[id_field]
+            journal.record_posted(key, posted_id)
+            return posted_id
         raise IOError(r.text)
 
+    @timed
     def get_track_info(self, recording_id):
         r = self.get(self.api_url + "/api/v1/recordings/{}/tracks".format(recording_id))
         r.raise_for_status()
         return r.json()
 
-    def download_file(self, token, filename):
-        r = requests.get(
+    @timed
+    def download_file(self, token, filename, recording=None):
+        """Download the file token is for. Given the recording the file is
+        for, a cached copy is used if there is one, the download is checked
+        against the recording's hash and size and then cached"""
+        cached = self.cache is not None and recording is not None
+        if cached and self.cache.get(recording, filename):
+            return True
+        if self.stream_later(token, filename, recording):
+            return True
+        sha1 = self.fetch_file(token, filename, recording)
+        if cached:
+            self.cache.add(recording, filename, sha1)
+        return True
+
+    def stream_later(self, token, filename, recording):
+        """With streaming on, leave a pipe the command reads the download
+        from as it arrives"""
+        if not stream.deferrable(filename):
+            return False
+        return stream.defer(
+            self,
             urljoin(self.api_url, "/api/v1/signedUrl"),
-            params={"jwt": token},
-            stream=True,
-            timeout=DL_TIMEOUT,
+            {"jwt": token},
+            filename,
+            recording,
+        )
+
+    def fetch_file(self, token, filename, recording=None):
+        """Download the file token is for, returning its sha1"""
+        recording = recording or {}
+        return self.downloader.download(
+            urljoin(self.api_url, "/api/v1/signedUrl"),
+            filename,
+            {"jwt": token},
+            sha1=recording.get(HASH_FIELD),
+            size=recording.get(SIZE_FIELD),
         )
-        r.raise_for_status()
-        return iter_to_file(filename, r.iter_content(chunk_size=4096))
 
 
 def iter_to_file(filename, source, overwrite=True):
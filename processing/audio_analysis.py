@@ -23,11 +23,13 @@ import subprocess
 import tempfile
 from pathlib import Path
 
-from . import API
 from . import logs
+from .api import Results
 from .processutils import HandleCalledProcessError
 from .tagger import UNIDENTIFIED
 from .thermal import Prediction
+from .pipeline import JobStages
+from .timing import stage
 
 MAX_FRQUENCY = 48000 / 2
 
@@ -45,83 +47,79 @@ def track_analyse(recording, jwtKey, conf):
     Returns:
         The API response.
     """
-
-    # this used to work by default then  just stopped, so will explicitly add it
-    mimetypes.add_type("audio/mp4", ".m4a")
-
-    logger = logs.worker_logger("audio.track_analysis", recording["id"])
-
-    api = API(conf.api_url, conf.user, conf.password, logger)
-
-    input_extension = mimetypes.guess_extension(recording["rawMimeType"])
-
-    if not input_extension:
-        # Unsupported mimetype. If needed more mimetypes can be added above.
-        logger.error(
-            "unsupported mimetype. Not processing %s", recording["rawMimeType"]
-        )
-        api.report_done(recording, recording["rawFileKey"], recording["rawMimeType"])
-        return
+    TRACK_ANALYSIS.run(recording, jwtKey, conf)
+
+
+def download_track_analysis(api, recording, jwtKey, conf, work_dir, logger):
+    input_filename = download_audio(api, recording, jwtKey, work_dir, logger)
+    if input_filename is None:
+        return None
+    track_info = api.get_track_info(recording["id"]).get("tracks")
+    track_info = [
+        t for t in track_info if not any(tag for tag in t["tags"] if tag["automatic"])
+    ]
+    recording["Tracks"] = track_info
+    filename = input_filename.with_suffix(".txt")
+    if "location" in recording:
+        location = recording["location"]
+        if (
+            "lat" not in location
+            and "lng" not in location
+            and "coordinates" in location
+        ):
+            coords = location["coordinates"]
+            location["lng"] = coords[0]
+            location["lat"] = coords[1]
+    with filename.open("w") as f:
+        json.dump(recording, f)
+    return recording
+
+
+def run_track_analysis(recording, conf):
+    return analyse(Path(recording["filename"]), conf, analyse_tracks=True)
+
+
+def upload_track_analysis(api, recording, metadata, conf, logger):
     new_metadata = {"additionalMetadata": {}}
-    with tempfile.TemporaryDirectory() as temp:
-        temp_path = Path(temp)
-        input_filename = temp_path / ("recording" + input_extension)
-        logger.debug("downloading recording to %s", input_filename)
-
-        api.download_file(jwtKey, str(input_filename))
-        track_info = api.get_track_info(recording["id"]).get("tracks")
-        track_info = [
-            t
-            for t in track_info
-            if not any(tag for tag in t["tags"] if tag["automatic"])
-        ]
-        recording["Tracks"] = track_info
-        filename = input_filename.with_suffix(".txt")
-        if "location" in recording:
-            location = recording["location"]
-            if (
-                "lat" not in location
-                and "lng" not in location
-                and "coordinates" in location
-            ):
-                coords = location["coordinates"]
-                location["lng"] = coords[0]
-                location["lat"] = coords[1]
-        with filename.open("w") as f:
-            json.dump(recording, f)
-
-        metadata = analyse(input_filename, conf, analyse_tracks=True)
-        analysis = AudioResult.load(metadata, metadata.get("duration"))
-        algorithm_meta = {"algorithm": "sliding_window"}
-        if analysis.species_identify_version is not None:
-            algorithm_meta["version"] = analysis.species_identify_version
-        algorithm_id = api.get_algorithm_id(algorithm_meta)
-        data = {"algorithm": algorithm_id}
-
-        for track in analysis.tracks:
-            # master_tag = get_master_tag(analysis, track, logger)
-            if track.master_tag is not None:
-                data["name"] = "Master"
-                api.add_track_tag(recording, track.id, track.master_tag, data)
-            else:
-                data["name"] = "Master"
-                unid = Prediction(UNIDENTIFIED)
-                api.add_track_tag(recording, track.id, unid, data)
-            for i, prediction in enumerate(track.predictions):
-                data["name"] = prediction.model_name
-                api.add_track_tag(recording, track.id, prediction, data)
+    analysis = AudioResult.load(metadata, metadata.get("duration"))
+    algorithm_meta = {"algorithm": "sliding_window"}
+    if analysis.species_identify_version is not None:
+        algorithm_meta["version"] = analysis.species_identify_version
+    algorithm_id = api.get_algorithm_id(algorithm_meta)
+    data = {"algorithm": algorithm_id}
+
+    results = Results(recording)
+    for track in analysis.tracks:
+        # master_tag = get_master_tag(analysis, track, logger)
+        if track.master_tag is not None:
+            data["name"] = "Master"
+            results.add_track_tag(recording, track.id, track.master_tag, data)
+        else:
+            data["name"] = "Master"
+            unid = Prediction(UNIDENTIFIED)
+            results.add_track_tag(recording, track.id, unid, data)
+        for i, prediction in enumerate(track.predictions):
+            data["name"] = prediction.model_name
+            results.add_track_tag(recording, track.id, prediction, data)
+    api.submit_results(results)
 
     api.report_done(recording, metadata=new_metadata)
     logger.info("Completed classifying for file: %s", recording["id"])
 
 
+TRACK_ANALYSIS = JobStages(
+    "audio.track_analysis",
+    download_track_analysis,
+    run_track_analysis,
+    upload_track_analysis,
+)
+
+
 SPECIFIC_NOISE = ["insect"]
 
 
 def process(recording, jwtKey, conf):
-    logger = logs.worker_logger("audio.analysis", recording["id"])
-    api = API(conf.api_url, conf.user, conf.password, logger)
-    return process_with_api(recording, jwtKey, api, conf, logger)
+    ANALYSIS.run(recording, jwtKey, conf)
 
 
 def process_with_api(recording, jwtKey, api, conf, logger=None):
@@ -138,11 +136,22 @@ def process_with_api(recording, jwtKey, api, conf, logger=None):
     Returns:
         The API response.
     """
+    if logger is None:
+        logger = logs.worker_logger("audio.analysis", recording["id"])
 
+    with tempfile.TemporaryDirectory() as temp:
+        recording = download_analysis(api, recording, jwtKey, conf, temp, logger)
+        if recording is None:
+            return
+        metadata = analyse(Path(recording["filename"]), conf)
+        upload_analysis(api, recording, metadata, conf, logger)
+
+
+def download_audio(api, recording, jwtKey, work_dir, logger):
+    """Download the recording to work_dir, or report it done and return None if
+    it isn't a type we can process"""
     # this used to work by default then  just stopped, so will explicitly add it
     mimetypes.add_type("audio/mp4", ".m4a")
-    if logger is None:
-        logger = logs.worker_logger("audio.analysis", recording["id"])
 
     input_extension = mimetypes.guess_extension(recording["rawMimeType"])
 
@@ -152,77 +161,94 @@ def process_with_api(recording, jwtKey, api, conf, logger=None):
             "unsupported mimetype. Not processing %s", recording["rawMimeType"]
         )
         api.report_done(recording, recording["rawFileKey"], recording["rawMimeType"])
-        return
-
+        return None
+
+    input_filename = Path(work_dir) / ("recording" + input_extension)
+    recording["filename"] = str(input_filename)
+    logger.debug("downloading recording to %s", input_filename)
+    api.download_file(jwtKey, str(input_filename), recording)
+    return input_filename
+
+
+def download_analysis(api, recording, jwtKey, conf, work_dir, logger):
+    input_filename = download_audio(api, recording, jwtKey, work_dir, logger)
+    if input_filename is None:
+        return None
+
+    filename = input_filename.with_suffix(".txt")
+    if "location" in recording:
+        location = recording["location"]
+        if (
+            location is not None
+            and "lat" not in location
+            and "lng" not in location
+            and "coordinates" in location
+        ):
+            coords = location["coordinates"]
+            location["lng"] = coords[0]
+            location["lat"] = coords[1]
+    if "tracks" in recording:
+        del recording["tracks"]
+    with filename.open("w") as f:
+        json.dump(recording, f)
+    return recording
+
+
+def run_analysis(recording, conf):
+    return analyse(Path(recording["filename"]), conf)
+
+
+def upload_analysis(api, recording, metadata, conf, logger):
     new_metadata = {"additionalMetadata": {}}
-    with tempfile.TemporaryDirectory() as temp:
-        temp_path = Path(temp)
-        input_filename = temp_path / ("recording" + input_extension)
-        logger.debug("downloading recording to %s", input_filename)
-        api.download_file(jwtKey, str(input_filename))
-
-        filename = input_filename.with_suffix(".txt")
-        if "location" in recording:
-            location = recording["location"]
-            if (
-                location is not None
-                and "lat" not in location
-                and "lng" not in location
-                and "coordinates" in location
-            ):
-                coords = location["coordinates"]
-                location["lng"] = coords[0]
-                location["lat"] = coords[1]
-        if "tracks" in recording:
-            del recording["tracks"]
-        with filename.open("w") as f:
-            json.dump(recording, f)
-        metadata = analyse(input_filename, conf)
-        new_metadata = {"additionalMetadata": {}}
-        duration = recording.get("duration")
-        if duration is not None:
-            new_metadata["duration"] = duration
-        else:
-            duration = metadata.get("analysis_result", {}).get("duration")
-        analysis = AudioResult.load(metadata, duration)
-        algorithm_meta = {"algorithm": "sliding_window"}
-        if analysis.species_identify_version is not None:
-            algorithm_meta["version"] = analysis.species_identify_version
-        algorithm_id = api.get_algorithm_id(algorithm_meta)
+    duration = recording.get("duration")
+    if duration is not None:
+        new_metadata["duration"] = duration
+    else:
+        duration = metadata.get("analysis_result", {}).get("duration")
+    analysis = AudioResult.load(metadata, duration)
+    algorithm_meta = {"algorithm": "sliding_window"}
+    if analysis.species_identify_version is not None:
+        algorithm_meta["version"] = analysis.species_identify_version
+    algorithm_id = api.get_algorithm_id(algorithm_meta)
+
+    results = Results(recording)
+    for track in analysis.tracks:
+        track.id = results.add_track(recording, track, algorithm_id)
 
-        for track in analysis.tracks:
-            track.id = api.add_track(recording, track, algorithm_id)
-
-            data = {"algorithm": algorithm_id}
+        data = {"algorithm": algorithm_id}
 
-            if track.master_tag is not None:
-                data["name"] = "Master"
-                api.add_track_tag(recording, track.id, track.master_tag, data)
-            else:
-                data["name"] = "Master"
-                unid = Prediction(UNIDENTIFIED)
-                api.add_track_tag(recording, track.id, unid, data)
-            for i, prediction in enumerate(track.predictions):
-                data["name"] = prediction.model_name
-                if prediction.filtered:
-                    data["filtered"] = True
-                api.add_track_tag(recording, track.id, prediction, data)
-
-        if analysis.cacophony_index is not None:
-            new_metadata["cacophonyIndex"] = analysis.cacophony_index
-            new_metadata["additionalMetadata"][
-                "cacophony_index_version"
-            ] = analysis.cacophony_index_version
-        if analysis.chirp_index is not None:
-            new_metadata["additionalMetadata"]["chirpIndex"] = analysis.chirp_index
-        if analysis.region_code is not None:
-            new_metadata["additionalMetadata"]["regionCode"] = analysis.region_code
-        # is there anyhting missing...
-        # new_metadata["additionalMetadata"] = analysis
+        if track.master_tag is not None:
+            data["name"] = "Master"
+            results.add_track_tag(recording, track.id, track.master_tag, data)
+        else:
+            data["name"] = "Master"
+            unid = Prediction(UNIDENTIFIED)
+            results.add_track_tag(recording, track.id, unid, data)
+        for i, prediction in enumerate(track.predictions):
+            data["name"] = prediction.model_name
+            if prediction.filtered:
+                data["filtered"] = True
+            results.add_track_tag(recording, track.id, prediction, data)
+    api.submit_results(results)
+
+    if analysis.cacophony_index is not None:
+        new_metadata["cacophonyIndex"] = analysis.cacophony_index
+        new_metadata["additionalMetadata"][
+            "cacophony_index_version"
+        ] = analysis.cacophony_index_version
+    if analysis.chirp_index is not None:
+        new_metadata["additionalMetadata"]["chirpIndex"] = analysis.chirp_index
+    if analysis.region_code is not None:
+        new_metadata["additionalMetadata"]["regionCode"] = analysis.region_code
+    # is there anyhting missing...
+    # new_metadata["additionalMetadata"] = analysis
     api.report_done(recording, metadata=new_metadata)
     logger.info("Completed processing for file: %s", recording["id"])
 
 
+ANALYSIS = JobStages("audio.analysis", download_analysis, run_analysis, upload_analysis)
+
+
 def analyse(filename, conf, analyse_tracks=False):
     command = conf.audio_analysis_cmd.format(
         folder=filename.parent,
@@ -230,7 +256,7 @@ def analyse(filename, conf, analyse_tracks=False):
         tag=conf.audio_analysis_tag,
         analyse_tracks=analyse_tracks,
     )
-    with HandleCalledProcessError():
+    with HandleCalledProcessError(), stage("command"):
         proc = subprocess.run(
             command,
             shell=True,
@@ -25,11 +25,10 @@ from pathlib import Path
 import librosa
 import soundfile as sf
 
-from . import API
+from .api import worker_api
 from . import logs
 from .processutils import HandleCalledProcessError
 
-
 MAX_AMPLIFICATION = 20
 
 mimetypes.add_type("audio/mp4", ".mp3")
@@ -44,7 +43,7 @@ BIT_RATE = "128k"
 def process(recording, jwt, conf):
     logger = logs.worker_logger("audio.convert", recording["id"])
 
-    api = API(conf.api_url, conf.user, conf.password, logger)
+    api = worker_api(conf, logger)
 
     input_extension = mimetypes.guess_extension(recording["rawMimeType"])
 
@@ -59,7 +58,7 @@ def process(recording, jwt, conf):
         temp_path = Path(temp)
         input_filename = temp_path / ("recording" + input_extension)
         logger.debug("downloading recording to %s", input_filename)
-        api.download_file(jwt, str(input_filename))
+        api.download_file(jwt, str(input_filename), recording)
 
         logger.debug("normalizing")
         output_filename, new_mime_type, amplification = normalize_file(input_filename)
@@ -0,0 +1,115 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import time
+
+from . import logs
+from .costmodel import DEFAULT_MEMORY_MB, read_meminfo
+
+# load average per cpu below which more workers can be added
+SCALE_UP_LOAD = 0.9
+# load average per cpu above which workers are taken away
+SCALE_DOWN_LOAD = 1.5
+# fraction of polls finding jobs for there to be a backlog
+BACKLOG_HIT_RATE = 0.5
+
+logger = logs.master_logger()
+
+
+def load_per_cpu():
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        return None
+
+
+class Autoscaler:
+    """Moves the size of the worker pool between min_workers and max_workers.
+
+    Every interval it looks at whether jobs are waiting for a worker, how many
+    polls found jobs, the load average and free memory, and adds or removes a
+    worker at a time.
+    """
+
+    def __init__(self, min_workers, max_workers, interval=60, memory_reserve_mb=1024):
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers, min_workers)
+        self.interval = interval
+        self.memory_reserve_mb = memory_reserve_mb
+        self.last_update = time.time()
+        self.last_polls = 0
+        self.last_found_polls = 0
+
+    def clamp(self, workers):
+        return min(self.max_workers, max(self.min_workers, workers))
+
+    def decide(self, size, running, waiting, polls, found_polls, load, available_mb):
+        """Returns the new pool size and the reason for it"""
+        hit_rate = found_polls / polls if polls > 0 else 0
+        backlog = waiting > 0 or (running >= size and hit_rate >= BACKLOG_HIT_RATE)
+        if load is not None and load > SCALE_DOWN_LOAD:
+            return self.clamp(size - 1), f"load {load:.2f} per cpu"
+        if available_mb is not None and available_mb < self.memory_reserve_mb:
+            return self.clamp(size - 1), f"only {available_mb:.0f}MB memory free"
+        if backlog:
+            if load is not None and load >= SCALE_UP_LOAD:
+                return size, f"backlog but load is {load:.2f} per cpu"
+            if (
+                available_mb is not None
+                and available_mb - DEFAULT_MEMORY_MB < self.memory_reserve_mb
+            ):
+                return size, f"backlog but only {available_mb:.0f}MB memory free"
+            return (
+                self.clamp(size + 1),
+                f"{waiting} jobs waiting, {found_polls}/{polls} polls found jobs",
+            )
+        if running < size - 1:
+            return self.clamp(size - 1), f"only {running} of {size} workers busy"
+        return size, "no change needed"
+
+    def update(self, pool, waiting, polls, found_polls, now=None):
+        """Resize pool if the interval has passed, polls and found_polls are
+        running totals over all processors"""
+        if now is None:
+            now = time.time()
+        if now - self.last_update < self.interval:
+            return False
+        self.last_update = now
+        new_polls = polls - self.last_polls
+        new_found = found_polls - self.last_found_polls
+        self.last_polls = polls
+        self.last_found_polls = found_polls
+
+        size = pool.max_workers
+        new_size, reason = self.decide(
+            size,
+            pool.running(),
+            waiting,
+            new_polls,
+            new_found,
+            load_per_cpu(),
+            read_meminfo("MemAvailable"),
+        )
+        if new_size == size:
+            logger.debug("Autoscale keeping %s workers: %s", size, reason)
+            return False
+        logger.info("Autoscale %s workers to %s: %s", size, new_size, reason)
+        pool.resize(new_size)
+        return True
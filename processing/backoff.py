@@ -0,0 +1,90 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import random
+import time
+
+# weight given to the newest interval when averaging job arrival intervals
+ARRIVAL_SMOOTHING = 0.3
+
+
+class PollBackoff:
+    """Decides when a processor should next poll for jobs.
+
+    While polls keep coming back empty the delay grows exponentially from
+    base_delay up to max_delay, with jitter so processors don't poll in step.
+    The delay is also capped at the observed interval between jobs arriving so
+    a queue that gets work every minute isn't left for ten. Finding a job
+    resets the delay, and server hints (Retry-After / queue depth) override it.
+    """
+
+    def __init__(self, base_delay, max_delay, factor=2, jitter=0.2):
+        self.base_delay = base_delay
+        self.max_delay = max(max_delay, base_delay)
+        self.factor = factor
+        self.jitter = jitter
+        self.empty_polls = 0
+        self.next_poll = 0
+        self.last_arrival = None
+        self.arrival_interval = None
+
+    def reset(self):
+        self.empty_polls = 0
+        self.next_poll = 0
+
+    def uncapped_delay(self):
+        return self.base_delay * self.factor ** (self.empty_polls - 1)
+
+    def delay(self):
+        if self.empty_polls == 0:
+            return 0
+        delay = self.uncapped_delay()
+        cap = self.max_delay
+        if self.arrival_interval is not None:
+            cap = min(cap, max(self.base_delay, self.arrival_interval))
+        delay = min(delay, cap)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def polled(self, found_jobs, retry_after=None, queue_depth=None, now=None):
+        if now is None:
+            now = time.time()
+        if found_jobs:
+            if self.last_arrival is not None:
+                interval = now - self.last_arrival
+                if self.arrival_interval is None:
+                    self.arrival_interval = interval
+                else:
+                    self.arrival_interval = (
+                        ARRIVAL_SMOOTHING * interval
+                        + (1 - ARRIVAL_SMOOTHING) * self.arrival_interval
+                    )
+            self.last_arrival = now
+            self.empty_polls = 0
+        elif queue_depth:
+            # server says there is work waiting, we just didn't get any
+            self.empty_polls = 0
+        elif self.empty_polls == 0 or 0 < self.uncapped_delay() < self.max_delay:
+            # stop counting once at max_delay, or the exponent overflows
+            self.empty_polls += 1
+
+        delay = self.delay()
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self.next_poll = now + delay
+        return delay
@@ -0,0 +1,182 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+
+from . import logs
+from . import metrics
+
+logger = logs.master_logger()
+
+# recording field the API gives the sha1 of the raw file in, when it does
+HASH_FIELD = "rawFileHash"
+# and its size in bytes
+SIZE_FIELD = "rawFileSize"
+CHUNK_SIZE = 1024 * 1024
+# <recording id>-<sha1><ext>
+CACHED_NAME = re.compile(r"(\d+)-([0-9a-f]{40})(\.\w+)?")
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class RecordingCache:
+    """Raw recordings kept on disk so retracking, reprocessing or retrying a
+    recording doesn't download it again.
+
+    Files are stored as <recording id>-<sha1><ext> and found by recording id.
+    When the API gives the file's hash a cached file with a different hash is
+    treated as stale. The least recently used files are removed once the
+    cache is over max_mb. Safe to use from several download threads.
+    """
+
+    def __init__(self, directory, max_mb):
+        self.directory = directory
+        self.max_bytes = max_mb * 1024**2
+        self.lock = threading.Lock()
+        # recording id to (filename, sha1, size), least recently used first
+        self.files = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        """Index files cached before a restart, oldest access first. Copies
+        left part way by a crash are removed"""
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".partial"):
+                os.remove(entry.path)
+                continue
+            match = CACHED_NAME.fullmatch(entry.name)
+            if match is None:
+                continue
+            stat = entry.stat()
+            found.append(
+                (
+                    stat.st_atime,
+                    int(match.group(1)),
+                    entry.path,
+                    match.group(2),
+                    stat.st_size,
+                )
+            )
+        for _, recording_id, filename, sha1, size in sorted(found):
+            # only the most recently used copy of a recording is kept
+            self.remove(recording_id)
+            self.files[recording_id] = (filename, sha1, size)
+            self.size += size
+        self.update_metrics()
+        if self.files:
+            logger.info(
+                "Recording cache has %s files, %.1f MB",
+                len(self.files),
+                self.size / 1024**2,
+            )
+
+    def get(self, recording, filename):
+        """Copy the cached file for recording to filename, returning whether
+        it was cached"""
+        wanted = recording.get(HASH_FIELD)
+        with self.lock:
+            cached = self.files.get(recording["id"])
+            if cached is not None and wanted and wanted != cached[1]:
+                logger.info("Cached file for %s is stale", recording["id"])
+                self.remove(recording["id"])
+                cached = None
+            if cached is None:
+                self.misses += 1
+                metrics.RECORDING_CACHE.inc(result="miss")
+                return False
+            self.files.move_to_end(recording["id"])
+            self.hits += 1
+            metrics.RECORDING_CACHE.inc(result="hit")
+        try:
+            shutil.copyfile(cached[0], filename)
+        except FileNotFoundError:
+            with self.lock:
+                self.remove(recording["id"])
+            return False
+        os.utime(cached[0])
+        return True
+
+    def add(self, recording, filename, sha1=None):
+        """Cache a downloaded copy of recording, returning the file's sha1"""
+        if sha1 is None:
+            sha1 = file_hash(filename)
+        size = os.path.getsize(filename)
+        if size > self.max_bytes:
+            return sha1
+        cached = os.path.join(
+            self.directory,
+            f"{recording['id']}-{sha1}{os.path.splitext(filename)[1]}",
+        )
+        # copy under a temporary name so a partly copied file is never used
+        partial = f"{cached}.partial"
+        shutil.copyfile(filename, partial)
+        os.replace(partial, cached)
+        with self.lock:
+            self.remove(recording["id"], keep=cached)
+            self.files[recording["id"]] = (cached, sha1, size)
+            self.size += size
+            self.evict()
+        return sha1
+
+    def resize(self, max_mb):
+        with self.lock:
+            self.max_bytes = max_mb * 1024**2
+            self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.files:
+            self.remove(next(iter(self.files)))
+        self.update_metrics()
+
+    def remove(self, recording_id, keep=None):
+        cached = self.files.pop(recording_id, None)
+        if cached is None:
+            return
+        self.size -= cached[2]
+        if cached[0] != keep:
+            try:
+                os.remove(cached[0])
+            except FileNotFoundError:
+                pass
+
+    def update_metrics(self):
+        metrics.RECORDING_CACHE_BYTES.set(self.size)
+        metrics.RECORDING_CACHE_FILES.set(len(self.files))
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
@@ -22,7 +22,6 @@ from pathlib import Path
 import attr
 import yaml
 
-
 CONFIG_FILENAME = "processing.yaml"
 CONFIG_DIRS = [Path(__file__).parent.parent, Path("/etc/cacophony")]
 
@@ -62,6 +61,83 @@ configTuple = namedtuple(
         "max_tracks",
         "no_job_sleep_seconds",
         "subprocess_timeout",
+        "max_claim_batch",
+        "max_no_job_sleep_seconds",
+        "max_workers",
+        "download_workers",
+        "upload_workers",
+        "prefetch_jobs",
+        "memory_budget_mb",
+        "memory_reserve_mb",
+        "worker_max_tasks",
+        "autoscale_min_workers",
+        "autoscale_max_workers",
+        "autoscale_interval_secs",
+        "metrics_port",
+        "metrics_address",
+        "timing_log",
+        "journal_file",
+        "quarantine_file",
+        "quarantine_max_failures",
+        "quarantine_backoff_secs",
+        "quarantine_expiry_hours",
+        "coordinator",
+        "coordinator_lease_secs",
+        "coordinator_max_duration",
+        "poll_timeout_secs",
+        "handoff_secs",
+        "recording_cache_mb",
+        "recording_cache_dir",
+        "token_cache_file",
+        "http_pool_size",
+        "http_retries",
+        "http_backoff_factor",
+        "post_workers",
+        "download_connections",
+        "download_part_mb",
+        "stream_downloads",
+        "coordinator_secret",
+        "coordinator_pending_secs",
+    ],
+    # options added after the original set, so they can be left out
+    defaults=[
+        10,
+        60 * 5,
+        None,
+        4,
+        4,
+        1,
+        None,
+        1024,
+        0,
+        1,
+        None,
+        60,
+        None,
+        "127.0.0.1",
+        None,
+        None,
+        None,
+        3,
+        60 * 5,
+        24 * 7,
+        None,
+        60,
+        None,
+        10,
+        600,
+        None,
+        None,
+        None,
+        None,
+        3,
+        0.5,
+        4,
+        4,
+        8,
+        False,
+        None,
+        600,
     ],
 )
 
@@ -140,6 +216,43 @@ class Config(configTuple):
                 max_tracks=thermal.get("max_tracks", 10),
                 no_job_sleep_seconds=y.get("no_job_sleep_seconds", 30),
                 subprocess_timeout=y.get("subprocess_timeout", 60 * 20),
+                max_claim_batch=y.get("max_claim_batch", 10),
+                max_no_job_sleep_seconds=y.get("max_no_job_sleep_seconds", 60 * 5),
+                max_workers=y.get("max_workers"),
+                download_workers=y.get("download_workers", 4),
+                upload_workers=y.get("upload_workers", 4),
+                prefetch_jobs=y.get("prefetch_jobs", 1),
+                memory_budget_mb=y.get("memory_budget_mb"),
+                memory_reserve_mb=y.get("memory_reserve_mb", 1024),
+                worker_max_tasks=y.get("worker_max_tasks", 0),
+                autoscale_min_workers=y.get("autoscale_min_workers", 1),
+                autoscale_max_workers=y.get("autoscale_max_workers"),
+                autoscale_interval_secs=y.get("autoscale_interval_secs", 60),
+                metrics_port=y.get("metrics_port"),
+                metrics_address=y.get("metrics_address", "127.0.0.1"),
+                timing_log=y.get("timing_log"),
+                journal_file=y.get("journal_file"),
+                quarantine_file=y.get("quarantine_file"),
+                quarantine_max_failures=y.get("quarantine_max_failures", 3),
+                quarantine_backoff_secs=y.get("quarantine_backoff_secs", 60 * 5),
+                quarantine_expiry_hours=y.get("quarantine_expiry_hours", 24 * 7),
+                coordinator=y.get("coordinator"),
+                coordinator_lease_secs=y.get("coordinator_lease_secs", 60),
+                coordinator_max_duration=y.get("coordinator_max_duration"),
+                poll_timeout_secs=y.get("poll_timeout_secs", 10),
+                handoff_secs=y.get("handoff_secs", 600),
+                recording_cache_mb=y.get("recording_cache_mb"),
+                recording_cache_dir=y.get("recording_cache_dir"),
+                token_cache_file=y.get("token_cache_file"),
+                http_pool_size=y.get("http_pool_size"),
+                http_retries=y.get("http_retries", 3),
+                http_backoff_factor=y.get("http_backoff_factor", 0.5),
+                post_workers=y.get("post_workers", 4),
+                download_connections=y.get("download_connections", 4),
+                download_part_mb=y.get("download_part_mb", 8),
+                stream_downloads=y.get("stream_downloads", False),
+                coordinator_secret=y.get("coordinator_secret"),
+                coordinator_pending_secs=y.get("coordinator_pending_secs", 600),
             )
 
 
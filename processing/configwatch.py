@@ -0,0 +1,65 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+from .config import Config, find_config
+
+
+class ConfigWatcher:
+    """Notices when the config file changes, either by its modification time
+    or because a reload was requested (e.g. on SIGHUP)."""
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = find_config()
+        self.filename = filename
+        self.mtime = self.read_mtime()
+        self.requested = False
+
+    def read_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime
+        except OSError:
+            return None
+
+    def request(self):
+        self.requested = True
+
+    def changed(self):
+        mtime = self.read_mtime()
+        if self.requested or (mtime is not None and mtime != self.mtime):
+            self.requested = False
+            self.mtime = mtime
+            return True
+        return False
+
+    def load(self, current):
+        """Load the config file again, keeping the API credentials of current
+        as these can come from the command line"""
+        conf = Config.load_from(self.filename)
+        return conf._replace(api_credentials=current.api_credentials)
+
+
+def changed_options(old, new):
+    return [
+        name
+        for name in old._fields
+        if name != "api_credentials" and getattr(old, name) != getattr(new, name)
+    ]
@@ -0,0 +1,393 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import attr
+
+from . import logs
+from .api import NO_HINTS
+
+LEASE_SECS = 60
+HEARTBEAT_SECS = 15
+# claimed jobs held for hosts that can take them, before claiming stops
+MAX_PENDING = 100
+# claimed jobs no host has taken are dropped after this long, well before the
+# API times out the claim and hands the recording to someone else
+PENDING_SECS = 600
+
+logger = logs.master_logger()
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def matches(response, wanted, max_duration):
+    recording = response["recording"]
+    if recording.get("type") != wanted["type"]:
+        return False
+    if recording.get("processingState") not in wanted["states"]:
+        return False
+    duration = recording.get("duration") or 0
+    return max_duration is None or duration <= max_duration
+
+
+@attr.s
+class Claimed:
+    job = attr.ib()
+    claimed = attr.ib()
+
+
+@attr.s
+class Lease:
+    job = attr.ib()
+    host = attr.ib()
+    expires = attr.ib()
+    claimed = attr.ib()
+
+    @property
+    def id(self):
+        return self.job["recording"]["id"]
+
+
+class Coordinator:
+    """Claims jobs from the API on behalf of several processing hosts and
+    leases them out, so hosts don't race each other for jobs.
+
+    Hosts ask for jobs the same way they'd poll the API, optionally with the
+    longest recording they can take, and keep their leases alive with
+    heartbeats. A lease that isn't renewed within lease_secs goes back to be
+    handed to another host. Claimed jobs that no host takes within
+    pending_secs of being claimed are dropped, as their job keys will soon be
+    stale.
+    """
+
+    def __init__(
+        self,
+        api,
+        lease_secs=LEASE_SECS,
+        max_pending=MAX_PENDING,
+        pending_secs=PENDING_SECS,
+    ):
+        self.api = api
+        self.lease_secs = lease_secs
+        self.max_pending = max_pending
+        self.pending_secs = pending_secs
+        self.lock = threading.Lock()
+        self.pending = []
+        self.leases = {}
+
+    def lease(self, host, wanted, max_duration=None, now=None):
+        clock = time.time if now is None else lambda: now
+        with self.lock:
+            self.expire(clock())
+            jobs = self.take(host, wanted, max_duration, clock())
+            remaining = []
+            for w in wanted:
+                # matching jobs still pending are ones this host can't take,
+                # so claiming more for it would only leave them waiting too
+                held = sum(matches(j, w, None) for j in jobs) + sum(
+                    matches(p.job, w, None) for p in self.pending
+                )
+                if w["limit"] > held:
+                    remaining.append(dict(w, limit=w["limit"] - held))
+            if not remaining or len(self.pending) >= self.max_pending:
+                return jobs
+        # claim without the lock so heartbeats and other hosts aren't held up
+        # by the API
+        try:
+            claimed = self.claim(remaining)
+        except Exception:
+            logger.error("Claiming jobs failed", exc_info=True)
+            return jobs
+        with self.lock:
+            now = clock()
+            self.pending.extend(Claimed(job, now) for job in claimed)
+            jobs.extend(self.take(host, remaining, max_duration, clock()))
+        return jobs
+
+    def take(self, host, wanted, max_duration, now):
+        limits = [w["limit"] for w in wanted]
+        taken = []
+        for pending in list(self.pending):
+            for i, w in enumerate(wanted):
+                if limits[i] > 0 and matches(pending.job, w, max_duration):
+                    limits[i] -= 1
+                    self.pending.remove(pending)
+                    lease = Lease(
+                        pending.job, host, now + self.lease_secs, pending.claimed
+                    )
+                    self.leases[lease.id] = lease
+                    taken.append(pending.job)
+                    break
+        return taken
+
+    def claim(self, wanted):
+        jobs, _ = self.api.poll_jobs(wanted)
+        if jobs is not None:
+            return jobs
+        jobs = []
+        for w in wanted:
+            claimed = []
+            for state in w["states"]:
+                if len(claimed) >= w["limit"]:
+                    break
+                more, _ = self.api.next_jobs(
+                    w["type"], state, w["limit"] - len(claimed)
+                )
+                claimed.extend(more)
+            jobs.extend(claimed)
+        return jobs
+
+    def heartbeat(self, host, lease_ids, now=None):
+        """Renew host's leases, returning the ids of any it no longer holds"""
+        if now is None:
+            now = time.time()
+        lost = []
+        with self.lock:
+            self.expire(now)
+            for lease_id in lease_ids:
+                lease = self.leases.get(lease_id)
+                if lease is None or lease.host != host:
+                    lost.append(lease_id)
+                else:
+                    lease.expires = now + self.lease_secs
+        return lost
+
+    def release(self, host, lease_id):
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is not None and lease.host == host:
+                del self.leases[lease_id]
+
+    def expire(self, now):
+        for lease in list(self.leases.values()):
+            if lease.expires <= now:
+                logger.warning(
+                    "Lease of %s by %s expired, handing it out again",
+                    lease.id,
+                    lease.host,
+                )
+                del self.leases[lease.id]
+                self.pending.insert(0, Claimed(lease.job, lease.claimed))
+        for pending in list(self.pending):
+            if now - pending.claimed >= self.pending_secs:
+                logger.warning(
+                    "No host took %s within %ss of claiming it, dropping it",
+                    pending.job["recording"]["id"],
+                    self.pending_secs,
+                )
+                self.pending.remove(pending)
+
+    def handle(self, message):
+        op = message.get("op")
+        host = message.get("host")
+        if op == "lease":
+            jobs = self.lease(host, message["wanted"], message.get("max_duration"))
+            return {"jobs": jobs, "lease_secs": self.lease_secs}
+        if op == "heartbeat":
+            return {"lost": self.heartbeat(host, message["leases"])}
+        if op == "release":
+            self.release(host, message["lease"])
+            return {}
+        return {"error": f"unknown op {op}"}
+
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                if self.server.authorized(message):
+                    reply = self.server.coordinator.handle(message)
+                else:
+                    logger.warning(
+                        "Rejected request from %s without the secret",
+                        self.client_address[0],
+                    )
+                    reply = {"error": "unauthorized"}
+            except Exception as err:
+                logger.error("Coordinator request failed", exc_info=True)
+                reply = {"error": str(err)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, coordinator, secret=None):
+        self.coordinator = coordinator
+        self.secret = secret
+        super().__init__(address, CoordinatorHandler)
+
+    def authorized(self, message):
+        if self.secret is None:
+            return True
+        return hmac.compare_digest(
+            str(message.get("secret", "")).encode(), self.secret.encode()
+        )
+
+
+def serve(coordinator, address, secret=None):
+    """Serve coordinator from a background thread, returning the server.
+    With secret set, requests without it are rejected."""
+    server = CoordinatorServer(parse_address(address), coordinator, secret)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Coordinating jobs on %s:%s", *server.server_address[:2])
+    if (
+        secret is None
+        and not ipaddress.ip_address(server.server_address[0]).is_loopback
+    ):
+        logger.warning(
+            "coordinator_secret isn't set, anyone who can connect can take jobs"
+        )
+    return server
+
+
+class CoordinatorClient:
+    """Gets jobs from a coordinator instead of polling the API.
+
+    Has the same poll_jobs as API so processors can use either. Leases are
+    renewed from a background thread, and leases the coordinator says this
+    host lost are collected for the main loop to drop.
+    """
+
+    def __init__(
+        self,
+        address,
+        host=None,
+        max_duration=None,
+        heartbeat_secs=HEARTBEAT_SECS,
+        secret=None,
+    ):
+        self.address = parse_address(address)
+        self.secret = secret
+        if host is None:
+            host = f"{socket.gethostname()}:{os.getpid()}"
+        self.host = host
+        self.max_duration = max_duration
+        self.heartbeat_secs = heartbeat_secs
+        self.lock = threading.Lock()
+        self.leases = set()
+        self.lost = set()
+        self.conn = None
+        self.stopped = threading.Event()
+
+    def request(self, message):
+        message["host"] = self.host
+        if self.secret is not None:
+            message["secret"] = self.secret
+        data = json.dumps(message).encode() + b"\n"
+        with self.lock:
+            # reconnect once if the coordinator was restarted
+            for attempt in range(2):
+                try:
+                    if self.conn is None:
+                        sock = socket.create_connection(self.address, timeout=60)
+                        self.conn = (sock, sock.makefile("rb"))
+                    sock, reader = self.conn
+                    sock.sendall(data)
+                    line = reader.readline()
+                    if not line:
+                        raise ConnectionError("coordinator closed the connection")
+                    break
+                except OSError:
+                    self.close()
+                    if attempt == 1:
+                        raise
+        reply = json.loads(line)
+        if "error" in reply:
+            raise IOError(reply["error"])
+        return reply
+
+    def poll_jobs(self, wanted):
+        reply = self.request(
+            {"op": "lease", "wanted": wanted, "max_duration": self.max_duration}
+        )
+        jobs = reply["jobs"]
+        with self.lock:
+            self.leases.update(job["recording"]["id"] for job in jobs)
+        return jobs, NO_HINTS
+
+    def release(self, lease_id):
+        with self.lock:
+            if lease_id not in self.leases:
+                return
+            self.leases.discard(lease_id)
+        self.request({"op": "release", "lease": lease_id})
+
+    def heartbeat(self):
+        with self.lock:
+            leases = list(self.leases)
+        if not leases:
+            return
+        lost = self.request({"op": "heartbeat", "leases": leases})["lost"]
+        with self.lock:
+            self.leases.difference_update(lost)
+            self.lost.update(lost)
+
+    def take_lost(self):
+        with self.lock:
+            lost = self.lost
+            self.lost = set()
+        return lost
+
+    def start(self):
+        threading.Thread(target=self.run_heartbeats, daemon=True).start()
+
+    def run_heartbeats(self):
+        while not self.stopped.wait(self.heartbeat_secs):
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.error("Heartbeat to coordinator failed", exc_info=True)
+
+    def close(self):
+        if self.conn is not None:
+            sock, reader = self.conn
+            reader.close()
+            sock.close()
+            self.conn = None
+
+
+def run(api, conf):
+    coordinator = Coordinator(
+        api,
+        conf.coordinator_lease_secs,
+        pending_secs=conf.coordinator_pending_secs,
+    )
+    server = serve(coordinator, conf.coordinator, conf.coordinator_secret)
+    try:
+        while True:
+            time.sleep(coordinator.lease_secs)
+            with coordinator.lock:
+                coordinator.expire(time.time())
+    finally:
+        server.shutdown()
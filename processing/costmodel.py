@@ -0,0 +1,145 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import threading
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+# jobs remembered per job type to fit costs to
+HISTORY = 200
+# samples needed before fitting costs to duration and size
+MIN_FIT_SAMPLES = 5
+DEFAULT_RUNTIME = 60
+DEFAULT_MEMORY_MB = 512
+MEMORY_SAMPLE_SECS = 0.5
+
+Cost = namedtuple("Cost", ["runtime", "memory_mb"])
+
+
+def features(recording):
+    duration = recording.get("duration") or 0
+    size_mb = 0
+    filename = recording.get("filename")
+    if filename is not None and os.path.isfile(filename):
+        size_mb = os.path.getsize(filename) / 1024**2
+    return [1, duration, size_mb]
+
+
+def read_meminfo(field):
+    """Memory field from /proc/meminfo in MB, or None if it can't be read"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                if name == field:
+                    return int(value.split()[0]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class CostModel:
+    """Learns how long jobs take and how much memory they need from past jobs
+    of the same type, as a linear fit to recording duration and file size.
+
+    It is used to run short jobs ahead of long ones and, with memory_budget_mb
+    set, to only start jobs whose predicted memory fits within it alongside
+    the jobs already running. Peaks are measured system wide, so jobs running
+    together inflate each other's predictions, which is why the budget is
+    opt in.
+    """
+
+    def __init__(self, memory_budget_mb=None):
+        self.memory_budget_mb = memory_budget_mb
+        self.history = {}
+        self.running = {}
+
+    def observe(self, name, recording, runtime, memory_mb):
+        samples = self.history.setdefault(name, deque(maxlen=HISTORY))
+        samples.append((features(recording), runtime, memory_mb))
+
+    def predict(self, name, recording):
+        samples = self.history.get(name)
+        if not samples:
+            return Cost(DEFAULT_RUNTIME, DEFAULT_MEMORY_MB)
+        if len(samples) < MIN_FIT_SAMPLES:
+            return Cost(
+                np.mean([s[1] for s in samples]), np.mean([s[2] for s in samples])
+            )
+        x = np.array([s[0] for s in samples], dtype=float)
+        y = np.array([[s[1], s[2]] for s in samples], dtype=float)
+        coefficients, *_ = np.linalg.lstsq(x, y, rcond=None)
+        runtime, memory_mb = np.array(features(recording), dtype=float) @ coefficients
+        # never predict less than the cheapest job seen
+        return Cost(
+            max(runtime, y[:, 0].min()),
+            max(memory_mb, y[:, 1].min()),
+        )
+
+    def priority(self, job, name):
+        """Shortest predicted job first, jobs move up the longer they wait"""
+        return self.predict(name, job.recording).runtime - (time.time() - job.started)
+
+    def admit(self, cost):
+        if self.memory_budget_mb is None or len(self.running) == 0:
+            return True
+        used = sum(running.memory_mb for running in self.running.values())
+        return used + cost.memory_mb <= self.memory_budget_mb
+
+    def started(self, job_id, cost):
+        self.running[job_id] = cost
+
+    def finished(self, job_id):
+        self.running.pop(job_id, None)
+
+
+class MemoryPeak:
+    """Samples system memory on a thread to find how much a job used at its
+    peak. Containers run outside the worker's process tree, so this measures
+    the drop in available memory, which over-estimates when jobs overlap."""
+
+    def __init__(self):
+        self.start = read_meminfo("MemAvailable")
+        self.lowest = self.start
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def __enter__(self):
+        if self.start is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.done.set()
+        return False
+
+    def sample(self):
+        while not self.done.wait(MEMORY_SAMPLE_SECS):
+            available = read_meminfo("MemAvailable")
+            if available is not None:
+                self.lowest = min(self.lowest, available)
+
+    @property
+    def peak_mb(self):
+        if self.start is None:
+            return 0
+        return max(0, self.start - self.lowest)
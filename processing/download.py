@@ -0,0 +1,264 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import logs
+from . import metrics
+
+logger = logs.master_logger()
+
+DL_TIMEOUT = 60 * 5
+CONNECTIONS = 4
+PART_MB = 8
+CHUNK_SIZE = 1024 * 1024
+RETRIES = 3
+RETRY_SLEEP_SECS = 1
+# errors a download can carry on from, anything else (like an expired link)
+# fails straight away
+RESUMABLE = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+class ShortRead(IOError):
+    pass
+
+
+class Mismatch(IOError):
+    pass
+
+
+class Digest:
+    """sha1 and size of a file hashed as it is written.
+
+    Bytes are hashed as they arrive when they carry on from what has been
+    hashed so far, which is all of a single stream and the first part of a
+    ranged download. Parts that arrive ahead of that are read back once the
+    download finishes, while they are still in the page cache. Bytes sent
+    again after a retry are only hashed once.
+    """
+
+    def __init__(self):
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def update(self, chunk, offset=None):
+        with self.lock:
+            if offset is None:
+                offset = self.size
+            if offset > self.size or offset + len(chunk) <= self.size:
+                return
+            chunk = chunk[self.size - offset :]
+            self.sha1.update(chunk)
+            self.size += len(chunk)
+
+    def finish(self, fd, total):
+        """Hash the rest of the first total bytes of fd"""
+        while self.size < total:
+            chunk = os.pread(fd, min(CHUNK_SIZE, total - self.size), self.size)
+            if not chunk:
+                raise ShortRead(f"File ends at {self.size} of {total} bytes")
+            self.update(chunk)
+
+    @property
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+    def check(self, sha1=None, size=None):
+        """Raise Mismatch if the file isn't the expected size or sha1"""
+        if size is not None and self.size != size:
+            raise Mismatch(f"Got {self.size} bytes, expected {size}")
+        if sha1 and self.hexdigest != sha1.lower():
+            raise Mismatch(f"Got sha1 {self.hexdigest}, expected {sha1}")
+
+
+def content_range_total(response):
+    """Total size from a "bytes start-end/total" Content-Range, or None"""
+    match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+class Downloader:
+    """Downloads a file in parts over several connections with HTTP range
+    requests, writing each part in place as it arrives.
+
+    A part that fails part way is carried on from the last byte received,
+    rather than the whole download starting again. Servers that ignore range
+    requests get a single streamed download, which is restarted on failure.
+    """
+
+    def __init__(
+        self,
+        session=None,
+        connections=CONNECTIONS,
+        part_mb=PART_MB,
+        retries=RETRIES,
+        chunk_size=CHUNK_SIZE,
+    ):
+        self.session = session or requests.Session()
+        self.connections = max(1, connections)
+        self.part_size = max(1, int(part_mb * 1024**2))
+        self.retries = retries
+        self.chunk_size = chunk_size
+
+    def download(self, url, filename, params=None, sha1=None, size=None):
+        """Download url to filename, returning the file's sha1. When the
+        expected sha1 or size is given a file that doesn't match is downloaded
+        again straight away."""
+        attempt = 0
+        while True:
+            digest = self.download_once(url, filename, params)
+            try:
+                digest.check(sha1, size)
+                return digest.hexdigest
+            except Mismatch as e:
+                metrics.DOWNLOAD_MISMATCHES.inc()
+                if attempt >= self.retries:
+                    raise
+                logger.warning("Download doesn't match, downloading again: %s", e)
+                attempt += 1
+
+    def download_once(self, url, filename, params):
+        digest = Digest()
+        with open(filename, "wb+") as f:
+            fd = f.fileno()
+            r = self.first(url, params)
+            if r.status_code == 416:
+                # an empty file has no range to ask for
+                return digest
+            if r.status_code != 206:
+                self.whole(fd, url, params, r, digest)
+                return digest
+            total = content_range_total(r)
+            if total is None:
+                raise IOError("Range response without a total size")
+            os.ftruncate(fd, total)
+            parts = [
+                (start, min(start + self.part_size, total) - 1)
+                for start in range(self.part_size, total, self.part_size)
+            ]
+            with ThreadPoolExecutor(max(1, self.connections - 1)) as pool:
+                rest = [
+                    pool.submit(self.fetch, url, params, fd, start, end, digest)
+                    for start, end in parts
+                ]
+                self.fetch(
+                    url, params, fd, 0, min(self.part_size, total) - 1, digest, r
+                )
+                for future in rest:
+                    future.result()
+            digest.finish(fd, total)
+        return digest
+
+    def first(self, url, params):
+        attempt = 0
+        while True:
+            try:
+                return self.get(url, params, 0, self.part_size - 1)
+            except RESUMABLE as e:
+                self.failed(attempt, e)
+                attempt += 1
+
+    def get(self, url, params, start, end):
+        r = self.session.get(
+            url,
+            params=params,
+            headers={"Range": f"bytes={start}-{end}"},
+            stream=True,
+            timeout=DL_TIMEOUT,
+        )
+        if r.status_code != 416:
+            r.raise_for_status()
+        return r
+
+    def fetch(self, url, params, fd, start, end, digest, r=None):
+        """Fetch bytes start to end inclusive, carrying on from where it got to
+        if the connection fails. r is a response already started at start"""
+        offset = start
+        attempt = 0
+        while offset <= end:
+            try:
+                if r is None:
+                    r = self.get(url, params, offset, end)
+                if r.status_code != 206:
+                    raise IOError(f"Range request got status {r.status_code}")
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    chunk = chunk[: end + 1 - offset]
+                    os.pwrite(fd, chunk, offset)
+                    digest.update(chunk, offset)
+                    offset += len(chunk)
+                    if offset > end:
+                        break
+                if offset <= end:
+                    raise ShortRead(f"Got {offset - start} of {end + 1 - start} bytes")
+            except RESUMABLE + (ShortRead,) as e:
+                self.failed(attempt, e)
+                attempt += 1
+            finally:
+                if r is not None:
+                    r.close()
+                r = None
+
+    def whole(self, fd, url, params, r, digest):
+        """Stream the whole file from a server that ignores ranges, starting
+        again if it fails"""
+        attempt = 0
+        while True:
+            offset = 0
+            try:
+                if r is None:
+                    r = self.session.get(
+                        url, params=params, stream=True, timeout=DL_TIMEOUT
+                    )
+                    r.raise_for_status()
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    os.pwrite(fd, chunk, offset)
+                    digest.update(chunk, offset)
+                    offset += len(chunk)
+                expected = r.headers.get("Content-Length")
+                # lengths of encoded responses don't match what is written
+                if (
+                    expected is not None
+                    and "Content-Encoding" not in r.headers
+                    and offset != int(expected)
+                ):
+                    raise ShortRead(f"Got {offset} of {expected} bytes")
+                os.ftruncate(fd, offset)
+                return
+            except RESUMABLE + (ShortRead,) as e:
+                self.failed(attempt, e)
+                attempt += 1
+                r = None
+
+    def failed(self, attempt, e):
+        if attempt >= self.retries:
+            raise e
+        logger.warning("Download interrupted, retrying: %s", e)
+        time.sleep(RETRY_SLEEP_SECS * 2**attempt)
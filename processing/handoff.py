@@ -0,0 +1,111 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import threading
+import time
+
+import attr
+
+from . import logs
+
+logger = logs.master_logger()
+
+# recordings kept at most, so handoffs nobody takes don't fill the disk
+MAX_HANDOFFS = 50
+
+
+@attr.s
+class Handoff:
+    filename = attr.ib()
+    tracks = attr.ib()
+    expires = attr.ib()
+
+
+class Handoffs:
+    """Recordings this host has tracked, kept for its analyse stage.
+
+    After tracking the recording file is moved out of the job's work dir and
+    kept with the tracks that were posted, so if the API then hands the
+    recording to this host for analysis it doesn't need to be downloaded and
+    its tracks fetched again. Handoffs that aren't taken within expiry_secs are
+    deleted.
+    """
+
+    def __init__(self, directory, expiry_secs=600, max_handoffs=MAX_HANDOFFS):
+        self.directory = directory
+        self.expiry_secs = expiry_secs
+        self.max_handoffs = max_handoffs
+        self.handoffs = {}
+        self.lock = threading.Lock()
+        # anything left from before a restart has no tracks to go with it
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def keep(self, recording_id, filename, tracks, now=None):
+        if now is None:
+            now = time.time()
+        kept = os.path.join(
+            self.directory, f"{recording_id}{os.path.splitext(filename)[1]}"
+        )
+        os.replace(filename, kept)
+        with self.lock:
+            old = self.handoffs.pop(recording_id, None)
+            self.handoffs[recording_id] = Handoff(kept, tracks, now + self.expiry_secs)
+        if old is not None and old.filename != kept:
+            remove(old.filename)
+        self.expire(now)
+
+    def take(self, recording_id, now=None):
+        """The handoff for recording_id, which the caller now owns, or None"""
+        self.expire(now)
+        with self.lock:
+            return self.handoffs.pop(recording_id, None)
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            expired = [
+                recording_id
+                for recording_id, handoff in self.handoffs.items()
+                if handoff.expires <= now
+            ]
+            left = [
+                recording_id
+                for recording_id in self.handoffs
+                if recording_id not in expired
+            ]
+            # dicts keep insertion order, so the oldest go first
+            expired.extend(left[: max(0, len(left) - self.max_handoffs)])
+            removed = [self.handoffs.pop(recording_id) for recording_id in expired]
+        for handoff in removed:
+            logger.debug("Handoff of %s expired", handoff.filename)
+            remove(handoff.filename)
+
+    def __len__(self):
+        return len(self.handoffs)
+
+
+def remove(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,219 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import contextvars
+import json
+import sqlite3
+import threading
+import time
+
+import attr
+
+from . import logs
+
+logger = logs.master_logger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    state TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    recording TEXT NOT NULL,
+    raw_jwt TEXT NOT NULL,
+    work_dir TEXT,
+    result TEXT,
+    claimed REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS posted (
+    recording_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (recording_id, key)
+);
+"""
+
+_posting = contextvars.ContextVar("posting", default=None)
+
+
+@attr.s
+class Entry:
+    id = attr.ib()
+    type = attr.ib()
+    state = attr.ib()
+    stage = attr.ib()
+    recording = attr.ib()
+    raw_jwt = attr.ib()
+    work_dir = attr.ib()
+    result = attr.ib()
+    claimed = attr.ib()
+
+
+class Journal:
+    """Remembers claimed jobs on disk so they can be picked up again after a
+    restart from the last stage they finished.
+
+    Jobs are recorded when claimed, downloaded and computed and removed once
+    finished. Results posted to the API while uploading are recorded too, so
+    an interrupted upload doesn't post the same tracks twice.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        # uploads record what they post from their own threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(SCHEMA)
+
+    def claimed(self, job, recording_type):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM posted WHERE recording_id = ?", (job.id,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?, ?)",
+                (
+                    job.id,
+                    recording_type,
+                    job.state,
+                    "claimed",
+                    json.dumps(job.recording),
+                    job.raw_jwt,
+                    job.started,
+                    now,
+                ),
+            )
+
+    def downloaded(self, job):
+        self.update(
+            job.id,
+            stage="downloaded",
+            recording=json.dumps(job.recording),
+            work_dir=job.work_dir,
+        )
+
+    def computed(self, job):
+        try:
+            result = json.dumps(job.result)
+        except (TypeError, ValueError):
+            # can't be stored, so it is computed again after a restart
+            return
+        self.update(job.id, stage="computed", result=result)
+
+    def update(self, job_id, **columns):
+        columns["updated"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in columns)
+        with self.lock, self.db:
+            self.db.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?",
+                (*columns.values(), job_id),
+            )
+
+    def finished(self, job_id):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self.db.execute("DELETE FROM posted WHERE recording_id = ?", (job_id,))
+
+    def entries(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, type, state, stage, recording, raw_jwt, work_dir, result,"
+                " claimed FROM jobs ORDER BY claimed"
+            ).fetchall()
+        entries = []
+        for row in rows:
+            entry = Entry(*row)
+            entry.recording = json.loads(entry.recording)
+            if entry.result is not None:
+                entry.result = json.loads(entry.result)
+            entries.append(entry)
+        return entries
+
+    def posted(self, recording_id, key):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM posted WHERE recording_id = ? AND key = ?",
+                (recording_id, key),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def record_posted(self, recording_id, key, value):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO posted VALUES (?, ?, ?)",
+                (recording_id, key, json.dumps(value)),
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class Posting:
+    """Results being posted for one job. Counts how many times each key has
+    been posted so identical posts in one job, such as two tracks with the
+    same data, are each recorded under their own key."""
+
+    def __init__(self, journal, recording_id):
+        self.journal = journal
+        self.recording_id = recording_id
+        # posts are made from the writer threads too
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def occurrence(self, key):
+        with self.lock:
+            count = self.counts.get(key, 0)
+            self.counts[key] = count + 1
+        return f"{key}:{count}"
+
+
+@contextlib.contextmanager
+def posting(journal, recording_id):
+    """Record results posted in this thread against recording_id"""
+    token = _posting.set(None if journal is None else Posting(journal, recording_id))
+    try:
+        yield
+    finally:
+        _posting.reset(token)
+
+
+def post_key(key):
+    """Key for the next post of key in this job, numbered by how many times
+    it has been posted already"""
+    current = _posting.get()
+    if current is None:
+        return key
+    return current.occurrence(key)
+
+
+def already_posted(key):
+    current = _posting.get()
+    if current is None:
+        return None
+    return current.journal.posted(current.recording_id, key)
+
+
+def record_posted(key, value):
+    current = _posting.get()
+    if current is not None:
+        current.journal.record_posted(current.recording_id, key, value)
@@ -60,3 +60,10 @@ def worker_logger(name, recording_id):
     logger.setLevel(logging.INFO)
     logger.info("Starting")
     return logger
+
+
+def stage_logger(name, recording_id):
+    """Logger for job stages that run on threads in the master process"""
+    logger = master_logger().getChild(f"{name}[{recording_id}]")
+    logger.setLevel(logging.INFO)
+    return logger
@@ -0,0 +1,212 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import logs
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+API_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+logger = logs.master_logger()
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=JOB_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            # one count per bucket plus one for values above the last bucket
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = format_labels(self.labels, key, ("le", format_value(bucket)))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {format_value(float(total))}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics %s - %s", self.address_string(), format % args)
+
+
+def serve(port, address="127.0.0.1"):
+    """Serve metrics in the Prometheus text format from a background thread"""
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving metrics on %s:%s", address, server.server_port)
+    return server
+
+
+POLLS = Counter(
+    "processing_polls_total",
+    "Polls for jobs by whether they found any",
+    ["type", "states", "result"],
+)
+JOBS_CLAIMED = Counter(
+    "processing_jobs_claimed_total", "Jobs claimed", ["type", "state"]
+)
+JOBS = Counter(
+    "processing_jobs_total",
+    "Jobs finished by result (succeeded, failed, cancelled or skipped)",
+    ["type", "state", "result"],
+)
+JOB_SECONDS = Histogram(
+    "processing_job_seconds",
+    "Time from claiming a job until it finished",
+    ["type", "state"],
+)
+STAGE_SECONDS = Histogram(
+    "processing_stage_seconds",
+    "Time jobs spent in each stage, ready is time waiting for a worker",
+    ["type", "state", "stage"],
+)
+IN_PROGRESS = Gauge(
+    "processing_jobs_in_progress",
+    "Jobs currently claimed by stage",
+    ["type", "state", "stage"],
+)
+WORKERS = Gauge("processing_workers", "Size of the shared worker pool")
+WORKERS_BUSY = Gauge("processing_workers_busy", "Workers running a job")
+API_SECONDS = Histogram(
+    "processing_api_request_seconds",
+    "API request latency",
+    ["method", "endpoint", "status"],
+    buckets=API_BUCKETS,
+)
+DOWNLOAD_MISMATCHES = Counter(
+    "processing_download_mismatches_total",
+    "Downloads that didn't match the recording's hash or size",
+)
+RECORDING_CACHE = Counter(
+    "processing_recording_cache_total",
+    "Recording cache lookups by whether the file was cached",
+    ["result"],
+)
+RECORDING_CACHE_BYTES = Gauge(
+    "processing_recording_cache_bytes", "Size of the recording cache"
+)
+RECORDING_CACHE_FILES = Gauge(
+    "processing_recording_cache_files", "Recordings in the recording cache"
+)
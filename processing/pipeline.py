@@ -0,0 +1,201 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import attr
+
+from .api import worker_api
+from . import journal
+from . import logs
+from . import stream
+from . import timing
+from .costmodel import MemoryPeak
+
+DOWNLOAD = "download"
+READY = "ready"
+COMPUTE = "compute"
+UPLOAD = "upload"
+STAGES = (DOWNLOAD, READY, COMPUTE, UPLOAD)
+
+
+@attr.s
+class JobStages:
+    """A job split into stages so network work doesn't hold a worker process.
+
+    download(api, recording, raw_jwt, conf, work_dir, logger) runs on a
+    download thread and returns the recording to pass on, or None if the job
+    needs no more work. compute(recording, conf) runs in a worker process and
+    upload(api, recording, result, conf, logger) posts what it returned from
+    an upload thread.
+
+    With hand_off set, upload returns the tracks it posted so the recording
+    and tracks can be kept for the analyse stage on this host, which gets them
+    from reuse(recording, handoff, work_dir, logger) instead of download.
+    """
+
+    name = attr.ib()
+    download = attr.ib()
+    compute = attr.ib()
+    upload = attr.ib()
+    hand_off = attr.ib(default=False)
+    reuse = attr.ib(default=None)
+
+    def run(self, recording, raw_jwt, conf):
+        """Run every stage one after the other in this process"""
+        logger = logs.worker_logger(self.name, recording["id"])
+        api = worker_api(conf, logger)
+        with tempfile.TemporaryDirectory(
+            dir=conf.temp_dir
+        ) as work_dir, timing.recording(timing.Timings()):
+            with timing.stage(DOWNLOAD):
+                recording = self.download(
+                    api, recording, raw_jwt, conf, work_dir, logger
+                )
+            if recording is None:
+                return
+            with timing.stage(COMPUTE):
+                result = self.compute(recording, conf)
+            with timing.stage(UPLOAD):
+                self.upload(api, recording, result, conf, logger)
+
+
+@attr.s
+class Job:
+    recording = attr.ib()
+    raw_jwt = attr.ib()
+    state = attr.ib(default=None)
+    stage = attr.ib(default=DOWNLOAD)
+    future = attr.ib(default=None)
+    work_dir = attr.ib(default=None)
+    result = attr.ib(default=None)
+    started = attr.ib(factory=time.time)
+    cost = attr.ib(default=None)
+    compute_started = attr.ib(default=None)
+    stage_started = attr.ib(factory=time.time)
+    timings = attr.ib(factory=timing.Timings)
+    streams = attr.ib(factory=list)
+
+    @property
+    def id(self):
+        return self.recording["id"]
+
+    @property
+    def job_key(self):
+        return self.recording["jobKey"]
+
+    def set_stage(self, stage):
+        self.stage = stage
+        self.stage_started = time.time()
+
+    def stage_finished(self):
+        """Record the time spent in the current stage, returning it"""
+        seconds = time.time() - self.stage_started
+        self.timings.add(self.stage, seconds)
+        return seconds
+
+
+class Pipeline:
+    """Runs job stages, downloads and uploads on their own thread pools and
+    compute on the shared worker pool."""
+
+    def __init__(self, api, pool, conf, journal=None, handoffs=None):
+        self.api = api
+        self.pool = pool
+        self.journal = journal
+        self.handoffs = handoffs
+        self.temp_dir = conf.temp_dir
+        self.stream_downloads = conf.stream_downloads
+        os.makedirs(self.temp_dir, exist_ok=True)
+        self.downloads = ThreadPoolExecutor(
+            conf.download_workers, thread_name_prefix="download"
+        )
+        self.uploads = ThreadPoolExecutor(
+            conf.upload_workers, thread_name_prefix="upload"
+        )
+
+    def download(self, job, stages, conf):
+        job.set_stage(DOWNLOAD)
+        job.future = self.downloads.submit(self._download, job, stages, conf)
+        return job.future
+
+    def _download(self, job, stages, conf):
+        job.work_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        logger = logs.stage_logger(f"{stages.name}.download", job.id)
+        handoff = None
+        if stages.reuse is not None and self.handoffs is not None:
+            handoff = self.handoffs.take(job.id)
+        streams = job.streams if self.stream_downloads else None
+        with timing.recording(job.timings), stream.deferring(streams):
+            if handoff is not None:
+                return stages.reuse(job.recording, handoff, job.work_dir, logger)
+            return stages.download(
+                self.api, job.recording, job.raw_jwt, conf, job.work_dir, logger
+            )
+
+    def compute(self, processor_id, job, stages, conf):
+        job.set_stage(COMPUTE)
+        job.compute_started = job.stage_started
+        job.future = self.pool.schedule(
+            processor_id, measured, (stages.compute, job.recording, conf)
+        )
+        # streamed downloads start once there is a worker to read them
+        for s in job.streams:
+            s.start(job.future.done)
+        return job.future
+
+    def upload(self, job, stages, conf):
+        job.set_stage(UPLOAD)
+        logger = logs.stage_logger(f"{stages.name}.upload", job.id)
+        job.future = self.uploads.submit(self._upload, job, stages, conf, logger)
+        return job.future
+
+    def _upload(self, job, stages, conf, logger):
+        for s in job.streams:
+            s.finish()
+        job.streams = []
+        with timing.recording(job.timings), journal.posting(self.journal, job.id):
+            tracks = stages.upload(self.api, job.recording, job.result, conf, logger)
+        if (
+            stages.hand_off
+            and tracks is not None
+            and self.handoffs is not None
+            and os.path.isfile(job.recording["filename"])
+        ):
+            try:
+                self.handoffs.keep(job.id, job.recording["filename"], tracks)
+            except OSError:
+                logger.warning("Couldn't keep recording for analysis", exc_info=True)
+
+    def cleanup(self, job):
+        if job.work_dir is not None:
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+            job.work_dir = None
+
+
+def measured(compute, recording, conf):
+    """Run a compute stage, returning its result, peak memory use in MB and
+    the timings recorded while it ran"""
+    with MemoryPeak() as memory, timing.recording(timing.Timings()) as timings:
+        result = compute(recording, conf)
+    return result, memory.peak_mb, timings.durations
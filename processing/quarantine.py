@@ -0,0 +1,153 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sqlite3
+import time
+from subprocess import CalledProcessError
+
+import requests
+
+from . import logs
+
+logger = logs.master_logger()
+
+DETERMINISTIC = "deterministic"
+TRANSIENT = "transient"
+
+# errors that will happen again however often the recording is retried
+DETERMINISTIC_ERRORS = (
+    ValueError,
+    KeyError,
+    IndexError,
+    TypeError,
+    AttributeError,
+    ZeroDivisionError,
+)
+# docker exit codes for problems with docker itself or the container being
+# killed (e.g. out of memory) rather than the command failing
+DOCKER_EXIT_CODES = (125, 126, 127, 137, 143)
+# client errors worth retrying
+RETRY_STATUS = (401, 408, 409, 429)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS failures (
+    recording_id INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    last REAL NOT NULL,
+    message TEXT,
+    PRIMARY KEY (recording_id, fingerprint)
+);
+"""
+
+
+def classify(err):
+    """Whether err is likely to happen again if the job is retried"""
+    if isinstance(err, CalledProcessError):
+        if err.returncode in DOCKER_EXIT_CODES or err.returncode < 0:
+            return TRANSIENT
+        return DETERMINISTIC
+    if isinstance(err, requests.exceptions.HTTPError):
+        status = getattr(err.response, "status_code", None)
+        if status is not None and 400 <= status < 500 and status not in RETRY_STATUS:
+            return DETERMINISTIC
+        return TRANSIENT
+    if isinstance(err, DETERMINISTIC_ERRORS):
+        return DETERMINISTIC
+    return TRANSIENT
+
+
+def fingerprint(err):
+    name = type(err).__name__
+    if isinstance(err, CalledProcessError):
+        return f"{name}:{err.returncode}"
+    if isinstance(err, requests.exceptions.HTTPError):
+        return f"{name}:{getattr(err.response, 'status_code', None)}"
+    return name
+
+
+class Quarantine:
+    """Remembers how recordings failed so ones that keep failing the same way
+    are skipped instead of being processed again.
+
+    Recordings failing with a deterministic error are skipped straight away.
+    Transient errors are retried with a growing delay, and the recording is
+    skipped once it has failed the same way max_failures times. Entries are
+    forgotten after expiry_secs so recordings are tried again eventually, e.g.
+    after a classifier fix.
+    """
+
+    def __init__(
+        self,
+        filename=None,
+        max_failures=3,
+        backoff_secs=300,
+        expiry_secs=7 * 24 * 60 * 60,
+    ):
+        self.max_failures = max_failures
+        self.backoff_secs = backoff_secs
+        self.expiry_secs = expiry_secs
+        self.db = sqlite3.connect(filename or ":memory:")
+        with self.db:
+            self.db.executescript(SCHEMA)
+
+    def failed(self, recording_id, err, now=None):
+        """Record a failure, returning the kind of error"""
+        if now is None:
+            now = time.time()
+        kind = classify(err)
+        with self.db:
+            self.db.execute(
+                "INSERT INTO failures VALUES (?, ?, ?, 1, ?, ?)"
+                " ON CONFLICT (recording_id, fingerprint) DO UPDATE"
+                " SET count = count + 1, last = excluded.last,"
+                " message = excluded.message",
+                (recording_id, fingerprint(err), kind, now, str(err)[:500]),
+            )
+        return kind
+
+    def succeeded(self, recording_id):
+        with self.db:
+            self.db.execute(
+                "DELETE FROM failures WHERE recording_id = ?", (recording_id,)
+            )
+
+    def skip(self, recording_id, now=None):
+        """Reason to skip recording_id, or None if it should be processed"""
+        if now is None:
+            now = time.time()
+        with self.db:
+            self.db.execute(
+                "DELETE FROM failures WHERE last < ?", (now - self.expiry_secs,)
+            )
+        rows = self.db.execute(
+            "SELECT fingerprint, kind, count, last FROM failures"
+            " WHERE recording_id = ?",
+            (recording_id,),
+        ).fetchall()
+        for fingerprint, kind, count, last in rows:
+            if kind == DETERMINISTIC:
+                return f"quarantined after {fingerprint}"
+            if count >= self.max_failures:
+                return f"quarantined after {count} failures with {fingerprint}"
+            retry_at = last + self.backoff_secs * 2 ** (count - 1)
+            if now < retry_at:
+                return f"backing off after {fingerprint} for {retry_at - now:.0f}s"
+        return None
@@ -0,0 +1,156 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import contextvars
+import errno
+import os
+import threading
+import time
+
+from . import logs
+from .cache import HASH_FIELD, SIZE_FIELD
+from .download import CHUNK_SIZE, DL_TIMEOUT, Digest, ShortRead
+
+logger = logs.master_logger()
+
+# formats the commands can read as they arrive, mp4 and m4a files can have
+# their index at the end
+STREAMABLE = (".cptv",)
+# how often to check whether the command has opened the pipe
+OPEN_POLL_SECS = 0.1
+
+_deferred = contextvars.ContextVar("streams", default=None)
+
+
+@contextlib.contextmanager
+def deferring(streams):
+    """Downloads of streamable files in this thread are added to streams,
+    rather than downloaded, when streams isn't None"""
+    token = _deferred.set(streams)
+    try:
+        yield
+    finally:
+        _deferred.reset(token)
+
+
+def deferrable(filename):
+    return _deferred.get() is not None and os.path.splitext(filename)[1] in STREAMABLE
+
+
+def defer(api, url, params, filename, recording):
+    """Put a named pipe where filename would be downloaded to, for the
+    download to be streamed through when the command runs. Returns False if
+    the download should happen now."""
+    if not deferrable(filename):
+        return False
+    os.mkfifo(filename)
+    _deferred.get().append(Stream(api, url, params, filename, recording))
+    return True
+
+
+class Stream:
+    """A download written into a named pipe for a command to read while it is
+    still arriving, and to a file that replaces the pipe once it finishes"""
+
+    def __init__(self, api, url, params, filename, recording):
+        self.api = api
+        self.url = url
+        self.params = params
+        self.filename = filename
+        self.recording = recording
+        self.partial = f"{filename}.partial"
+        self.thread = None
+        self.error = None
+        self.digest = Digest()
+
+    def start(self, finished):
+        """Start streaming, finished() being true once the command has exited
+        so the pipe won't be read"""
+        self.thread = threading.Thread(
+            target=self.run, args=(finished,), name="stream", daemon=True
+        )
+        self.thread.start()
+
+    def run(self, finished):
+        pipe = None
+        try:
+            pipe = self.open_pipe(finished)
+            r = self.api.session.get(
+                self.url, params=self.params, stream=True, timeout=DL_TIMEOUT
+            )
+            r.raise_for_status()
+            with open(self.partial, "wb") as f:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    self.digest.update(chunk)
+                    if pipe is not None:
+                        try:
+                            pipe.write(chunk)
+                        except BrokenPipeError:
+                            # the command stopped reading, finish the file
+                            pipe = None
+            expected = r.headers.get("Content-Length")
+            if (
+                expected is not None
+                and "Content-Encoding" not in r.headers
+                and self.digest.size != int(expected)
+            ):
+                raise ShortRead(f"Got {self.digest.size} of {expected} bytes")
+        except Exception as e:
+            logger.error("Streaming %s failed: %s", self.filename, e)
+            self.error = e
+        finally:
+            if pipe is not None:
+                # the command sees the end of the file
+                with contextlib.suppress(BrokenPipeError):
+                    pipe.close()
+
+    def open_pipe(self, finished):
+        """Open the pipe once the command opens it for reading, or None if the
+        command finished without opening it"""
+        while True:
+            try:
+                fd = os.open(self.filename, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                # no reader yet
+                if e.errno != errno.ENXIO:
+                    raise
+                if finished():
+                    return None
+                time.sleep(OPEN_POLL_SECS)
+                continue
+            os.set_blocking(fd, True)
+            return os.fdopen(fd, "wb", buffering=0)
+
+    def finish(self):
+        """Wait for the download and put the file where the pipe was. The
+        command has already read it, so a file that doesn't match the
+        recording's hash or size fails the job rather than being downloaded
+        again"""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.recording is not None:
+            self.digest.check(
+                self.recording.get(HASH_FIELD), self.recording.get(SIZE_FIELD)
+            )
+        os.replace(self.partial, self.filename)
+        if self.api.cache is not None and self.recording is not None:
+            self.api.cache.add(self.recording, self.filename, self.digest.hexdigest)
@@ -20,13 +20,12 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 import attr
 import json
 import subprocess
-import tempfile
 import socket
 import math
+import shutil
 from pathlib import Path
 import numpy as np
 
-from . import API
 from . import logs
 from .processutils import HandleCalledProcessError
 from .tagger import (
@@ -42,7 +41,10 @@ from .tagger import (
     MASTER_TAG,
     PREDICTIONS,
 )
+from .api import Results
 from .config import ModelConfig
+from .pipeline import JobStages
+from .timing import stage
 
 DOWNLOAD_FILENAME = "recording"
 SLEEP_SECS = 10
@@ -51,32 +53,68 @@ FRAME_RATE = 9
 MIN_TRACK_CONFIDENCE = 0.85
 
 
-def tracking_job(recording, rawJWT, conf):
+def download_recording(api, recording, rawJWT, work_dir, logger):
+    ext = ".mp4" if recording.get("type") == "irRaw" else ".cptv"
+    filename = (Path(work_dir) / DOWNLOAD_FILENAME).with_suffix(ext)
+    recording["filename"] = str(filename)
+    logger.debug("downloading recording")
+    api.download_file(rawJWT, str(filename), recording)
+    return filename
+
+
+def write_metadata(recording):
+    meta_filename = Path(recording["filename"]).with_suffix(".txt")
+    with meta_filename.open("w") as f:
+        json.dump(recording, f)
+
+
+def get_tracks(api, recording):
+    track_info = api.get_track_info(recording["id"]).get("tracks")
+    for track in track_info:
+        track["start_s"] = track["start"]
+        track["end_s"] = track["end"]
+        track["positions"] = track["positions"]
+    return track_info
+
+
+def is_retrack(recording):
+    return recording["processingState"] == "retrack"
+
+
+def download_tracking(api, recording, rawJWT, conf, work_dir, logger):
+    download_recording(api, recording, rawJWT, work_dir, logger)
+    if is_retrack(recording):
+        recording["tracks"] = get_tracks(api, recording)
+        write_metadata(recording)
+    return recording
+
+
+def run_tracking(recording, conf):
     logger = logs.worker_logger("tracking", recording["id"])
-    retrack = recording["processingState"] == "retrack"
-    api = API(conf.api_url, conf.user, conf.password, logger)
-    mp4 = recording.get("type") == "irRaw"
-    with tempfile.TemporaryDirectory(dir=conf.temp_dir) as temp_dir:
-        ext = ".mp4" if mp4 else ".cptv"
-        filename = Path(temp_dir) / DOWNLOAD_FILENAME
-        filename = filename.with_suffix(ext)
-        recording["filename"] = str(filename)
-        logger.debug("downloading recording")
-        api.download_file(rawJWT, str(filename))
-        if retrack:
-            track_info = api.get_track_info(recording["id"]).get("tracks")
-            for t in track_info:
-                t["start_s"] = t["start"]
-                t["end_s"] = t["end"]
-                t["positions"] = t["positions"]
-            recording["tracks"] = track_info
-            filename = filename.with_suffix(".txt")
-            with filename.open("w") as f:
-                json.dump(recording, f)
-        track(conf, recording, api, recording.get("duration", 0), retrack, logger)
+    return run_tracker(
+        conf, recording, recording.get("duration", 0), is_retrack(recording), logger
+    )
+
+
+def upload_tracking(api, recording, tracking_info, conf, logger):
+    return post_tracking(api, recording, tracking_info, is_retrack(recording), logger)
+
+
+TRACKING = JobStages(
+    "tracking", download_tracking, run_tracking, upload_tracking, hand_off=True
+)
+
+
+def tracking_job(recording, rawJWT, conf):
+    TRACKING.run(recording, rawJWT, conf)
 
 
 def track(conf, recording, api, duration, retrack, logger):
+    tracking_info = run_tracker(conf, recording, duration, retrack, logger)
+    post_tracking(api, recording, tracking_info, retrack, logger)
+
+
+def run_tracker(conf, recording, duration, retrack, logger):
     cache = (
         duration is not None
         and conf.cache_clips_bigger_than
@@ -90,7 +128,10 @@ def track(conf, recording, api, duration, retrack, logger):
         temp_dir=conf.temp_dir,
     )
     logger.info("tracking %s", recording["filename"])
-    tracking_info = run_command(command, recording["filename"], conf.subprocess_timeout)
+    return run_command(command, recording["filename"], conf.subprocess_timeout)
+
+
+def post_tracking(api, recording, tracking_info, retrack, logger):
     format_track_data(tracking_info["tracks"])
     algorithm_id = api.get_algorithm_id(tracking_info["algorithm"])
     tracks = []
@@ -98,16 +139,18 @@ def track(conf, recording, api, duration, retrack, logger):
         tracks.append(Track.load(t))
 
     tracking_result = ClassifyResult.load(tracking_info, algorithm_id, tracks)
+    results = Results(recording)
     for track in tracking_result.tracks:
         if retrack:
             if len(track.positions) == 0:
-                api.archive_track(recording, track.id)
+                results.archive_track(recording, track.id)
             else:
                 api.update_track(recording, track)
         else:
-            track.id = api.add_track(
+            track.id = results.add_track(
                 recording, track, tracking_result.tracking_algorithm
             )
+    api.submit_results(results)
     additionalMetadata = {"algorithm": tracking_result.tracking_algorithm}
     if tracking_result.tracking_time is not None:
         additionalMetadata["tracking_time"] = tracking_result.tracking_time
@@ -117,55 +160,94 @@ def track(conf, recording, api, duration, retrack, logger):
     metadata = {"additionalMetadata": additionalMetadata}
     api.report_done(recording, None, None, metadata)
     logger.info("Finished tracking")
+    # the tracks as get_tracks would fetch them, for analysing on this host
+    return [
+        track.info()
+        for track in tracking_result.tracks
+        if not retrack or len(track.positions) > 0
+    ]
 
 
-def track_classify_job(recording, rawJWT, conf):
+def download_track_classify(api, recording, rawJWT, conf, work_dir, logger):
+    download_recording(api, recording, rawJWT, work_dir, logger)
+    write_metadata(recording)
+    return recording
+
+
+def run_track_classify(recording, conf):
     logger = logs.worker_logger("track_classify_job", recording["id"])
+    return run_classifier(conf, recording, logger, do_tracking=True)
 
-    api = API(conf.api_url, conf.user, conf.password, logger)
-    mp4 = recording.get("type") == "irRaw"
-    ext = ".mp4" if mp4 else ".cptv"
 
-    with tempfile.TemporaryDirectory(dir=conf.temp_dir) as temp_dir:
-        filename = Path(temp_dir) / DOWNLOAD_FILENAME
-        filename = filename.with_suffix(ext)
-        recording["filename"] = str(filename)
-        logger.debug("downloading recording")
-        api.download_file(rawJWT, str(filename))
-        meta_filename = (Path(temp_dir) / DOWNLOAD_FILENAME).with_suffix(".txt")
+def upload_track_classify(api, recording, classify_info, conf, logger):
+    post_classification(api, recording, classify_info, conf, logger, do_tracking=True)
 
-        with open(str(meta_filename), "w") as f:
-            json.dump(recording, f)
-        classify(conf, recording, api, logger, do_tracking=True)
 
+TRACK_CLASSIFY = JobStages(
+    "track_classify_job",
+    download_track_classify,
+    run_track_classify,
+    upload_track_classify,
+)
 
-def classify_job(recording, rawJWT, conf):
+
+def track_classify_job(recording, rawJWT, conf):
+    TRACK_CLASSIFY.run(recording, rawJWT, conf)
+
+
+def download_classify(api, recording, rawJWT, conf, work_dir, logger):
+    download_recording(api, recording, rawJWT, work_dir, logger)
+    recording["tracks"] = get_tracks(api, recording)
+    write_metadata(recording)
+    return recording
+
+
+def run_classify(recording, conf):
     logger = logs.worker_logger("classify", recording["id"])
+    return run_classifier(conf, recording, logger)
+
+
+def upload_classify(api, recording, classify_info, conf, logger):
+    post_classification(api, recording, classify_info, conf, logger)
 
-    api = API(conf.api_url, conf.user, conf.password, logger)
-    mp4 = recording.get("type") == "irRaw"
-    ext = ".mp4" if mp4 else ".cptv"
-
-    with tempfile.TemporaryDirectory(dir=conf.temp_dir) as temp_dir:
-        filename = Path(temp_dir) / DOWNLOAD_FILENAME
-        filename = filename.with_suffix(ext)
-        recording["filename"] = str(filename)
-        logger.debug("downloading recording")
-        api.download_file(rawJWT, str(filename))
-        meta_filename = (Path(temp_dir) / DOWNLOAD_FILENAME).with_suffix(".txt")
-        track_info = api.get_track_info(recording["id"]).get("tracks")
-        for track in track_info:
-            track["start_s"] = track["start"]
-            track["end_s"] = track["end"]
-            track["positions"] = track["positions"]
-        recording["tracks"] = track_info
-        with open(str(meta_filename), "w") as f:
-            json.dump(recording, f)
-        classify(conf, recording, api, logger)
+
+def reuse_classify(recording, handoff, work_dir, logger):
+    """Classify the recording and tracks this host just tracked"""
+    filename = (Path(work_dir) / DOWNLOAD_FILENAME).with_suffix(
+        Path(handoff.filename).suffix
+    )
+    shutil.move(handoff.filename, filename)
+    recording["filename"] = str(filename)
+    recording["tracks"] = handoff.tracks
+    write_metadata(recording)
+    logger.debug("using recording and tracks from tracking on this host")
+    return recording
+
+
+CLASSIFY = JobStages(
+    "classify",
+    download_classify,
+    run_classify,
+    upload_classify,
+    reuse=reuse_classify,
+)
+
+
+def classify_job(recording, rawJWT, conf):
+    CLASSIFY.run(recording, rawJWT, conf)
 
 
 def classify_file(
     api, file, conf, duration, logger, do_tracking=False, calculate_thumbnails=False
+):
+    classify_info = run_classify_command(
+        file, conf, duration, logger, do_tracking, calculate_thumbnails
+    )
+    return load_classify_result(api, classify_info, conf, do_tracking)
+
+
+def run_classify_command(
+    file, conf, duration, logger, do_tracking=False, calculate_thumbnails=False
 ):
     cache = False
     if (
@@ -186,7 +268,10 @@ def classify_file(
     if calculate_thumbnails:
         command = f"{command} --calculate-thumbnails"
     logger.info("Classifying %s with command %s", file, command)
-    classify_info = run_command(command, file, conf.subprocess_timeout)
+    return run_command(command, file, conf.subprocess_timeout)
+
+
+def load_classify_result(api, classify_info, conf, do_tracking=False):
     tracks = []
     for t in classify_info["tracks"]:
         tracks.append(Track.load(t))
@@ -215,7 +300,7 @@ def read_all(socket):
 
 
 def run_command(command, filename, timeout=None):
-    with HandleCalledProcessError():
+    with HandleCalledProcessError(), stage("command"):
         proc = subprocess.run(
             command,
             shell=True,
@@ -251,19 +336,32 @@ def fp_score(track):
 
 
 def classify(conf, recording, api, logger, do_tracking=False):
-    wallaby_device = is_wallaby_device(conf.wallaby_devices, recording)
+    classify_info = run_classifier(conf, recording, logger, do_tracking)
+    post_classification(api, recording, classify_info, conf, logger, do_tracking)
+
+
+def run_classifier(conf, recording, logger, do_tracking=False):
     logger.debug("processing %s ", recording["filename"])
-    calculate_thumbnails = recording.get("metadataSource") == "PI"
-    classify_result = classify_file(
-        api,
+    return run_classify_command(
         recording["filename"],
         conf,
         recording.get("duration", 0),
         logger,
         do_tracking=do_tracking,
-        calculate_thumbnails=calculate_thumbnails,
+        calculate_thumbnails=needs_thumbnails(recording),
     )
 
+
+def needs_thumbnails(recording):
+    return recording.get("metadataSource") == "PI"
+
+
+def post_classification(api, recording, classify_info, conf, logger, do_tracking=False):
+    wallaby_device = is_wallaby_device(conf.wallaby_devices, recording)
+    calculate_thumbnails = needs_thumbnails(recording)
+    classify_result = load_classify_result(api, classify_info, conf, do_tracking)
+    results = Results(recording)
+
     generate_master_tags(
         api,
         recording,
@@ -278,7 +376,7 @@ def classify(conf, recording, api, logger, do_tracking=False):
         for track in classify_result.tracks:
             for prediction in track.predictions:
                 add_track_tag(
-                    api,
+                    results,
                     recording,
                     track,
                     prediction,
@@ -287,7 +385,7 @@ def classify(conf, recording, api, logger, do_tracking=False):
                 )
 
             add_track_tag(
-                api,
+                results,
                 recording,
                 track,
                 track.master_tag,
@@ -322,7 +420,7 @@ def classify(conf, recording, api, logger, do_tracking=False):
                 )
             if fp_pred and not do_tracking:
                 confidence = min(confidence, fp_pred.confidence)
-                api.archive_track(recording, track.id)
+                results.archive_track(recording, track.id)
             else:
                 good_tracks.append(track)
         if len(good_tracks) == 0 and len(classify_result.tracks) > 0:
@@ -348,7 +446,7 @@ def classify(conf, recording, api, logger, do_tracking=False):
         # once we remove tracking step can remove this
         if not do_tracking:
             for track in ordered[conf.max_tracks :]:
-                api.archive_track(recording, track.id)
+                results.archive_track(recording, track.id)
         classify_result.tracks = ordered[: conf.max_tracks]
 
     # if doing tracking and anlaysis in one step, only create and tag important tracks
@@ -357,12 +455,12 @@ def classify(conf, recording, api, logger, do_tracking=False):
             if calculate_thumbnails:
                 api.update_track_thumbnail(recording, track)
             elif do_tracking:
-                track.id = api.add_track(
+                track.id = results.add_track(
                     recording, track, classify_result.tracking_algorithm
                 )
                 for prediction in track.predictions:
                     add_track_tag(
-                        api,
+                        results,
                         recording,
                         track,
                         prediction,
@@ -371,7 +469,7 @@ def classify(conf, recording, api, logger, do_tracking=False):
                     )
 
                 add_track_tag(
-                    api,
+                    results,
                     recording,
                     track,
                     track.master_tag,
@@ -390,6 +488,7 @@ def classify(conf, recording, api, logger, do_tracking=False):
             {"event": MULTIPLE, CONFIDENCE: multiple_confidence},
         )
 
+    api.submit_results(results)
     additionalMetadata = {"algorithm": classify_result.tracking_algorithm}
     if classify_result.tracking_time is not None:
         additionalMetadata["tracking_time"] = classify_result.tracking_time
@@ -640,6 +739,14 @@ class Track:
 
         return data
 
+    def info(self):
+        """The track as the API returns it from get_track_info"""
+        data = self.post_data()
+        data["id"] = self.id
+        data["start"] = data["start_s"]
+        data["end"] = data["end_s"]
+        return data
+
 
 @attr.s
 class Prediction:
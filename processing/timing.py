@@ -0,0 +1,111 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import contextvars
+import functools
+import json
+import threading
+import time
+
+_current = contextvars.ContextVar("timings", default=None)
+
+
+class Timings:
+    """Seconds spent in each named stage of a job, repeated stages add up"""
+
+    def __init__(self, durations=None):
+        self.durations = dict(durations or {})
+        # API calls for a job can run on several threads at once
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.durations[name] = self.durations.get(name, 0) + seconds
+
+    def update(self, durations):
+        for name, seconds in durations.items():
+            self.add(name, seconds)
+
+    def as_dict(self):
+        return {name: round(seconds, 3) for name, seconds in self.durations.items()}
+
+
+def current():
+    return _current.get()
+
+
+@contextlib.contextmanager
+def recording(timings):
+    """Make timings the one stages are recorded to in this thread"""
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def stage(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings = current()
+        if timings is not None:
+            timings.add(name, time.time() - start)
+
+
+def timed(func):
+    """Record the time spent in func as a stage with its name"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def with_timings(metadata):
+    """Add the current timings to report_done metadata"""
+    timings = current()
+    if timings is None:
+        return metadata
+    metadata.setdefault("additionalMetadata", {})["timings"] = timings.as_dict()
+    return metadata
+
+
+class TimingLog:
+    """Appends one compact JSON line of stage timings per job"""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def write(self, job, recording_type, result):
+        line = {
+            "id": job.id,
+            "type": recording_type,
+            "state": job.state,
+            "result": result,
+            "finished": round(time.time()),
+            "timings": job.timings.as_dict(),
+        }
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(line, separators=(",", ":")) + "\n")
@@ -0,0 +1,245 @@
+"""
+cacophony-processing - this is a server side component that runs alongside
+the Cacophony Project API, performing post-upload processing tasks.
+Copyright (C) 2019, The Cacophony Project
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import CancelledError
+
+from pebble import ProcessExpired, ProcessPool
+
+from . import logs
+
+logger = logs.master_logger()
+
+# exit code of a worker retired by a recycle, pebble replaces workers that
+# exit with an error
+RETIRED_EXIT_CODE = 3
+# how long to wait before trying again when a retire lands on a new worker
+# because the old ones are busy
+RETIRE_RETRY_SECS = 5
+# give up after this many retries in a row, the workers left may have been
+# replaced after max_tasks already
+RETIRE_MAX_MISSES = 60
+
+# when this worker process started, to tell it apart from workers started
+# after a recycle
+_worker_started = None
+
+
+def init_worker(log_q):
+    global _worker_started
+    _worker_started = time.time()
+    logs.init_worker(log_q)
+
+
+def retire(recycle_started):
+    """Run in a worker, exiting it if it was started before the recycle.
+    Returns False for a worker that is already new."""
+    if _worker_started < recycle_started:
+        os._exit(RETIRED_EXIT_CODE)
+    return False
+
+
+class WorkerPool:
+    """A process pool shared by every processor.
+
+    Each processor registers a quota, which is the number of workers it is
+    guaranteed and also its weight. Processors with nothing to do don't hold on
+    to their quota, so a busy processor can borrow those idle workers. The
+    total number of running jobs never goes over max_workers, and when several
+    processors are busy the workers are split between them by weight.
+
+    The pool starts size worker processes, at least max_workers, so the
+    autoscaler can move max_workers up to size without starting a new pool.
+    """
+
+    def __init__(self, max_workers=None, log_q=None, max_tasks=0, size=None):
+        self.max_workers = max_workers
+        self.log_q = log_q
+        self.max_tasks = max_tasks
+        self.pool = None
+        # number of worker processes in the pool
+        self.size = size
+        # when the recycle in progress started, and workers it has replaced
+        self.recycling = None
+        self.retired = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.quotas = {}
+        self.in_use = {}
+        self.backlog = {}
+
+    def register(self, processor_id, quota):
+        self.quotas[processor_id] = quota
+        self.in_use[processor_id] = 0
+        self.backlog[processor_id] = False
+
+    def set_quota(self, processor_id, quota):
+        self.quotas[processor_id] = quota
+
+    def start(self):
+        if self.max_workers is None:
+            self.max_workers = sum(self.quotas.values())
+        self.size = max(self.size or 0, self.max_workers)
+        self.pool = self.new_pool()
+
+    def resize(self, max_workers=None):
+        """Change how many jobs can run at once. The pool is only replaced
+        when it needs more workers than it has, running jobs are left to
+        finish on the old workers. Returns True if the size changed."""
+        if max_workers is None:
+            max_workers = sum(self.quotas.values())
+        if max_workers == self.max_workers:
+            return False
+        self.max_workers = max_workers
+        if max_workers > self.size:
+            self.size = max_workers
+            self.replace()
+        return True
+
+    def new_pool(self):
+        # with max_tasks set each worker is replaced after that many jobs
+        return ProcessPool(
+            self.size,
+            max_tasks=self.max_tasks,
+            initializer=init_worker,
+            initargs=(self.log_q,),
+        )
+
+    def replace(self):
+        """Swap the pool for a new one without interrupting running jobs.
+
+        New jobs go to the new pool, while each old worker exits once it has
+        finished the job it is running.
+        """
+        old = self.pool
+        self.pool = self.new_pool()
+        with self.lock:
+            # every worker is new
+            self.recycling = None
+        old.close()
+        threading.Thread(target=old.join, daemon=True).start()
+
+    def recycle(self):
+        """Replace the worker processes one at a time without interrupting
+        running jobs.
+
+        A task that exits its worker if it is older than the recycle is run
+        one at a time, and the pool starts a new worker in place of each one
+        that exits, so the other workers carry on running jobs meanwhile.
+        """
+        with self.lock:
+            in_progress = self.recycling is not None
+            self.recycling = time.time()
+            self.retired = 0
+            self.misses = 0
+        if not in_progress:
+            self.retire_next()
+
+    def retire_next(self):
+        with self.lock:
+            started = self.recycling
+        if started is None:
+            return
+        try:
+            future = self.pool.schedule(retire, (started,))
+        except RuntimeError:
+            # the pool was closed
+            self.recycling = None
+            return
+        future.add_done_callback(self.retire_done)
+
+    def retire_done(self, future):
+        try:
+            future.result()
+        except ProcessExpired:
+            with self.lock:
+                self.retired += 1
+                self.misses = 0
+                finished = self.retired >= self.size
+                if finished:
+                    self.recycling = None
+            if finished:
+                logger.info("Recycled all %s workers", self.size)
+            else:
+                self.retire_next()
+            return
+        except (CancelledError, RuntimeError):
+            # the pool was closed
+            with self.lock:
+                self.recycling = None
+            return
+        # a new worker got it, the old ones left are busy
+        with self.lock:
+            self.misses += 1
+            if self.misses >= RETIRE_MAX_MISSES:
+                logger.info("Recycled %s of %s workers", self.retired, self.size)
+                self.recycling = None
+                return
+        timer = threading.Timer(RETIRE_RETRY_SECS, self.retire_next)
+        timer.daemon = True
+        timer.start()
+
+    def running(self):
+        return sum(self.in_use.values())
+
+    def set_backlog(self, processor_id, backlog):
+        self.backlog[processor_id] = backlog
+
+    def active(self, processor_id):
+        return self.backlog[processor_id] or self.in_use[processor_id] > 0
+
+    def usage(self, processor_id):
+        """Running jobs relative to quota, used to decide who gets workers first"""
+        return self.in_use[processor_id] / max(self.quotas[processor_id], 1)
+
+    def free_slots(self, processor_id, pending=0):
+        """How many more jobs processor_id can start now.
+
+        pending is the number of slots already promised to other processors
+        that haven't been scheduled yet.
+        """
+        quota = self.quotas[processor_id]
+        in_use = self.in_use[processor_id]
+        # keep unused quota of other busy processors free for them
+        reserved = sum(
+            max(0, self.quotas[other] - self.in_use[other])
+            for other in self.quotas
+            if other != processor_id and self.active(other)
+        )
+        free = self.max_workers - self.running() - pending
+        guaranteed = quota - in_use
+        borrowable = free - reserved
+
+        active_quota = quota + sum(
+            self.quotas[other]
+            for other in self.quotas
+            if other != processor_id and self.active(other)
+        )
+        fair_share = max(quota, round(self.max_workers * quota / active_quota))
+        slots = max(guaranteed, min(borrowable, fair_share - in_use))
+        return max(0, min(slots, free))
+
+    def schedule(self, processor_id, func, args):
+        self.in_use[processor_id] += 1
+        return self.pool.schedule(func, args)
+
+    def finished(self, processor_id):
+        self.in_use[processor_id] = max(0, self.in_use[processor_id] - 1)
@@ -0,0 +1,388 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+import pytest
+import requests
+
+from processing import journal
+from processing.api import (
+    API,
+    NO_HINTS,
+    PollHints,
+    Results,
+    ResultsError,
+    TokenCache,
+    make_session,
+    merge_hints,
+    parse_poll_hints,
+)
+from processing.cache import RecordingCache
+from processing.journal import Journal
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(response=self)
+
+
+def make_api(responses):
+    api = API.__new__(API)
+    api.file_url = "http://localhost/api/v1/processing"
+    api.logger = logging.getLogger("test")
+    api._batch_claim = True
+    api._multi_poll = True
+    api._bulk_results = True
+    api.post_workers = 2
+    api.writers = ThreadPoolExecutor(2)
+    api.cache = None
+    api.requested = []
+
+    def request(url, **args):
+        api.requested.append(url)
+        r = responses.pop(0)
+        r.raise_for_status()
+        return r
+
+    api.get = request
+    api.post = request
+    return api
+
+
+def job(rec_id):
+    return {"recording": {"id": rec_id}, "rawJWT": "jwt"}
+
+
+def test_next_jobs_batch():
+    api = make_api([FakeResponse(200, {"jobs": [job(1), job(2)]})])
+    jobs, _ = api.next_jobs("thermalRaw", "analyse", 4)
+    assert [j["recording"]["id"] for j in jobs] == [1, 2]
+    assert api.requested == [api.file_url + "/batch"]
+
+
+def test_next_jobs_falls_back_to_single_claims():
+    api = make_api(
+        [
+            FakeResponse(404),
+            FakeResponse(200, job(1)),
+            FakeResponse(200, job(2)),
+            FakeResponse(204),
+        ]
+    )
+    jobs, _ = api.next_jobs("thermalRaw", "analyse", 4)
+    assert [j["recording"]["id"] for j in jobs] == [1, 2]
+    assert not api._batch_claim
+
+    # fallback is remembered so the batch endpoint isn't tried again
+    api.requested = []
+    api.get = make_api([FakeResponse(204)]).get
+    assert api.next_jobs("thermalRaw", "analyse", 4) == ([], NO_HINTS)
+
+
+def test_next_jobs_no_free_slots():
+    api = make_api([])
+    assert api.next_jobs("thermalRaw", "analyse", 0) == ([], NO_HINTS)
+
+
+def test_poll_jobs():
+    api = make_api([FakeResponse(200, {"jobs": [job(1)]})])
+    wanted = [{"type": "audio", "states": ["analyse"], "limit": 2}]
+    assert api.poll_jobs(wanted) == ([job(1)], NO_HINTS)
+
+
+def test_poll_jobs_unsupported():
+    api = make_api([FakeResponse(404)])
+    wanted = [{"type": "audio", "states": ["analyse"], "limit": 2}]
+    assert api.poll_jobs(wanted)[0] is None
+    # not asked again once the server has said no
+    assert api.poll_jobs(wanted)[0] is None
+    assert len(api.requested) == 1
+
+
+def test_parse_poll_hints():
+    r = FakeResponse(200)
+    r.headers = {"Retry-After": "30", "X-Queue-Depth": "12"}
+    assert parse_poll_hints(r) == PollHints(30, 12)
+    r.headers = {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    assert parse_poll_hints(r) == PollHints(0, None)
+    r.headers = {}
+    assert parse_poll_hints(r) == PollHints(None, None)
+
+
+def test_throttled_poll():
+    r = FakeResponse(503)
+    r.headers = {"Retry-After": "120"}
+    api = make_api([r])
+    api._batch_claim = False
+    assert api.next_jobs("audio", "analyse", 2) == ([], PollHints(120, None))
+
+
+def test_merge_hints():
+    assert merge_hints(PollHints(30, 2), PollHints(None, 3)) == PollHints(30, 5)
+    assert merge_hints(NO_HINTS, PollHints(60, None)) == PollHints(60, None)
+    assert merge_hints(NO_HINTS, NO_HINTS) == NO_HINTS
+
+
+class FakeTrack:
+    id = 5
+
+    def post_data(self):
+        return {"start_s": 1}
+
+
+def test_add_track_not_posted_twice_after_restart(tmp_path):
+    recording = {"id": 1}
+    store = Journal(str(tmp_path / "journal.sqlite"))
+    api = make_api([FakeResponse(200, {"trackId": 10})])
+    with journal.posting(store, 1):
+        assert api.add_track(recording, FakeTrack(), 2) == 10
+    # the restarted upload gets the same id without posting again
+    with journal.posting(store, 1):
+        assert api.add_track(recording, FakeTrack(), 2) == 10
+    assert len(api.requested) == 1
+
+
+def test_identical_tracks_both_posted(tmp_path):
+    recording = {"id": 1}
+    store = Journal(str(tmp_path / "journal.sqlite"))
+    api = make_api(
+        [FakeResponse(200, {"trackId": 10}), FakeResponse(200, {"trackId": 11})]
+    )
+    with journal.posting(store, 1):
+        assert api.add_track(recording, FakeTrack(), 2) == 10
+        assert api.add_track(recording, FakeTrack(), 2) == 11
+    assert len(api.requested) == 2
+    # after a restart each gets its own id back
+    with journal.posting(store, 1):
+        assert api.add_track(recording, FakeTrack(), 2) == 10
+        assert api.add_track(recording, FakeTrack(), 2) == 11
+    assert len(api.requested) == 2
+
+
+def test_download_file_uses_cache(tmp_path):
+    api = make_api([])
+    api.cache = RecordingCache(str(tmp_path / "cache"), 1)
+    fetched = []
+
+    sha1 = hashlib.sha1(b"cptv").hexdigest()
+
+    def fetch_file(token, filename, recording=None):
+        fetched.append(token)
+        with open(filename, "wb") as f:
+            f.write(b"cptv")
+        return sha1
+
+    api.fetch_file = fetch_file
+    recording = {"id": 1}
+    api.download_file("jwt", str(tmp_path / "first.cptv"), recording)
+    api.download_file("jwt", str(tmp_path / "second.cptv"), recording)
+    assert fetched == ["jwt"]
+    assert (tmp_path / "second.cptv").read_bytes() == b"cptv"
+    # cached under the sha1 the download returned
+    assert os.listdir(tmp_path / "cache") == [f"1-{sha1}.cptv"]
+
+
+def test_login_uses_cached_token(tmp_path, monkeypatch):
+    token = jwt.encode(
+        {"exp": time.time() + 3600, "iat": time.time()}, "s" * 32, algorithm="HS256"
+    )
+    logins = []
+
+    def get_jwt(self):
+        logins.append(self.user)
+        return "JWT " + token
+
+    monkeypatch.setattr(API, "_get_jwt", get_jwt)
+    cache = TokenCache(str(tmp_path / "token.json"))
+    first = API("http://localhost", "user", "password", logging.getLogger(), cache)
+    second = API("http://localhost", "user", "password", logging.getLogger(), cache)
+    assert logins == ["user"]
+    assert second.auth_header == first.auth_header
+
+    second.login(use_cache=False)
+    assert logins == ["user", "user"]
+
+
+def test_retries_once_after_401():
+    api = make_api([])
+    api._expiry = time.time() + 60
+    api._token = "JWT old"
+    logins = []
+
+    def login(use_cache=True):
+        logins.append(use_cache)
+        api._token = "JWT new"
+
+    api.login = login
+    responses = [FakeResponse(401), FakeResponse(200)]
+    sent = []
+
+    def put(url, **args):
+        sent.append(args["headers"].get("Authorization"))
+        return responses.pop(0)
+
+    r = api.retry_if_auth(put, "http://localhost/x", {"headers": {}})
+    assert r.status_code == 200
+    assert logins == [False]
+    assert sent == [None, "JWT new"]
+
+
+def test_session_retries_server_errors():
+    statuses = [500, 502, 200]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(statuses.pop(0))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        session = make_session(retries=3, backoff_factor=0)
+        r = session.get(f"http://127.0.0.1:{server.server_port}/")
+        assert r.status_code == 200
+        assert statuses == []
+    finally:
+        server.shutdown()
+
+
+def test_session_returns_throttled_responses():
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.path)
+            self.send_response(429)
+            self.send_header("Retry-After", "60")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        session = make_session(retries=3, backoff_factor=0)
+        start = time.monotonic()
+        r = session.get(f"http://127.0.0.1:{server.server_port}/")
+        assert r.status_code == 429
+        assert r.headers["Retry-After"] == "60"
+        assert len(requests_seen) == 1
+        assert time.monotonic() - start < 5
+    finally:
+        server.shutdown()
+
+
+class ResultTrack:
+    def __init__(self):
+        self.id = None
+
+    def post_data(self):
+        return {"start_s": 0, "end_s": 1}
+
+
+class FakePrediction:
+    tag = "possum"
+    confidence = 0.9
+
+
+def recording_results():
+    recording = {"id": 1}
+    results = Results(recording)
+    track = ResultTrack()
+    track.id = results.add_track(recording, track, 3)
+    results.add_track_tag(recording, track.id, FakePrediction(), {"name": "Master"})
+    results.archive_track(recording, 7)
+    return track, results
+
+
+def test_submit_results_together():
+    api = make_api([FakeResponse(200, {"trackIds": [5]})])
+    track, results = recording_results()
+    api.submit_results(results)
+    assert api.requested == [api.file_url + "/1/results"]
+    assert track.id == 5
+
+
+def test_submit_results_singly():
+    api = make_api(
+        [
+            FakeResponse(404),
+            FakeResponse(200, {"trackId": 5}),
+            FakeResponse(200, {"trackTagId": 6}),
+            FakeResponse(200),
+        ]
+    )
+    track, results = recording_results()
+    api.submit_results(results)
+    assert track.id == 5
+    assert api.requested == [
+        api.file_url + "/1/results",
+        api.file_url + "/1/tracks",
+        api.file_url + "/1/tracks/5/tags",
+        api.file_url + "/1/tracks/7/archive",
+    ]
+    assert not api._bulk_results
+
+
+def test_submit_results_for_deleted_recording():
+    api = make_api([FakeResponse(404), FakeResponse(404)])
+    _, results = recording_results()
+    results.tags = []
+    results.archived = []
+    with pytest.raises(ResultsError):
+        api.submit_results(results)
+    # the recording was gone rather than the endpoint
+    assert api._bulk_results
+
+
+def test_post_results_singly_aggregates_errors():
+    api = make_api([])
+    posted = []
+    lock = threading.Lock()
+
+    def post(url, **args):
+        with lock:
+            posted.append(url)
+        if url.endswith("/tracks"):
+            return FakeResponse(200, {"trackId": 10 + len(results.tracks)})
+        if url.endswith("/2/tags"):
+            raise requests.exceptions.HTTPError(response=FakeResponse(500))
+        return FakeResponse(200, {"trackTagId": 1})
+
+    api.post = post
+    recording = {"id": 1}
+    results = Results(recording)
+    track = ResultTrack()
+    track.id = results.add_track(recording, track, 3)
+    for _ in range(3):
+        results.add_track_tag(recording, track.id, FakePrediction())
+    results.add_track_tag(recording, 2, FakePrediction())
+    results.archive_track(recording, 2)
+    try:
+        api.post_results_singly(results)
+    except ResultsError as e:
+        assert len(e.errors) == 1
+    else:
+        raise AssertionError("expected a ResultsError")
+    assert posted[0] == api.file_url + "/1/tracks"
+    assert posted.count(api.file_url + "/1/tracks/11/tags") == 3
+    assert posted[-1] == api.file_url + "/1/tracks/2/archive"
@@ -0,0 +1,50 @@
+from processing.autoscale import Autoscaler
+
+
+class FakePool:
+    def __init__(self, max_workers, running):
+        self.max_workers = max_workers
+        self.in_use = running
+
+    def running(self):
+        return self.in_use
+
+    def resize(self, max_workers):
+        self.max_workers = max_workers
+
+
+def test_scale_up_on_backlog():
+    scaler = Autoscaler(1, 4, memory_reserve_mb=0)
+    size, _ = scaler.decide(2, 2, 3, 10, 8, 0.5, 10000)
+    assert size == 3
+
+
+def test_stays_within_bounds():
+    scaler = Autoscaler(2, 4, memory_reserve_mb=0)
+    assert scaler.decide(4, 4, 3, 10, 8, 0.5, 10000)[0] == 4
+    assert scaler.decide(2, 0, 0, 10, 0, 0.1, 10000)[0] == 2
+
+
+def test_no_scale_up_when_loaded():
+    scaler = Autoscaler(1, 4, memory_reserve_mb=0)
+    assert scaler.decide(2, 2, 3, 10, 8, 1.0, 10000)[0] == 2
+    assert scaler.decide(2, 2, 3, 10, 8, 2.0, 10000)[0] == 1
+
+
+def test_scale_down_on_low_memory():
+    scaler = Autoscaler(1, 4, memory_reserve_mb=1024)
+    assert scaler.decide(3, 3, 3, 10, 8, 0.5, 500)[0] == 2
+
+
+def test_scale_down_when_idle():
+    scaler = Autoscaler(1, 4, memory_reserve_mb=0)
+    assert scaler.decide(3, 1, 0, 10, 0, 0.1, 10000)[0] == 2
+    assert scaler.decide(3, 2, 0, 10, 0, 0.1, 10000)[0] == 3
+
+
+def test_update_waits_for_interval():
+    scaler = Autoscaler(1, 8, interval=60, memory_reserve_mb=0)
+    pool = FakePool(4, 0)
+    assert not scaler.update(pool, 0, 10, 0, now=scaler.last_update + 30)
+    assert scaler.update(pool, 0, 10, 0, now=scaler.last_update + 60)
+    assert pool.max_workers == 3
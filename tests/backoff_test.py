@@ -0,0 +1,51 @@
+from processing.backoff import PollBackoff
+
+
+def test_grows_while_empty():
+    backoff = PollBackoff(10, 100, jitter=0)
+    delays = [backoff.polled(False, now=0) for _ in range(5)]
+    assert delays == [10, 20, 40, 80, 100]
+
+
+def test_resets_on_job():
+    backoff = PollBackoff(10, 100, jitter=0)
+    backoff.polled(False, now=0)
+    backoff.polled(False, now=10)
+    assert backoff.polled(True, now=30) == 0
+    assert backoff.next_poll == 30
+    assert backoff.polled(False, now=30) == 10
+
+
+def test_jitter():
+    backoff = PollBackoff(10, 100, jitter=0.2)
+    for _ in range(20):
+        backoff.reset()
+        assert 8 <= backoff.polled(False, now=0) <= 12
+
+
+def test_capped_by_arrival_interval():
+    backoff = PollBackoff(10, 1000, jitter=0)
+    backoff.polled(True, now=0)
+    backoff.polled(True, now=60)
+    delays = [backoff.polled(False, now=60) for _ in range(5)]
+    assert delays == [10, 20, 40, 60, 60]
+
+
+def test_retry_after():
+    backoff = PollBackoff(10, 100, jitter=0)
+    assert backoff.polled(False, retry_after=50, now=0) == 50
+    assert backoff.next_poll == 50
+
+
+def test_queue_depth():
+    backoff = PollBackoff(10, 100, jitter=0)
+    backoff.polled(False, now=0)
+    assert backoff.polled(False, queue_depth=3, now=10) == 0
+
+
+def test_long_idle_stays_at_max_delay():
+    backoff = PollBackoff(0.5, 300, jitter=0)
+    for _ in range(5000):
+        delay = backoff.polled(False, now=0)
+    assert delay == 300
+    assert backoff.empty_polls < 20
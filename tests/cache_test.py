@@ -0,0 +1,62 @@
+import os
+
+from processing.cache import RecordingCache, file_hash
+
+
+def downloaded(tmp_path, data, name="recording.cptv"):
+    filename = tmp_path / name
+    filename.write_bytes(data)
+    return str(filename)
+
+
+def test_hit_and_miss(tmp_path):
+    cache = RecordingCache(str(tmp_path / "cache"), 1)
+    recording = {"id": 1}
+    target = str(tmp_path / "copy.cptv")
+    assert not cache.get(recording, target)
+
+    sha1 = cache.add(recording, downloaded(tmp_path, b"cptv"))
+    assert sha1 == file_hash(str(tmp_path / "recording.cptv"))
+    assert cache.get(recording, target)
+    assert open(target, "rb").read() == b"cptv"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_stale_hash(tmp_path):
+    cache = RecordingCache(str(tmp_path / "cache"), 1)
+    cache.add({"id": 1}, downloaded(tmp_path, b"cptv"))
+    target = str(tmp_path / "copy.cptv")
+    assert not cache.get({"id": 1, "rawFileHash": "other"}, target)
+    assert os.listdir(tmp_path / "cache") == []
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = RecordingCache(str(tmp_path / "cache"), 1)
+    data = b"x" * (400 * 1024)
+    for recording_id in range(2):
+        cache.add({"id": recording_id}, downloaded(tmp_path, data))
+    cache.get({"id": 0}, str(tmp_path / "copy.cptv"))
+    cache.add({"id": 2}, downloaded(tmp_path, data))
+    assert list(cache.files) == [0, 2]
+    assert len(os.listdir(tmp_path / "cache")) == 2
+
+
+def test_survives_restart(tmp_path):
+    cache = RecordingCache(str(tmp_path / "cache"), 1)
+    cache.add({"id": 1}, downloaded(tmp_path, b"cptv"))
+    cache = RecordingCache(str(tmp_path / "cache"), 1)
+    assert cache.size == 4
+    assert cache.get({"id": 1}, str(tmp_path / "copy.cptv"))
+
+
+def test_restart_removes_partial_copies(tmp_path):
+    cache = RecordingCache(str(tmp_path / "cache"), 1)
+    sha1 = cache.add({"id": 1}, downloaded(tmp_path, b"cptv"))
+    # crashed while caching recording 1 again and recording 2
+    (tmp_path / "cache" / f"1-{sha1}.cptv.partial").write_bytes(b"cp")
+    (tmp_path / "cache" / f"2-{sha1}.cptv.partial").write_bytes(b"cptvc")
+    cache = RecordingCache(str(tmp_path / "cache"), 1)
+    assert list(cache.files) == [1]
+    assert cache.size == 4
+    assert not cache.get({"id": 2}, str(tmp_path / "copy.cptv"))
+    assert os.listdir(tmp_path / "cache") == [f"1-{sha1}.cptv"]
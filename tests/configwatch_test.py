@@ -0,0 +1,46 @@
+import os
+import shutil
+from pathlib import Path
+
+from processing import Config
+from processing.configwatch import ConfigWatcher, changed_options
+
+TEMPLATE = Path(__file__).parent.parent / "processing_TEMPLATE.yaml"
+
+
+def make_watcher(tmp_path):
+    filename = tmp_path / "processing.yaml"
+    shutil.copy(TEMPLATE, filename)
+    return ConfigWatcher(str(filename)), filename
+
+
+def test_unchanged(tmp_path):
+    watcher, _ = make_watcher(tmp_path)
+    assert not watcher.changed()
+
+
+def test_modified(tmp_path):
+    watcher, filename = make_watcher(tmp_path)
+    os.utime(filename, (0, 0))
+    assert watcher.changed()
+    assert not watcher.changed()
+
+
+def test_requested(tmp_path):
+    watcher, _ = make_watcher(tmp_path)
+    watcher.request()
+    assert watcher.changed()
+    assert not watcher.changed()
+
+
+def test_reload_keeps_credentials(tmp_path):
+    watcher, filename = make_watcher(tmp_path)
+    current = Config.load_from(filename)
+    current.api_credentials.user = "from-args"
+    text = filename.read_text().replace("trail_workers: 1", "trail_workers: 3")
+    filename.write_text(text)
+
+    conf = watcher.load(current)
+    assert conf.trail_workers == 3
+    assert conf.user == "from-args"
+    assert changed_options(current, conf) == ["trail_workers"]
@@ -0,0 +1,175 @@
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from processing.coordinator import Coordinator, CoordinatorClient, serve
+
+WANTED = [{"type": "thermalRaw", "states": ["analyse"], "limit": 2}]
+
+
+class FakeAPI:
+    def __init__(self, durations):
+        self.jobs = [
+            {
+                "recording": {
+                    "id": i,
+                    "type": "thermalRaw",
+                    "processingState": "analyse",
+                    "duration": duration,
+                },
+                "rawJWT": "jwt",
+            }
+            for i, duration in enumerate(durations, 1)
+        ]
+
+    def poll_jobs(self, wanted):
+        limit = wanted[0]["limit"]
+        jobs, self.jobs = self.jobs[:limit], self.jobs[limit:]
+        return jobs, None
+
+
+def ids(jobs):
+    return [job["recording"]["id"] for job in jobs]
+
+
+def test_lease_expires_without_heartbeat():
+    coordinator = Coordinator(FakeAPI([10, 10]), lease_secs=60)
+    assert ids(coordinator.lease("a", WANTED, now=0)) == [1, 2]
+    assert coordinator.heartbeat("a", [1], now=50) == []
+    assert ids(coordinator.lease("b", WANTED, now=70)) == [2]
+    assert coordinator.heartbeat("a", [1, 2], now=70) == [2]
+
+
+def test_long_clips_go_to_big_hosts():
+    coordinator = Coordinator(FakeAPI([10, 1000, 20]))
+    assert ids(coordinator.lease("small", WANTED, max_duration=60, now=0)) == [1]
+    assert ids(coordinator.lease("big", WANTED, now=0)) == [2, 3]
+
+
+def test_release():
+    coordinator = Coordinator(FakeAPI([10]), lease_secs=60)
+    coordinator.lease("a", WANTED, now=0)
+    coordinator.release("a", 1)
+    assert coordinator.leases == {}
+    assert coordinator.lease("b", WANTED, now=100) == []
+
+
+def run_host(address, results):
+    client = CoordinatorClient(address)
+    while True:
+        jobs, _ = client.poll_jobs(WANTED)
+        if not jobs:
+            break
+        for job in jobs:
+            results.put(job["recording"]["id"])
+            client.release(job["recording"]["id"])
+    client.close()
+
+
+def test_hosts_share_jobs_without_overlap():
+    server = serve(Coordinator(FakeAPI([10] * 30)), "127.0.0.1:0")
+    address = "127.0.0.1:{}".format(server.server_address[1])
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    hosts = [
+        context.Process(target=run_host, args=(address, results)) for _ in range(3)
+    ]
+    try:
+        for host in hosts:
+            host.start()
+        leased = sorted(results.get(timeout=10) for _ in range(30))
+        for host in hosts:
+            host.join(timeout=10)
+    finally:
+        server.shutdown()
+    assert leased == list(range(1, 31))
+
+
+def test_client_collects_lost_leases():
+    coordinator = Coordinator(FakeAPI([10]), lease_secs=60)
+    server = serve(coordinator, "127.0.0.1:0")
+    client = CoordinatorClient("127.0.0.1:{}".format(server.server_address[1]))
+    try:
+        assert ids(client.poll_jobs(WANTED)[0]) == [1]
+        client.heartbeat()
+        assert client.take_lost() == set()
+        # another host took over the job
+        coordinator.leases[1].host = "other"
+        client.heartbeat()
+        assert client.take_lost() == {1}
+        assert client.leases == set()
+    finally:
+        client.close()
+        server.shutdown()
+
+
+def test_secret():
+    server = serve(Coordinator(FakeAPI([10])), "127.0.0.1:0", secret="s3cret")
+    address = "127.0.0.1:{}".format(server.server_address[1])
+    try:
+        with pytest.raises(IOError, match="unauthorized"):
+            CoordinatorClient(address).poll_jobs(WANTED)
+        with pytest.raises(IOError, match="unauthorized"):
+            CoordinatorClient(address, secret="wrong").poll_jobs(WANTED)
+        jobs, _ = CoordinatorClient(address, secret="s3cret").poll_jobs(WANTED)
+        assert ids(jobs) == [1]
+    finally:
+        server.shutdown()
+
+
+def test_heartbeat_not_held_up_by_claim():
+    api = FakeAPI([10])
+    claiming = threading.Event()
+    release = threading.Event()
+    poll_jobs = api.poll_jobs
+
+    def slow_poll_jobs(wanted):
+        claiming.set()
+        release.wait(5)
+        return poll_jobs(wanted)
+
+    api.poll_jobs = slow_poll_jobs
+    coordinator = Coordinator(api, lease_secs=60)
+    leased = []
+    thread = threading.Thread(
+        target=lambda: leased.extend(coordinator.lease("a", WANTED))
+    )
+    thread.start()
+    assert claiming.wait(5)
+    start = time.time()
+    assert coordinator.heartbeat("b", []) == []
+    assert time.time() - start < 1
+    release.set()
+    thread.join()
+    assert ids(leased) == [1]
+
+
+def test_no_more_claimed_than_host_can_take():
+    api = FakeAPI([1000, 1000, 10])
+    coordinator = Coordinator(api)
+    assert coordinator.lease("small", WANTED, max_duration=60, now=0) == []
+    # the long clips still waiting count against what small can take
+    assert coordinator.lease("small", WANTED, max_duration=60, now=0) == []
+    assert len(coordinator.pending) == 2
+    assert ids(coordinator.lease("big", WANTED, now=0)) == [1, 2]
+    assert ids(coordinator.lease("small", WANTED, max_duration=60, now=0)) == [3]
+
+
+def test_unclaimed_jobs_are_dropped():
+    api = FakeAPI([1000, 1000, 10])
+    coordinator = Coordinator(api, pending_secs=300)
+    assert coordinator.lease("small", WANTED, max_duration=60, now=0) == []
+    assert ids(coordinator.lease("big", WANTED, now=400)) == [3]
+    assert coordinator.pending == []
+
+
+def test_expired_lease_keeps_its_claim_time():
+    coordinator = Coordinator(FakeAPI([10, 10]), lease_secs=60, pending_secs=300)
+    assert ids(coordinator.lease("a", WANTED, now=0)) == [1, 2]
+    for now in range(50, 300, 50):
+        assert coordinator.heartbeat("a", [1, 2], now=now) == []
+    # expires at 310, by when it was claimed too long ago to hand out again
+    assert coordinator.lease("b", WANTED, now=320) == []
+    assert coordinator.pending == []
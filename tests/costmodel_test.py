@@ -0,0 +1,46 @@
+import time
+
+from processing.costmodel import CostModel, Cost, DEFAULT_RUNTIME
+from processing.pipeline import Job
+
+
+def test_default_cost():
+    costs = CostModel(memory_budget_mb=1000)
+    assert costs.predict("tracking", {"duration": 10}).runtime == DEFAULT_RUNTIME
+
+
+def test_learns_from_duration():
+    costs = CostModel(memory_budget_mb=1000)
+    for duration in range(10, 100, 10):
+        costs.observe("tracking", {"duration": duration}, duration * 2, 100 + duration)
+    cost = costs.predict("tracking", {"duration": 200})
+    assert round(cost.runtime) == 400
+    assert round(cost.memory_mb) == 300
+    # other job types are learnt separately
+    assert costs.predict("classify", {"duration": 200}).runtime == DEFAULT_RUNTIME
+
+
+def test_short_jobs_first():
+    costs = CostModel(memory_budget_mb=1000)
+    for duration in range(10, 100, 10):
+        costs.observe("tracking", {"duration": duration}, duration, 100)
+    long_job = Job({"id": 1, "duration": 90}, "jwt")
+    short_job = Job({"id": 2, "duration": 10}, "jwt")
+    ordered = sorted([long_job, short_job], key=lambda j: costs.priority(j, "tracking"))
+    assert ordered == [short_job, long_job]
+
+    # until the long job has waited long enough
+    long_job.started = time.time() - 100
+    ordered = sorted([long_job, short_job], key=lambda j: costs.priority(j, "tracking"))
+    assert ordered == [long_job, short_job]
+
+
+def test_admission():
+    costs = CostModel(memory_budget_mb=1000)
+    big = Cost(10, 800)
+    assert costs.admit(big)
+    costs.started(1, big)
+    assert not costs.admit(Cost(10, 300))
+    assert costs.admit(Cost(10, 200))
+    costs.finished(1)
+    assert costs.admit(Cost(10, 2000))
@@ -0,0 +1,105 @@
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from processing.download import Downloader, Mismatch
+
+DATA = os.urandom(300 * 1024)
+SHA1 = hashlib.sha1(DATA).hexdigest()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ranges = True
+    # cut off the first request for each part after drop_after bytes
+    drop_after = None
+    dropped = set()
+    requests = []
+
+    def do_GET(self):
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        self.requests.append(self.headers.get("Range"))
+        if self.ranges and match:
+            start, end = int(match.group(1)), min(int(match.group(2)), len(DATA) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(DATA)}")
+        else:
+            start, end = 0, len(DATA) - 1
+            self.send_response(200)
+        body = DATA[start : end + 1]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.drop_after is not None and end not in self.dropped:
+            self.dropped.add(end)
+            self.wfile.write(body[: self.drop_after])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.requests = []
+    Handler.dropped = set()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server, f"http://127.0.0.1:{server.server_port}/file"
+    server.shutdown()
+    Handler.ranges = True
+    Handler.drop_after = None
+
+
+def test_parallel_parts(server, tmp_path):
+    _, url = server
+    filename = tmp_path / "file"
+    sha1 = Downloader(connections=4, part_mb=0.1).download(
+        url, filename, sha1=SHA1, size=len(DATA)
+    )
+    assert filename.read_bytes() == DATA
+    assert sha1 == SHA1
+    assert len(Handler.requests) == 3
+
+
+def test_server_without_ranges(server, tmp_path):
+    _, url = server
+    Handler.ranges = False
+    filename = tmp_path / "file"
+    sha1 = Downloader(connections=4, part_mb=0.1).download(url, filename)
+    assert filename.read_bytes() == DATA
+    assert sha1 == SHA1
+
+
+def test_resumes_interrupted_parts(server, tmp_path, monkeypatch):
+    monkeypatch.setattr("processing.download.RETRY_SLEEP_SECS", 0)
+    _, url = server
+    Handler.drop_after = 5000
+    filename = tmp_path / "file"
+    sha1 = Downloader(connections=2, part_mb=0.1, chunk_size=512).download(
+        url, filename
+    )
+    assert filename.read_bytes() == DATA
+    assert sha1 == SHA1
+    # the interrupted parts carry on from where they got to
+    starts = [int(r[len("bytes=") :].split("-")[0]) for r in Handler.requests]
+    part_size = int(0.1 * 1024**2)
+    assert len([start for start in starts if start % part_size]) == 3
+
+
+def test_downloads_again_on_mismatch(server, tmp_path):
+    _, url = server
+    filename = tmp_path / "file"
+    with pytest.raises(Mismatch):
+        Downloader(connections=4, part_mb=0.1, retries=1).download(
+            url, filename, sha1="0" * 40
+        )
+    # three parts for each of the two attempts
+    assert len(Handler.requests) == 6
+    with pytest.raises(Mismatch):
+        Downloader(retries=0).download(url, filename, size=len(DATA) + 1)
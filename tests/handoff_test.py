@@ -0,0 +1,40 @@
+import os
+
+from processing.handoff import Handoffs
+
+
+def recording_file(tmp_path, name="recording.cptv"):
+    work_dir = tmp_path / "work"
+    work_dir.mkdir(exist_ok=True)
+    filename = work_dir / name
+    filename.write_bytes(b"cptv")
+    return str(filename)
+
+
+def test_keep_and_take(tmp_path):
+    handoffs = Handoffs(str(tmp_path / "handoff"), expiry_secs=60)
+    filename = recording_file(tmp_path)
+    handoffs.keep(1, filename, [{"id": 10}], now=0)
+    assert not os.path.exists(filename)
+
+    handoff = handoffs.take(1, now=30)
+    assert handoff.tracks == [{"id": 10}]
+    assert handoff.filename.endswith("1.cptv")
+    assert os.path.exists(handoff.filename)
+    assert handoffs.take(1, now=30) is None
+
+
+def test_expires(tmp_path):
+    handoffs = Handoffs(str(tmp_path / "handoff"), expiry_secs=60)
+    handoffs.keep(1, recording_file(tmp_path), [], now=0)
+    kept = handoffs.handoffs[1].filename
+    assert handoffs.take(1, now=60) is None
+    assert not os.path.exists(kept)
+
+
+def test_oldest_dropped_over_max(tmp_path):
+    handoffs = Handoffs(str(tmp_path / "handoff"), max_handoffs=2)
+    for recording_id in range(3):
+        handoffs.keep(recording_id, recording_file(tmp_path), [], now=0)
+    assert list(handoffs.handoffs) == [1, 2]
+    assert sorted(os.listdir(tmp_path / "handoff")) == ["1.cptv", "2.cptv"]
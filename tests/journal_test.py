@@ -0,0 +1,61 @@
+from processing import journal
+from processing.journal import Journal
+from processing.pipeline import Job
+
+
+def make_job():
+    return Job({"id": 1, "jobKey": "key"}, "jwt", "analyse")
+
+
+def test_resume_from_last_stage(tmp_path):
+    filename = str(tmp_path / "journal.sqlite")
+    store = Journal(filename)
+    job = make_job()
+    store.claimed(job, "thermalRaw")
+    job.recording["filename"] = "recording.cptv"
+    job.work_dir = str(tmp_path)
+    store.downloaded(job)
+    job.result = {"tracks": []}
+    store.computed(job)
+    store.close()
+
+    entries = Journal(filename).entries()
+    assert len(entries) == 1
+    entry = entries[0]
+    assert (entry.id, entry.type, entry.state) == (1, "thermalRaw", "analyse")
+    assert entry.stage == "computed"
+    assert entry.recording["filename"] == "recording.cptv"
+    assert entry.work_dir == str(tmp_path)
+    assert entry.result == {"tracks": []}
+
+
+def test_finished(tmp_path):
+    store = Journal(str(tmp_path / "journal.sqlite"))
+    job = make_job()
+    store.claimed(job, "thermalRaw")
+    store.record_posted(job.id, "track", 10)
+    store.finished(job.id)
+    assert store.entries() == []
+    assert store.posted(job.id, "track") is None
+
+
+def test_result_that_cant_be_stored(tmp_path):
+    store = Journal(str(tmp_path / "journal.sqlite"))
+    job = make_job()
+    store.claimed(job, "thermalRaw")
+    job.result = object()
+    store.computed(job)
+    assert store.entries()[0].stage == "claimed"
+
+
+def test_posting(tmp_path):
+    store = Journal(str(tmp_path / "journal.sqlite"))
+    assert journal.already_posted("key") is None
+    with journal.posting(store, 1):
+        journal.record_posted("key", 10)
+        assert journal.already_posted("key") == 10
+    with journal.posting(store, 2):
+        assert journal.already_posted("key") is None
+    # nothing is recorded outside of a job
+    journal.record_posted("other", 11)
+    assert store.posted(1, "other") is None
@@ -0,0 +1,334 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+import main
+from processing import Config, pipeline
+from processing.api import NO_HINTS, PollHints
+from processing.costmodel import CostModel
+from processing.pipeline import JobStages
+from processing.quarantine import Quarantine
+from processing.workerpool import WorkerPool
+
+TEMPLATE = Path(__file__).parent.parent / "processing_TEMPLATE.yaml"
+
+
+def job(rec_id, recording_type="thermalRaw", state="tracking"):
+    return {
+        "recording": {
+            "id": rec_id,
+            "type": recording_type,
+            "processingState": state,
+            "jobKey": f"key{rec_id}",
+        },
+        "rawJWT": "jwt",
+    }
+
+
+class FakeAPI:
+    def __init__(self):
+        # (recording type, state) to a function returning (jobs, hints)
+        self.claims = {}
+        self.multiplexed = None
+        self.failed = []
+
+    def poll_jobs(self, wanted):
+        if self.multiplexed is None:
+            return None, NO_HINTS
+        return self.multiplexed(wanted)
+
+    def next_jobs(self, recording_type, state, max_jobs):
+        claim = self.claims.get((recording_type, state))
+        if claim is None:
+            return [], NO_HINTS
+        return claim()
+
+    def report_failed(self, rec_id, job_key):
+        self.failed.append(rec_id)
+
+
+class InlinePool:
+    """Runs compute stages on threads in place of worker processes"""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(4)
+
+    def schedule(self, func, args):
+        return self.executor.submit(func, *args)
+
+
+def download(api, recording, raw_jwt, conf, work_dir, logger):
+    return recording
+
+
+def compute(recording, conf):
+    return recording["id"]
+
+
+def upload(api, recording, result, conf, logger):
+    api.uploaded.append(result)
+
+
+STAGES = JobStages("test", download, compute, upload)
+
+
+@pytest.fixture
+def processors(tmp_path, monkeypatch):
+    conf = Config.load_from(TEMPLATE)._replace(
+        temp_dir=str(tmp_path), poll_timeout_secs=0.5, journal_file=None
+    )
+    api = FakeAPI()
+    api.uploaded = []
+    pool = WorkerPool(2)
+    pool.pool = InlinePool()
+    poller = ThreadPoolExecutor(4)
+    for name, value in {
+        "conf": conf,
+        "api": api,
+        "claimer": api,
+        "pool": pool,
+        "pipeline": pipeline.Pipeline(api, pool, conf),
+        "costs": CostModel(memory_budget_mb=None),
+        "quarantine": Quarantine(),
+        "poller": poller,
+        "late_polls": queue.Queue(),
+        "completed": queue.SimpleQueue(),
+        "coordinator": None,
+        "journal": None,
+        "draining": False,
+    }.items():
+        monkeypatch.setattr(main.Processor, name, value)
+    processors = main.Processors()
+    processors.add("thermalRaw", ["tracking"], STAGES, "thermal_tracking_workers")
+    processors.add("audio", ["analyse"], STAGES, "audio_analysis_workers")
+    yield processors
+    poller.shutdown(wait=False, cancel_futures=True)
+
+
+def finish_jobs(processors, timeout=5):
+    deadline = time.time() + timeout
+    while any(p.has_work() for p in processors) and time.time() < deadline:
+        processors.wait(0.1)
+
+
+def test_each_processor_gets_its_own_poll_hints(processors):
+    thermal, audio = processors
+    api = main.Processor.api
+    api.claims[("thermalRaw", "tracking")] = lambda: ([job(1)], PollHints(None, 5))
+    api.claims[("audio", "analyse")] = lambda: ([], PollHints(60, None))
+    now = time.time()
+    processors.poll_all()
+    assert list(thermal.in_progress) == [1]
+    # the queue depth means thermal polls again straight away
+    assert thermal.backoff.next_poll < now + 5
+    assert audio.backoff.next_poll >= now + 59
+    finish_jobs(processors)
+    assert api.uploaded == [1]
+
+
+def test_multiplexed_poll(processors):
+    thermal, audio = processors
+    api = main.Processor.api
+    api.multiplexed = lambda wanted: (
+        [job(1), job(2, "audio", "analyse")],
+        PollHints(30, None),
+    )
+    now = time.time()
+    processors.poll_all()
+    assert list(thermal.in_progress) == [1]
+    assert list(audio.in_progress) == [2]
+    assert audio.backoff.next_poll >= now + 29
+    finish_jobs(processors)
+    assert sorted(api.uploaded) == [1, 2]
+
+
+def test_slow_poll_is_scheduled_when_it_returns(processors):
+    thermal, audio = processors
+    api = main.Processor.api
+    release = threading.Event()
+
+    def slow_claim():
+        release.wait(10)
+        return [job(1)], NO_HINTS
+
+    api.claims[("thermalRaw", "tracking")] = slow_claim
+    api.claims[("audio", "analyse")] = lambda: (
+        [job(2, "audio", "analyse")],
+        NO_HINTS,
+    )
+    start = time.time()
+    processors.poll_all()
+    # the slow poll doesn't hold up the other processor
+    assert time.time() - start < 5
+    assert list(audio.in_progress) == [2]
+    assert thermal.late_poll and not thermal.should_poll()
+
+    release.set()
+    deadline = time.time() + 5
+    while 1 not in thermal.in_progress and time.time() < deadline:
+        processors.wait(0.1)
+        processors.schedule_late_polls()
+    assert 1 in thermal.in_progress
+    finish_jobs(processors)
+    assert not thermal.late_poll
+    assert sorted(api.uploaded) == [1, 2]
+
+
+class FakeCoordinator:
+    def __init__(self):
+        self.released = []
+
+    def release(self, lease_id):
+        self.released.append(lease_id)
+
+
+def test_skipped_job_releases_its_lease(processors, monkeypatch):
+    thermal, _ = processors
+    coordinator = FakeCoordinator()
+    monkeypatch.setattr(main.Processor, "coordinator", coordinator)
+    monkeypatch.setattr(main.Processor.quarantine, "skip", lambda rec_id: "failed")
+    assert not thermal.schedule(job(1), "tracking")
+    assert coordinator.released == [1]
+    assert main.Processor.api.failed == [1]
+
+
+def test_duplicate_keeps_lease_of_running_job(processors, monkeypatch):
+    thermal, _ = processors
+    coordinator = FakeCoordinator()
+    monkeypatch.setattr(main.Processor, "coordinator", coordinator)
+    release = threading.Event()
+    monkeypatch.setattr(
+        thermal,
+        "stages",
+        JobStages("test", lambda *args: release.wait(5) and args[1], compute, upload),
+    )
+    assert thermal.schedule(job(1), "tracking")
+    # a running download can't be cancelled
+    time.sleep(0.1)
+    assert not thermal.schedule(job(1), "tracking")
+    assert coordinator.released == []
+    release.set()
+    finish_jobs(processors)
+    assert coordinator.released == [1]
+
+
+def stages(fail=None, download_result=True, work_dirs=None):
+    """Stages that fail in the stage named fail, remembering work dirs"""
+
+    def check(stage):
+        if stage == fail:
+            raise ValueError(f"{stage} failed")
+
+    def download(api, recording, raw_jwt, conf, work_dir, logger):
+        if work_dirs is not None:
+            work_dirs.append(work_dir)
+        check(pipeline.DOWNLOAD)
+        return recording if download_result else None
+
+    def compute(recording, conf):
+        check(pipeline.COMPUTE)
+        return recording["id"]
+
+    def upload(api, recording, result, conf, logger):
+        check(pipeline.UPLOAD)
+        api.uploaded.append(result)
+
+    return JobStages("test", download, compute, upload)
+
+
+def test_job_runs_through_every_stage(processors, monkeypatch):
+    thermal, _ = processors
+    work_dirs = []
+    monkeypatch.setattr(thermal, "stages", stages(work_dirs=work_dirs))
+    thermal.schedule(job(1), "tracking")
+    job_1 = thermal.in_progress[1]
+    seen = []
+    deadline = time.time() + 5
+    while thermal.has_work() and time.time() < deadline:
+        if job_1.stage not in seen:
+            seen.append(job_1.stage)
+        processors.wait(0.01)
+    assert seen[0] == pipeline.DOWNLOAD and seen[-1] == pipeline.UPLOAD
+    assert main.Processor.api.uploaded == [1]
+    assert set(job_1.timings.durations) >= {
+        pipeline.DOWNLOAD,
+        pipeline.READY,
+        pipeline.COMPUTE,
+        pipeline.UPLOAD,
+    }
+    assert not os.path.exists(work_dirs[0])
+    assert main.Processor.pool.running() == 0
+
+
+def test_download_returning_none_finishes_job(processors, monkeypatch):
+    thermal, _ = processors
+    monkeypatch.setattr(thermal, "stages", stages(download_result=False))
+    thermal.schedule(job(1), "tracking")
+    finish_jobs(processors)
+    assert not thermal.has_work()
+    assert main.Processor.api.uploaded == []
+    assert main.Processor.api.failed == []
+
+
+@pytest.mark.parametrize(
+    "stage", [pipeline.DOWNLOAD, pipeline.COMPUTE, pipeline.UPLOAD]
+)
+def test_failed_stage(processors, monkeypatch, stage):
+    thermal, _ = processors
+    work_dirs = []
+    monkeypatch.setattr(thermal, "stages", stages(fail=stage, work_dirs=work_dirs))
+    thermal.schedule(job(1), "tracking")
+    finish_jobs(processors)
+    assert not thermal.has_work()
+    assert main.Processor.api.failed == [1]
+    assert main.Processor.api.uploaded == []
+    assert not os.path.exists(work_dirs[0])
+    # the worker and its memory are given back
+    assert main.Processor.pool.running() == 0
+    assert main.Processor.costs.running == {}
+
+
+def test_finished_job_wakes_main_loop(processors, monkeypatch):
+    thermal, _ = processors
+    release = threading.Event()
+
+    def download(api, recording, raw_jwt, conf, work_dir, logger):
+        release.wait(5)
+        return None
+
+    monkeypatch.setattr(thermal, "stages", JobStages("test", download, compute, upload))
+    thermal.schedule(job(1), "tracking")
+    threading.Timer(0.2, release.set).start()
+    start = time.time()
+    processors.wait(30)
+    # woken by the job finishing rather than the timeout, and it was reaped
+    assert time.time() - start < 5
+    assert not thermal.has_work()
+
+
+def test_wait_times_out_without_jobs(processors):
+    start = time.time()
+    processors.wait(0.2)
+    assert time.time() - start >= 0.2
+
+
+@pytest.mark.parametrize("multiplexed", [False, True])
+def test_quarantined_jobs_dont_reset_backoff(processors, monkeypatch, multiplexed):
+    thermal, _ = processors
+    api = main.Processor.api
+    monkeypatch.setattr(main.Processor.quarantine, "skip", lambda rec_id: "failed")
+    if multiplexed:
+        api.multiplexed = lambda wanted: ([job(1)], NO_HINTS)
+    else:
+        api.claims[("thermalRaw", "tracking")] = lambda: ([job(1)], NO_HINTS)
+    now = time.time()
+    processors.poll_all()
+    assert api.failed == [1]
+    assert not thermal.has_work()
+    assert thermal.backoff.empty_polls == 1
+    assert thermal.backoff.next_poll > now
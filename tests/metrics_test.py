@@ -0,0 +1,53 @@
+import urllib.request
+
+from processing import metrics
+from processing.api import endpoint
+
+
+def test_counter():
+    counter = metrics.Counter("test_total", "A test counter", ["type"])
+    counter.inc(type="audio")
+    counter.inc(2, type="audio")
+    assert counter.render() == [
+        "# HELP test_total A test counter",
+        "# TYPE test_total counter",
+        'test_total{type="audio"} 3',
+    ]
+
+
+def test_histogram():
+    histogram = metrics.Histogram("test_seconds", "A test histogram", buckets=(1, 10))
+    histogram.observe(0.5)
+    histogram.observe(5)
+    histogram.observe(50)
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{le="1"} 1',
+        'test_seconds_bucket{le="10"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        "test_seconds_sum 55.5",
+        "test_seconds_count 3",
+    ]
+
+
+def test_label_escaping():
+    gauge = metrics.Gauge("test_gauge", "A test gauge", ["name"])
+    gauge.set(1, name='a "b"')
+    assert gauge.render()[2] == 'test_gauge{name="a \\"b\\""} 1'
+
+
+def test_endpoint():
+    assert endpoint("http://api/api/v1/recordings/123/tracks/4") == (
+        "/api/v1/recordings/:id/tracks/:id"
+    )
+
+
+def test_serve():
+    metrics.WORKERS.set(4)
+    server = metrics.serve(0)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/metrics"
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode()
+        assert "processing_workers 4" in body.splitlines()
+    finally:
+        server.shutdown()
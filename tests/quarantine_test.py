@@ -0,0 +1,65 @@
+import requests
+
+from processing.processutils import CalledProcessErrorWithOutput
+from processing.quarantine import DETERMINISTIC, TRANSIENT, Quarantine, classify
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def http_error(status_code):
+    return requests.exceptions.HTTPError(response=FakeResponse(status_code))
+
+
+def test_classify():
+    assert classify(CalledProcessErrorWithOutput(1, "classify")) == DETERMINISTIC
+    assert classify(CalledProcessErrorWithOutput(137, "classify")) == TRANSIENT
+    assert classify(ValueError("bad json")) == DETERMINISTIC
+    assert classify(http_error(400)) == DETERMINISTIC
+    assert classify(http_error(503)) == TRANSIENT
+    assert classify(requests.exceptions.ConnectionError()) == TRANSIENT
+    assert classify(TimeoutError()) == TRANSIENT
+
+
+def test_deterministic_skipped_straight_away():
+    quarantine = Quarantine()
+    quarantine.failed(1, ValueError("bad json"), now=0)
+    assert quarantine.skip(1, now=1) is not None
+    assert quarantine.skip(2, now=1) is None
+
+
+def test_transient_backs_off():
+    quarantine = Quarantine(backoff_secs=100)
+    quarantine.failed(1, TimeoutError(), now=0)
+    assert quarantine.skip(1, now=50) is not None
+    assert quarantine.skip(1, now=100) is None
+    quarantine.failed(1, TimeoutError(), now=100)
+    assert quarantine.skip(1, now=250) is not None
+    assert quarantine.skip(1, now=300) is None
+
+
+def test_quarantined_after_identical_failures():
+    quarantine = Quarantine(max_failures=2, backoff_secs=1)
+    quarantine.failed(1, TimeoutError(), now=0)
+    quarantine.failed(1, ConnectionError(), now=10)
+    assert quarantine.skip(1, now=100) is None
+    quarantine.failed(1, TimeoutError(), now=100)
+    assert "quarantined" in quarantine.skip(1, now=1000)
+
+
+def test_success_and_expiry_clear():
+    quarantine = Quarantine(expiry_secs=1000)
+    quarantine.failed(1, ValueError(), now=0)
+    quarantine.failed(2, ValueError(), now=0)
+    quarantine.succeeded(1)
+    assert quarantine.skip(1, now=1) is None
+    assert quarantine.skip(2, now=1) is not None
+    assert quarantine.skip(2, now=1001) is None
+
+
+def test_kept_over_restarts(tmp_path):
+    filename = str(tmp_path / "quarantine.sqlite")
+    Quarantine(filename).failed(1, ValueError(), now=0)
+    assert Quarantine(filename).skip(1, now=1) is not None
@@ -0,0 +1,83 @@
+import os
+import stat
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from processing import stream
+from processing.download import Mismatch
+
+DATA = os.urandom(300 * 1024)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(DATA)))
+        self.end_headers()
+        self.wfile.write(DATA)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAPI:
+    def __init__(self):
+        self.session = requests.Session()
+        self.cache = None
+
+
+@pytest.fixture
+def url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/file"
+    server.shutdown()
+
+
+def deferred(url, filename, recording=None):
+    streams = []
+    with stream.deferring(streams):
+        assert stream.defer(FakeAPI(), url, {}, str(filename), recording)
+    assert stat.S_ISFIFO(os.stat(filename).st_mode)
+    return streams[0]
+
+
+def test_not_deferred(tmp_path):
+    filename = str(tmp_path / "recording.cptv")
+    assert not stream.defer(FakeAPI(), "", {}, filename, None)
+    with stream.deferring([]):
+        assert not stream.defer(FakeAPI(), "", {}, str(tmp_path / "a.mp4"), None)
+    assert not os.path.exists(filename)
+
+
+def test_streams_to_reader_and_file(url, tmp_path):
+    filename = tmp_path / "recording.cptv"
+    s = deferred(url, filename)
+    s.start(lambda: False)
+    with open(filename, "rb") as f:
+        assert f.read() == DATA
+    s.finish()
+    assert filename.read_bytes() == DATA
+
+
+def test_downloads_without_reader(url, tmp_path, monkeypatch):
+    monkeypatch.setattr("processing.stream.OPEN_POLL_SECS", 0)
+    filename = tmp_path / "recording.cptv"
+    s = deferred(url, filename)
+    s.start(lambda: True)
+    s.finish()
+    assert filename.read_bytes() == DATA
+
+
+def test_mismatch_fails(url, tmp_path, monkeypatch):
+    monkeypatch.setattr("processing.stream.OPEN_POLL_SECS", 0)
+    filename = tmp_path / "recording.cptv"
+    s = deferred(url, filename, {"id": 1, "rawFileHash": "0" * 40})
+    s.start(lambda: True)
+    with pytest.raises(Mismatch):
+        s.finish()
@@ -0,0 +1,52 @@
+import json
+
+from processing import timing
+from processing.pipeline import Job
+
+
+def test_stage_adds_up():
+    with timing.recording(timing.Timings()) as timings:
+        with timing.stage("command"):
+            pass
+        with timing.stage("command"):
+            pass
+    assert list(timings.durations) == ["command"]
+    assert timing.current() is None
+
+
+def test_stage_without_timings():
+    with timing.stage("command"):
+        pass
+
+
+def test_timed():
+    @timing.timed
+    def add_track():
+        return 1
+
+    with timing.recording(timing.Timings()) as timings:
+        assert add_track() == 1
+    assert "add_track" in timings.durations
+
+
+def test_with_timings():
+    metadata = {"additionalMetadata": {"algorithm": 1}}
+    with timing.recording(timing.Timings({"download": 1.23456})):
+        timing.with_timings(metadata)
+    assert metadata == {
+        "additionalMetadata": {"algorithm": 1, "timings": {"download": 1.235}}
+    }
+    assert timing.with_timings({}) == {}
+
+
+def test_timing_log(tmp_path):
+    filename = tmp_path / "timings.jsonl"
+    log = timing.TimingLog(str(filename))
+    job = Job({"id": 1, "jobKey": "key"}, "jwt", "analyse")
+    job.timings.add("download", 2)
+    log.write(job, "audio", "succeeded")
+    log.write(job, "audio", "failed")
+    lines = [json.loads(line) for line in filename.read_text().splitlines()]
+    assert len(lines) == 2
+    assert lines[0]["timings"] == {"download": 2}
+    assert lines[1]["result"] == "failed"
@@ -0,0 +1,106 @@
+import os
+import time
+
+from processing.workerpool import WorkerPool
+
+
+def slow_pid():
+    time.sleep(0.1)
+    return os.getpid()
+
+
+def make_pool(quotas, max_workers=None):
+    pool = WorkerPool(max_workers)
+    for processor_id, quota in quotas.items():
+        pool.register(processor_id, quota)
+    if pool.max_workers is None:
+        pool.max_workers = sum(quotas.values())
+    return pool
+
+
+def test_guaranteed_quota():
+    pool = make_pool({1: 2, 2: 2})
+    pool.set_backlog(2, True)
+    assert pool.free_slots(1) == 2
+
+
+def test_borrow_idle_workers():
+    pool = make_pool({1: 2, 2: 2})
+    assert pool.free_slots(1) == 4
+
+
+def test_dont_borrow_from_busy_processor():
+    pool = make_pool({1: 2, 2: 2})
+    pool.set_backlog(2, True)
+    pool.in_use[1] = 2
+    assert pool.free_slots(1) == 0
+    assert pool.free_slots(2) == 2
+
+
+def test_weighted_share():
+    pool = make_pool({1: 1, 2: 3}, max_workers=8)
+    pool.set_backlog(1, True)
+    pool.set_backlog(2, True)
+    assert pool.free_slots(1) == 2
+    assert pool.free_slots(2) == 6
+
+
+def test_hard_cap():
+    pool = make_pool({1: 2, 2: 2}, max_workers=3)
+    pool.in_use[2] = 2
+    assert pool.free_slots(1) == 1
+    assert pool.free_slots(1, pending=1) == 0
+
+
+def test_finished():
+    pool = make_pool({1: 1})
+    pool.in_use[1] = 1
+    pool.finished(1)
+    pool.finished(1)
+    assert pool.in_use[1] == 0
+
+
+def test_recycle_keeps_running_jobs():
+    pool = make_pool({1: 1})
+    pool.start()
+    running = pool.schedule(1, time.sleep, (0.5,))
+    old = pool.pool
+    pool.recycle()
+    assert pool.pool is old
+    assert running.result(timeout=10) is None
+    assert pool.schedule(1, abs, (-1,)).result(timeout=10) == 1
+    pool.pool.stop()
+
+
+def test_recycle_replaces_every_worker():
+    pool = make_pool({1: 2})
+    pool.start()
+    try:
+        before = {pool.pool.schedule(slow_pid).result() for _ in range(4)}
+        pool.recycle()
+        deadline = time.time() + 10
+        while pool.recycling is not None and time.time() < deadline:
+            time.sleep(0.1)
+        assert pool.retired == 2
+        after = {pool.pool.schedule(slow_pid).result() for _ in range(4)}
+        assert not before & after
+    finally:
+        pool.pool.stop()
+
+
+def test_resize_within_size_keeps_pool():
+    pool = WorkerPool(2, size=4)
+    pool.register(1, 2)
+    pool.start()
+    try:
+        started = pool.pool
+        assert pool.resize(4)
+        assert pool.resize(1)
+        assert pool.pool is started
+        assert pool.free_slots(1) == 1
+        # growing past the workers started needs a new pool
+        assert pool.resize(6)
+        assert pool.pool is not started
+        assert pool.size == 6
+    finally:
+        pool.pool.stop()